@@ -0,0 +1,426 @@
+"""
+accuracy.py
+
+Differential accuracy harness for fast calculation paths.
+
+A candidate replaces the swisseph longitude calculation (swe.calc_ut) used by
+hd_features and the astrology signs/houses. The harness samples random
+instants and locations, runs the reference and every candidate on them and
+compares gate, line, color, tone and base of all activations, the design
+date, type, authority and the astrology signs and houses. It reports the
+maximum arc error per body, the mismatches with their distance to the nearest
+boundary and the speed of each candidate relative to the reference.
+
+Like benchmark.py it can be used as a gate: the exit status is 1 if a
+candidate exceeds the allowed mismatch rate or arc error.
+
+Example:
+    python accuracy.py --samples 200000 --workers 8 --output accuracy.json
+    python accuracy.py --only moshier --max-mismatch-rate 0 --max-arc-error 2
+    python accuracy.py --only --policy moshier,Moon:swiss
+"""
+import argparse
+import json
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import swisseph as swe
+import flatlib
+from flatlib import const
+from flatlib.object import House
+
+import human_design_lib.hd_features as hdf
+from human_design_lib import hd_constants
+from human_design_lib import hd_ephemeris
+
+# Gate, line, color, tone and base widths in degrees
+FIELD_WIDTHS = {"gate": 360 / 64,
+                "line": 360 / (64 * 6),
+                "color": 360 / (64 * 6 * 6),
+                "tone": 360 / (64 * 6 * 6 * 6),
+                "base": 360 / (64 * 6 * 6 * 6 * 5)}
+
+# Bodies of the astrology output that come from calc_ut, with their offset
+ASTRO_BODIES = {"Sun": (swe.SUN, 0), "Moon": (swe.MOON, 0), "Mercury": (swe.MERCURY, 0),
+                "Venus": (swe.VENUS, 0), "Mars": (swe.MARS, 0), "Jupiter": (swe.JUPITER, 0),
+                "Saturn": (swe.SATURN, 0), "Uranus": (swe.URANUS, 0),
+                "Neptune": (swe.NEPTUNE, 0), "Pluto": (swe.PLUTO, 0),
+                "Chiron": (swe.CHIRON, 0), "North Node": (swe.MEAN_NODE, 0),
+                "South Node": (swe.MEAN_NODE, 180), "Lilith": (swe.MEAN_APOG, 0),
+                "Earth": (swe.SUN, 180)}
+
+CANDIDATES = {}
+
+# Candidates built in this process, keyed by (name, jd_start, jd_end)
+_built = {}
+
+
+def candidate(name):
+    """
+    Register a candidate. The decorated function receives the sampled Julian
+    day range (UT) and returns a function (jdut, planet_code) -> longitude.
+    """
+    def register(function):
+        CANDIDATES[name] = function
+        return function
+    return register
+
+
+def reference_lon(jdut, planet_code):
+    return swe.calc_ut(jdut, planet_code)[0][0]
+
+
+def policy_candidate(policy):
+    """Longitudes of an hd_ephemeris policy."""
+    def lon(jdut, planet_code):
+        return swe.calc_ut(jdut, planet_code, policy.flag(planet_code))[0][0]
+    return lon
+
+
+@candidate("moshier")
+def moshier(jd_start, jd_end):
+    """
+    Moshier's analytical ephemeris, no ephemeris files. Bodies Moshier does
+    not cover (Chiron) fall back to the Swiss Ephemeris.
+    """
+    return policy_candidate(hd_ephemeris.EphemerisPolicy("moshier"))
+
+
+def build_candidate(name, jd_start, jd_end):
+    """
+    A registered candidate, or an ephemeris policy for names
+    "policy:DEFAULT[,BODY:MODE...]" (see hd_ephemeris.parse_policy).
+    """
+    if name.startswith("policy:"):
+        default, _, bodies = name[len("policy:"):].partition(",")
+        return policy_candidate(hd_ephemeris.parse_policy(default, bodies))
+    return CANDIDATES[name](jd_start, jd_end)
+
+
+class HermiteEphemeris:
+    """
+    Longitudes interpolated from tables of position and speed with cubic
+    Hermite splines.
+
+    Parameters
+    ----------
+    planet_codes: iterable of int
+        swisseph planet numbers to tabulate.
+    jd_start, jd_end: float
+        Julian day range (UT) covered by the tables.
+    step: float
+        Table spacing in days.
+    """
+    def __init__(self, planet_codes, jd_start, jd_end, step=0.5):
+        self.step = step
+        self.jd0 = math.floor(jd_start) - step
+        n = int(math.ceil((jd_end - self.jd0) / step)) + 2
+        # Two extra nodes on each side for the derivatives
+        grid = self.jd0 + step * np.arange(-2, n + 2)
+        self.tables = {}
+        for code in set(planet_codes):
+            lon = np.array([swe.calc_ut(jd, code)[0][0] for jd in grid])
+            # Unwrap so interpolation does not jump at 0/360 degrees
+            lon = np.rad2deg(np.unwrap(np.deg2rad(lon)))
+            # Five point derivative (per step) of the positions; the speeds of
+            # calc_ut have glitches at ephemeris segment boundaries
+            speed = (lon[:-4] - 8 * lon[1:-3] + 8 * lon[3:-1] - lon[4:]) / 12
+            self.tables[code] = (lon[2:-2], speed)
+
+    def __call__(self, jdut, planet_code):
+        lon, speed = self.tables[planet_code]
+        x = (jdut - self.jd0) / self.step
+        i = int(x)
+        t = x - i
+        t2, t3 = t * t, t * t * t
+        value = ((2 * t3 - 3 * t2 + 1) * lon[i] + (t3 - 2 * t2 + t) * speed[i]
+                 + (-2 * t3 + 3 * t2) * lon[i + 1] + (t3 - t2) * speed[i + 1])
+        return value % 360
+
+
+@candidate("hermite")
+def hermite(jd_start, jd_end):
+    """
+    Half-day Hermite tables of the Swiss Ephemeris (design date included).
+    """
+    codes = set(hd_constants.SWE_PLANET_DICT.values())
+    codes.update(code for code, _ in ASTRO_BODIES.values())
+    return HermiteEphemeris(codes, jd_start - 100, jd_end)
+
+
+class CandidateFeatures(hdf.hd_features):
+    """
+    hd_features with the longitudes of a candidate. The design date is
+    solved on the candidate's Sun.
+    """
+    ephemeris = staticmethod(reference_lon)
+
+    def planet_lon(self, jdut, planet_code):
+        return self.ephemeris(jdut, planet_code)
+
+    def calc_create_date(self, jdut):
+        target = (self.ephemeris(jdut, swe.SUN) - 88) % 360
+        jd = jdut - 88 / 0.9856
+        for _ in range(8):
+            delta = (self.ephemeris(jd, swe.SUN) - target + 180) % 360 - 180
+            speed = ((self.ephemeris(jd + 0.01, swe.SUN) - self.ephemeris(jd - 0.01, swe.SUN) + 180)
+                     % 360 - 180) / 0.02
+            jd -= delta / speed
+            if abs(delta) < 1e-9:
+                break
+        return jd
+
+
+def arc_difference(a, b):
+    """Absolute difference of two longitudes in degrees."""
+    return abs((a - b + 180) % 360 - 180)
+
+
+def boundary_distance(lon, field):
+    """Distance in degrees from a longitude to the nearest boundary of a field."""
+    width = FIELD_WIDTHS[field]
+    position = ((lon + hd_constants.IGING_offset) % 360) % width
+    return min(position, width - position)
+
+
+def astro_positions(lon, jdut, lat, geo_lon):
+    """
+    Sign and house (equal houses, flatlib's house offset) of the astrology
+    bodies, longitudes from lon.
+    """
+    asc = swe.houses(jdut, lat, geo_lon, b"E")[1][0]
+    positions = {}
+    for name, (code, offset) in ASTRO_BODIES.items():
+        body_lon = (lon(jdut, code) + offset) % 360
+        house = int(((body_lon - asc - House._OFFSET) % 360) // 30) + 1
+        positions[name] = (const.LIST_SIGNS[int(body_lon // 30)], house, body_lon)
+    return positions
+
+
+def random_samples(seed, n, jd_start, jd_end):
+    """
+    Random instants (Julian day UT) and locations, latitudes within +-60
+    degrees where the house systems are defined.
+    """
+    rng = np.random.default_rng(seed)
+    return np.column_stack([rng.uniform(jd_start, jd_end, n),
+                            rng.uniform(-60, 60, n),
+                            rng.uniform(-180, 180, n)])
+
+
+def chart(features_class, jdut, lat, geo_lon):
+    year, month, day, hour = swe.revjul(jdut)
+    instance = features_class(year, month, day, int(hour), 0, 0, 0, lat, geo_lon)
+    start = time.perf_counter()
+    date_to_gate_dict = instance.birth_creat_date_to_gate(birth_julday=jdut)
+    elapsed = time.perf_counter() - start
+    create_julday = instance.calc_create_date(jdut)
+    typ, auth = hdf.calc_gate_dict_features(date_to_gate_dict)[:2]
+    return date_to_gate_dict, create_julday, typ, auth, elapsed
+
+
+def empty_stats():
+    return {"samples": 0,
+            "activations": 0,
+            "mismatches": {field: 0 for field in
+                           list(FIELD_WIDTHS) + ["type", "authority", "astro_sign", "astro_house"]},
+            "max_arc_error_arcsec": {},
+            "max_design_error_sec": 0.0,
+            "reference_sec": 0.0,
+            "candidate_sec": 0.0,
+            "boundary_mismatches": []}
+
+
+def compare_sample(stats, features_class, lon, jdut, lat, geo_lon, max_examples):
+    ref = chart(hdf.hd_features, jdut, lat, geo_lon)
+    cand = chart(features_class, jdut, lat, geo_lon)
+    stats["samples"] += 1
+    stats["reference_sec"] += ref[4]
+    stats["candidate_sec"] += cand[4]
+
+    ref_dict, cand_dict = ref[0], cand[0]
+    for i, planet in enumerate(ref_dict["planets"]):
+        stats["activations"] += 1
+        key = "{} {}".format(ref_dict["label"][i], planet)
+        arc = arc_difference(ref_dict["lon"][i], cand_dict["lon"][i]) * 3600
+        body = stats["max_arc_error_arcsec"]
+        body[planet] = max(body.get(planet, 0.0), arc)
+        for field in FIELD_WIDTHS:
+            if ref_dict[field][i] != cand_dict[field][i]:
+                stats["mismatches"][field] += 1
+                if len(stats["boundary_mismatches"]) < max_examples:
+                    stats["boundary_mismatches"].append({
+                        "jdut": jdut, "activation": key, "field": field,
+                        "reference": ref_dict[field][i], "candidate": cand_dict[field][i],
+                        "arc_error_arcsec": arc,
+                        "boundary_distance_arcsec": boundary_distance(ref_dict["lon"][i], field) * 3600})
+
+    stats["max_design_error_sec"] = max(stats["max_design_error_sec"],
+                                        abs(ref[1] - cand[1]) * 86400)
+    stats["mismatches"]["type"] += ref[2] != cand[2]
+    stats["mismatches"]["authority"] += ref[3] != cand[3]
+
+    ref_astro = astro_positions(reference_lon, jdut, lat, geo_lon)
+    cand_astro = astro_positions(lon, jdut, lat, geo_lon)
+    for name, (sign, house, body_lon) in ref_astro.items():
+        cand_sign, cand_house, cand_lon = cand_astro[name]
+        stats["mismatches"]["astro_sign"] += sign != cand_sign
+        stats["mismatches"]["astro_house"] += house != cand_house
+        arc = arc_difference(body_lon, cand_lon) * 3600
+        body = stats["max_arc_error_arcsec"]
+        body["astro " + name] = max(body.get("astro " + name, 0.0), arc)
+
+
+def merge_stats(total, part):
+    for key in ("samples", "activations", "max_design_error_sec", "reference_sec", "candidate_sec"):
+        if key == "max_design_error_sec":
+            total[key] = max(total[key], part[key])
+        else:
+            total[key] += part[key]
+    for field, count in part["mismatches"].items():
+        total["mismatches"][field] += count
+    for body, arc in part["max_arc_error_arcsec"].items():
+        total["max_arc_error_arcsec"][body] = max(total["max_arc_error_arcsec"].get(body, 0.0), arc)
+    total["boundary_mismatches"].extend(part["boundary_mismatches"])
+    return total
+
+
+def run_chunk(names, seed, n, jd_start, jd_end, ephe_path, max_examples):
+    """
+    Compare n samples for the named candidates (runs in a worker process).
+    """
+    swe.set_ephe_path(ephe_path)
+    # The reference is the Swiss Ephemeris, whatever the configured policy
+    hd_ephemeris.set_policy(hd_ephemeris.EphemerisPolicy("swiss"))
+    results = {}
+    samples = random_samples(seed, n, jd_start, jd_end)
+    for name in names:
+        key = (name, jd_start, jd_end)
+        if key not in _built:
+            _built[key] = build_candidate(name, jd_start, jd_end)
+        lon = _built[key]
+        features_class = type(name, (CandidateFeatures,), {"ephemeris": staticmethod(lon)})
+        stats = empty_stats()
+        for jdut, lat, geo_lon in samples:
+            compare_sample(stats, features_class, lon, jdut, lat, geo_lon, max_examples)
+        results[name] = stats
+    return results
+
+
+def summarize(stats, max_examples):
+    n_samples = max(stats["samples"], 1)
+    per_field = {field: stats["activations"] for field in FIELD_WIDTHS}
+    per_field.update(type=n_samples, authority=n_samples,
+                     astro_sign=n_samples * len(ASTRO_BODIES),
+                     astro_house=n_samples * len(ASTRO_BODIES))
+    stats["mismatch_rates"] = {field: count / max(per_field[field], 1)
+                               for field, count in stats["mismatches"].items()}
+    stats["speedup"] = stats["reference_sec"] / stats["candidate_sec"] if stats["candidate_sec"] else None
+    stats["boundary_mismatches"] = sorted(stats["boundary_mismatches"],
+                                          key=lambda m: -m["boundary_distance_arcsec"])[:max_examples]
+    return stats
+
+
+def run_accuracy(names, samples, seed=0, workers=1, start_year=1900, end_year=2100,
+                 chunk_size=2000, max_examples=20):
+    """
+    Compare candidates against the reference path.
+
+    Returns
+    -------
+    dict
+        Candidate name -> statistics (mismatch counts and rates, maximum arc
+        error per body, maximum design date error, speedup, the mismatches
+        farthest from a boundary).
+    """
+    ephe_path = os.path.join(flatlib.PATH_RES, "swefiles")
+    jd_start = swe.julday(start_year, 1, 1)
+    jd_end = swe.julday(end_year, 1, 1)
+    chunks = [(names, seed * 1000003 + i, min(chunk_size, samples - start),
+               jd_start, jd_end, ephe_path, max_examples)
+              for i, start in enumerate(range(0, samples, chunk_size))]
+
+    totals = {name: empty_stats() for name in names}
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = pool.map(run_chunk, *zip(*chunks))
+            for part in parts:
+                for name in names:
+                    merge_stats(totals[name], part[name])
+    else:
+        for chunk in chunks:
+            part = run_chunk(*chunk)
+            for name in names:
+                merge_stats(totals[name], part[name])
+    return {name: summarize(stats, max_examples) for name, stats in totals.items()}
+
+
+def check(results, max_mismatch_rate, max_arc_error):
+    """
+    Print a summary per candidate and return the candidates that fail the gate.
+    """
+    failed = []
+    for name, stats in results.items():
+        worst_rate = max(stats["mismatch_rates"].values())
+        worst_arc = max(stats["max_arc_error_arcsec"].values())
+        worst_body = max(stats["max_arc_error_arcsec"], key=stats["max_arc_error_arcsec"].get)
+        ok = worst_rate <= max_mismatch_rate and worst_arc <= max_arc_error
+        if not ok:
+            failed.append(name)
+        print("{:12s} samples {:8d}  speedup x{:.2f}  max arc {:.3f}\" ({})  design {:.3f} s  {}".format(
+            name, stats["samples"], stats["speedup"] or 0.0, worst_arc, worst_body,
+            stats["max_design_error_sec"], "ok" if ok else "FAILED"))
+        for field, count in stats["mismatches"].items():
+            if count:
+                print("    {:12s} {:8d} mismatches  rate {:.2e}".format(
+                    field, count, stats["mismatch_rates"][field]))
+        for mismatch in stats["boundary_mismatches"][:5]:
+            print("    {activation} {field}: {reference} vs {candidate}, "
+                  "{boundary_distance_arcsec:.3f}\" from boundary".format(**mismatch))
+    return failed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compares fast calculation paths with swisseph.")
+
+    parser.add_argument("--samples", type=int, default=100000, help="Random instants and locations.")
+    parser.add_argument("--seed", type=int, default=0, help="Sampling seed.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Worker processes.")
+    parser.add_argument("--start-year", type=int, default=1900, help="First sampled year.")
+    parser.add_argument("--end-year", type=int, default=2100, help="Last sampled year (exclusive).")
+    parser.add_argument("--only", nargs="*", default=None,
+                        help="Candidates to compare. Defaults to all.")
+    parser.add_argument("--policy", nargs="*", default=[],
+                        help="Ephemeris policies to compare as well, e.g. moshier,Moon:swiss")
+    parser.add_argument("--max-mismatch-rate", type=float, default=1e-3,
+                        help="Allowed mismatch rate of any compared field.")
+    parser.add_argument("--max-arc-error", type=float, default=5.0,
+                        help="Allowed longitude error in arcseconds.")
+    parser.add_argument("--max-examples", type=int, default=20,
+                        help="Mismatches reported per candidate.")
+    parser.add_argument("--output", default=None, help="JSON file for the results.")
+
+    return parser.parse_args()
+
+
+def main(args):
+    names = [name for name in CANDIDATES if args.only is None or name in args.only]
+    names += ["policy:" + policy for policy in args.policy]
+    results = run_accuracy(names, args.samples, seed=args.seed, workers=args.workers,
+                           start_year=args.start_year, end_year=args.end_year,
+                           max_examples=args.max_examples)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"samples": args.samples, "seed": args.seed,
+                       "years": [args.start_year, args.end_year], "results": results}, f, indent=2)
+    if check(results, args.max_mismatch_rate, args.max_arc_error):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(parse_args()))
@@ -3,7 +3,6 @@ astrology.py
 
 Functions for creating astrology birth information.
 """
-import swisseph
 import flatlib
 from flatlib.datetime import Datetime
 from flatlib.geopos import GeoPos
@@ -12,38 +11,70 @@ from flatlib import const
 from flatlib.ephem.eph import _signInfo
 from flatlib.object import Object
 
-def get_astro(birthDate, birthTime, timeOffset, location):
+from birth import as_instant
+from fixed_stars import get_fixed_stars, DEFAULT_ORB
+from human_design_lib import hd_ephemeris
+from human_design_lib.hd_constants import PENDING, EXTRA_BODY_DICT
+
+# flatlib computes its objects with the ephemeris policy
+hd_ephemeris.install_flatlib()
+
+# Points that move with the location, not used without it
+LOCATION_POINTS = {"Pars Fortuna", "Ascending", "Descending", "Midheaven", "IC"}
+
+
+def get_astro(birthDate, birthTime=None, timeOffset=None, location=None, fixed_stars=False,
+              extra_bodies=()):
     """
     Create the astrology information from the chart.
 
     Parameters
     ----------
-    birthDate: str
-        Should be in the format YYYY/MM/DD
+    birthDate: str or birth.BirthInstant
+        Should be in the format YYYY/MM/DD, or the parsed birth instant
+        (the other arguments are then not used).
     birthTime : str
         Should be in the format HH:MM. Optionally HH:MM:SS.
     timeOffset: str
         UTC offset. Should be in the format HH:MM. Optionally HH:MM:SS.
-    location: tuple(str, str) or tuple(float, float)
-        Should be in the format (latitude, longitude). Latitude and longitude
-        can be either in string form ("32n30") or in numerical form (32.5452).
-        Negative numbers in the numerical form correspond to south and west.
+    location: tuple(float, float)
+        Should be in the format (latitude, longitude). Negative numbers
+        correspond to south and west. None if the location is not known yet:
+        the planet signs are computed, houses, angles and the sign of
+        Pars Fortuna are PENDING.
+    fixed_stars: bool
+        Add the fixed stars within DEFAULT_ORB of the chart points under
+        "Fixed Stars" (see fixed_stars.py).
+    extra_bodies: list of str
+        Optional bodies (hd_constants.EXTRA_BODY_DICT), returned under
+        "Extra Bodies" in the format of the planets.
     """
-    date = Datetime(birthDate, birthTime, timeOffset)
-    pos = GeoPos(*location)
+    birth = as_instant(birthDate, birthTime, timeOffset, location)
+    location = birth.location
+    # flatlib only uses the julian day of the date
+    date = Datetime.fromJD(birth.jd_ut, birth.utc_offset)
+    pending = location is None
+    # Planet signs do not depend on the location
+    pos = GeoPos(0, 0) if pending else GeoPos(*location)
     chart = Chart(date, pos, IDs=const.LIST_OBJECTS, hsys=const.HOUSES_EQUAL)
     info = {}
+    longitudes = {}
     planets = const.LIST_OBJECTS
 
+    def house(obj):
+        return PENDING if pending else chart.houses.getObjectHouse(obj).id
+
     # This will get every planet except for Lilith and Earth
     for planet in planets:
         pl = chart.getObject(planet)
-        line = {"sign": pl.sign,
-                "house": chart.houses.getObjectHouse(pl).id}
+        # Pars Fortuna is placed from the angles, unknown without the location
+        line = {"sign": PENDING if pending and pl.id in LOCATION_POINTS else pl.sign,
+                "house": house(pl)}
         info[pl.id] = line
+        longitudes[pl.id] = pl.lon
 
     # Calculate Lilith separately using the Swiss Ephemera directly
-    sweph, _ = swisseph.calc_ut(date.jd, 12)  # 12 is the code for Mean Lunar Apogee
+    sweph, _ = hd_ephemeris.calc_ut(birth.jd_ut, 12)  # 12 is the code for Mean Lunar Apogee
     lilith_dict = {"id": "Lilith",
                    "lon": sweph[0],
                    "lat": sweph[1],
@@ -52,11 +83,12 @@ def get_astro(birthDate, birthTime, timeOffset, location):
     _signInfo(lilith_dict)  # Adds the sign and sign longitude
     lilith_obj = Object.fromDict(lilith_dict)
     line = {"sign": lilith_obj.sign,
-            "house": chart.houses.getObjectHouse(lilith_obj).id}
+            "house": house(lilith_obj)}
     info[lilith_obj.id] = line
+    longitudes[lilith_obj.id] = lilith_obj.lon
 
     # Calculate Earth separately using the Sun object
-    earth_dict = flatlib.ephem.swe.sweObject(const.SUN, date.jd)
+    earth_dict = flatlib.ephem.swe.sweObject(const.SUN, birth.jd_ut)
     earth_dict.update({
             'id': "Earth",
             'lon': flatlib.angle.norm(earth_dict['lon'] + 180)
@@ -64,8 +96,24 @@ def get_astro(birthDate, birthTime, timeOffset, location):
     _signInfo(earth_dict)
     earth_obj = Object.fromDict(earth_dict)
     line = {"sign": earth_obj.sign,
-            "house": chart.houses.getObjectHouse(earth_obj).id}
+            "house": house(earth_obj)}
     info[earth_obj.id] = line
+    longitudes[earth_obj.id] = earth_obj.lon
+
+    # Optional bodies, computed only on request
+    if extra_bodies:
+        hd_ephemeris.require_bodies(extra_bodies)
+        extra = {}
+        for body in extra_bodies:
+            sweph, _ = hd_ephemeris.calc_ut(birth.jd_ut, EXTRA_BODY_DICT[body])
+            body_dict = {"id": body, "lon": sweph[0], "lat": sweph[1],
+                         "lonspeed": sweph[3], "latspeed": sweph[4]}
+            _signInfo(body_dict)
+            body_obj = Object.fromDict(body_dict)
+            extra[body] = {"sign": body_obj.sign,
+                           "house": house(body_obj)}
+            longitudes[body] = body_obj.lon
+        info["Extra Bodies"] = extra
 
     # Get angles separately
     angle_names = {"Asc": "Ascending",
@@ -74,7 +122,14 @@ def get_astro(birthDate, birthTime, timeOffset, location):
                    "IC": "IC"}
     for ang in const.LIST_ANGLES:
         angle = chart.getAngle(ang)
-        info[angle_names[ang]] = {"sign": angle.sign}
-    
+        info[angle_names[ang]] = {"sign": PENDING if pending else angle.sign}
+        longitudes[angle_names[ang]] = angle.lon
+
+    if fixed_stars:
+        if pending:
+            longitudes = {name: lon for name, lon in longitudes.items()
+                          if name not in LOCATION_POINTS}
+        info["Fixed Stars"] = get_fixed_stars().conjunctions(longitudes, birth.jd_ut, DEFAULT_ORB)
+
     return info
 
@@ -0,0 +1,396 @@
+"""
+benchmark.py
+
+Benchmark suite for every calculation layer.
+
+Each benchmark runs over a fixed corpus of representative births and reports
+throughput, latency percentiles and memory allocated per call. Results are
+saved as JSON; --compare checks them against an earlier result file and
+exits with status 1 if a benchmark's median latency regressed.
+
+Example:
+    python benchmark.py --output bench_main.json
+    python benchmark.py --output bench_branch.json --compare bench_main.json
+"""
+import argparse
+import contextlib
+import inspect
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import swisseph
+import flatlib
+
+import human_design_lib.hd_features as hdf
+from human_design_lib import hd_ephemeris
+from human_design import get_hd, processTimeOffset
+from astrology import get_astro
+from birth import BirthInstant
+from gene_keys import get_gk, gk_codes
+from bodygraph import chart_signature, render_signature
+from human_design_lib import hd_cycles
+from human_design_lib.hd_index import ACTIVATION_KEYS
+from human_design_lib.hd_constants import EXTRA_BODY_DICT
+
+# Representative births: eras, hemispheres, offsets, high latitudes and
+# the different types. Format (birthDate, birthTime, timeOffset, location).
+CORPUS = [
+    ("1925/03/14", "06:30", "+01:00", (48.8566, 2.3522)),
+    ("1938/11/02", "23:15", "-05:00", (40.7128, -74.0060)),
+    ("1947/07/21", "12:00", "+05:30", (19.0760, 72.8777)),
+    ("1953/01/30", "04:45", "+09:00", (35.6762, 139.6503)),
+    ("1961/09/09", "18:20", "-03:00", (-34.6037, -58.3816)),
+    ("1969/07/20", "20:17", "+00:00", (51.5074, -0.1278)),
+    ("1974/12/25", "09:05", "+10:00", (-33.8688, 151.2093)),
+    ("1981/04/17", "15:40", "-08:00", (37.7749, -122.4194)),
+    ("1986/06/06", "02:10", "+03:00", (55.7558, 37.6173)),
+    ("1990/10/31", "21:55", "+02:00", (-33.9249, 18.4241)),
+    ("1995/02/07", "08:00", "-06:00", (30.5083, -97.6789)),
+    ("1999/08/11", "11:03", "+01:00", (64.1466, -21.9426)),
+    ("2003/05/23", "13:30", "+08:00", (1.3521, 103.8198)),
+    ("2008/02/29", "00:01", "-07:00", (33.4484, -112.0740)),
+    ("2013/11/13", "16:45", "+13:00", (-36.8485, 174.7633)),
+    ("2019/03/20", "21:58", "+00:00", (69.6492, 18.9553)),
+]
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """
+    Register a benchmark. The decorated function receives the corpus and
+    returns a list of zero-argument callables (or yields it once, see
+    prepared); iterations cycle through them.
+    """
+    def register(function):
+        BENCHMARKS[name] = function
+        return function
+    return register
+
+
+def _timestamp(birth):
+    birthDate, birthTime, timeOffset, _ = birth
+    date = [int(s) for s in birthDate.split("/")]
+    time_parts = [int(t) for t in birthTime.split(":")] + [0]
+    return tuple(date + time_parts[:3] + [processTimeOffset(timeOffset)])
+
+
+def _instance(birth):
+    return hdf.hd_features(*_timestamp(birth), *birth[3])
+
+
+@benchmark("hd.date_to_gate")
+def bench_date_to_gate(corpus):
+    calls = []
+    for birth in corpus:
+        instance = _instance(birth)
+        jdut = instance.timestamp_to_juldate()
+        calls.append(lambda instance=instance, jdut=jdut: instance.date_to_gate(jdut, "prs"))
+    return calls
+
+
+@benchmark("hd.calc_create_date")
+def bench_calc_create_date(corpus):
+    calls = []
+    for birth in corpus:
+        instance = _instance(birth)
+        jdut = instance.timestamp_to_juldate()
+        calls.append(lambda instance=instance, jdut=jdut: instance.calc_create_date(jdut))
+    return calls
+
+
+def _gate_dicts(corpus):
+    return [_instance(birth).birth_creat_date_to_gate() for birth in corpus]
+
+
+@benchmark("hd.get_channels_and_active_chakras")
+def bench_channels(corpus):
+    return [lambda d=d: hdf.get_channels_and_active_chakras(hdf.remove_extras(d))
+            for d in _gate_dicts(corpus)]
+
+
+def _channel_results(corpus):
+    return [hdf.get_channels_and_active_chakras(hdf.remove_extras(d))
+            for d in _gate_dicts(corpus)]
+
+
+@benchmark("hd.get_typ")
+def bench_typ(corpus):
+    return [lambda c=c, a=a: hdf.get_typ(c, a) for c, a in _channel_results(corpus)]
+
+
+@benchmark("hd.get_auth")
+def bench_auth(corpus):
+    return [lambda c=c, a=a: hdf.get_auth(a, c) for c, a in _channel_results(corpus)]
+
+
+@benchmark("hd.get_split")
+def bench_split(corpus):
+    return [lambda c=c, a=a: hdf.get_split(c, a) for c, a in _channel_results(corpus)]
+
+
+@benchmark("birth.from_strings")
+def bench_birth(corpus):
+    return [lambda b=birth: BirthInstant.from_strings(*b) for birth in corpus]
+
+
+@benchmark("get_hd")
+def bench_get_hd(corpus):
+    return [lambda b=birth: get_hd(*b) for birth in corpus]
+
+
+@benchmark("get_astro")
+def bench_get_astro(corpus):
+    return [lambda b=birth: get_astro(*b) for birth in corpus]
+
+
+@benchmark("get_hd.instant")
+def bench_get_hd_instant(corpus):
+    """get_hd of an already parsed birth, as compute_details calls it."""
+    return [lambda b=BirthInstant.from_strings(*birth): get_hd(b) for birth in corpus]
+
+
+@benchmark("get_astro.fixed_stars")
+def bench_get_astro_stars(corpus):
+    return [lambda b=birth: get_astro(*b, fixed_stars=True) for birth in corpus]
+
+
+def _register_extra_body(body):
+    @benchmark("extra_body.{}.hd".format(body))
+    def bench_hd(corpus):
+        """Incremental cost in get_hd: the body at birth and design time."""
+        instances = []
+        for birth in corpus:
+            instance = _instance(birth)
+            instance.birth_creat_date_to_gate()
+            instances.append(instance)
+        return [lambda i=instance: i.extra_bodies_to_gate([body]) for instance in instances]
+
+    @benchmark("extra_body.{}.astro".format(body))
+    def bench_astro(corpus):
+        """Incremental cost in get_astro: the body's position at birth."""
+        code = EXTRA_BODY_DICT[body]
+        return [lambda jd=BirthInstant.from_strings(*birth).jd_ut: hd_ephemeris.calc_ut(jd, code)
+                for birth in corpus]
+
+
+# Incremental cost of each optional body
+for _body in EXTRA_BODY_DICT:
+    _register_extra_body(_body)
+
+
+@benchmark("get_gk")
+def bench_get_gk(corpus):
+    return [lambda p=get_hd(*birth)["planets"]: get_gk(p) for birth in corpus]
+
+
+@benchmark("gene_keys.codes_10k")
+def bench_gk_codes(corpus):
+    """Sphere codes of 10000 charts (the corpus repeated) in one batch."""
+    halves = {"prs": "personality", "des": "design"}
+    planets = [get_hd(*birth)["planets"] for birth in corpus]
+    rows = np.resize(np.arange(len(planets)), 10000)
+    gates, lines = (np.array([[p[halves[half]][planet][key] for half, planet in ACTIVATION_KEYS]
+                              for p in planets])[rows]
+                    for key in ("gate", "line"))
+    return [lambda: gk_codes(gates, lines)]
+
+
+@benchmark("bodygraph.render")
+def bench_bodygraph(corpus):
+    """Uncached render from the fragments."""
+    return [lambda s=chart_signature(get_hd(*birth)["planets"]): render_signature(s)
+            for birth in corpus]
+
+
+@benchmark("cycles.lifetime_100")
+def bench_cycles(corpus):
+    """All life-cycle events of 90 years for 100 charts (the corpus repeated), tables prebuilt."""
+    jd_birth = np.resize([BirthInstant.from_strings(*birth).jd_ut for birth in corpus], 100)
+    tables = hd_cycles.get_tables(jd_birth.min(), jd_birth.max() + 90 * hd_cycles.DAYS_PER_YEAR)
+    return [lambda: hd_cycles.lifetime_events(jd_birth, 90, tables=tables)]
+
+
+@benchmark("endpoint.generate_details")
+def bench_endpoint(corpus):
+    """
+    The /generate-details endpoint in process, with a stub geocoder that
+    returns the corpus location for each place. The app runs (lifespan
+    included) until the benchmark is done, with its jobs in a temporary
+    directory.
+    """
+    import hda_core
+
+    locations = {"place {}".format(i): birth[3] for i, birth in enumerate(corpus)}
+    hda_core.geocode = lambda place, maps_key=None, **kwargs: locations[place]
+    hda_core.geocode_cache = hda_core.PlaceCache()
+
+    bodies = [{"birthDate": birthDate,
+               "birthTime": birthTime + timeOffset,
+               "birthPlace": "place {}".format(i)}
+              for i, (birthDate, birthTime, timeOffset, _) in enumerate(corpus)]
+    try:
+        from fastapi.testclient import TestClient
+    except (ImportError, RuntimeError):
+        # No HTTP test client installed, call the endpoint function directly
+        yield [lambda body=body: hda_core.generate_details(hda_core.BirthDataModel(**body))
+               for body in bodies]
+        return
+
+    job_dir = os.environ.get("HDA_JOB_DIR")
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["HDA_JOB_DIR"] = tmp
+        try:
+            with TestClient(hda_core.app) as client:
+                yield [lambda body=body: client.post("/generate-details", json=body).json()
+                       for body in bodies]
+        finally:
+            if job_dir is None:
+                del os.environ["HDA_JOB_DIR"]
+            else:
+                os.environ["HDA_JOB_DIR"] = job_dir
+
+
+@contextlib.contextmanager
+def prepared(setup, corpus):
+    """
+    The calls of a benchmark. Setups that need cleaning up are generators
+    yielding their calls once; they are closed when the benchmark is done.
+    """
+    calls = setup(corpus)
+    if not inspect.isgenerator(calls):
+        yield calls
+        return
+    try:
+        yield next(calls)
+    finally:
+        calls.close()
+
+
+def run_benchmark(calls, iterations, warmup):
+    """
+    Time iterations calls (cycling through calls) after warmup calls.
+    """
+    for i in range(warmup):
+        calls[i % len(calls)]()
+
+    latencies = np.empty(iterations)
+    start = time.perf_counter()
+    for i in range(iterations):
+        t0 = time.perf_counter()
+        calls[i % len(calls)]()
+        latencies[i] = time.perf_counter() - t0
+    total = time.perf_counter() - start
+
+    # Allocations in a separate pass, tracing slows the calls down
+    n_traced = min(iterations, len(calls))
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    before, _ = tracemalloc.get_traced_memory()
+    for i in range(n_traced):
+        calls[i]()
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"iterations": iterations,
+            "ops_per_sec": iterations / total,
+            "mean_ms": latencies.mean() * 1000,
+            "p50_ms": np.percentile(latencies, 50) * 1000,
+            "p90_ms": np.percentile(latencies, 90) * 1000,
+            "p99_ms": np.percentile(latencies, 99) * 1000,
+            "max_ms": latencies.max() * 1000,
+            "peak_alloc_bytes": peak - before,
+            "retained_bytes_per_call": (after - before) / n_traced}
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {"commit": commit or None,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": np.__version__,
+            "swisseph": swisseph.version,
+            "ephemeris": hd_ephemeris.get_policy().describe()}
+
+
+def compare(results, baseline, threshold):
+    """
+    Print median latency ratios against a baseline and return the names of
+    benchmarks slower than threshold.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["p50_ms"] / baseline[name]["p50_ms"]
+        flag = ""
+        if ratio > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("{:40s} p50 {:9.3f} ms  baseline {:9.3f} ms  x{:.2f}{}".format(
+            name, result["p50_ms"], baseline[name]["p50_ms"], ratio, flag))
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks the calculation layers.")
+
+    parser.add_argument("--output", default=None, help="JSON file for the results.")
+    parser.add_argument("--compare", default=None, help="Earlier result file to compare against.")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="Median latency ratio above which a benchmark counts as regressed.")
+    parser.add_argument("--iterations", type=int, default=200, help="Timed calls per benchmark.")
+    parser.add_argument("--warmup", type=int, default=20, help="Untimed calls before timing.")
+    parser.add_argument("--only", nargs="*", default=None,
+                        help="Benchmark names (prefixes) to run. Defaults to all.")
+    parser.add_argument("--ephemeris", default=None,
+                        help="Ephemeris policy, e.g. moshier or moshier,Moon:swiss."
+                        " Defaults to HDA_EPHEMERIS/HDA_EPHEMERIS_BODIES.")
+
+    return parser.parse_args()
+
+
+def main(args):
+    # Connect to extra ephemeris files (for Chiron)
+    swisseph.set_ephe_path(os.path.join(flatlib.PATH_RES, "swefiles"))
+    if args.ephemeris:
+        default, _, bodies = args.ephemeris.partition(",")
+        hd_ephemeris.set_policy(hd_ephemeris.parse_policy(default, bodies))
+
+    results = {}
+    for name, setup in BENCHMARKS.items():
+        if args.only and not any(name.startswith(prefix) for prefix in args.only):
+            continue
+        with prepared(setup, CORPUS) as calls:
+            results[name] = run_benchmark(calls, args.iterations, args.warmup)
+        r = results[name]
+        print("{:40s} {:10.1f} ops/s  p50 {:8.3f} ms  p99 {:8.3f} ms  peak {:8d} B".format(
+            name, r["ops_per_sec"], r["p50_ms"], r["p99_ms"], r["peak_alloc_bytes"]))
+
+    report = {"environment": environment(), "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(parse_args()))
@@ -0,0 +1,171 @@
+"""
+birth.py
+
+Canonical birth instant shared by the calculators.
+
+Birth data is parsed and validated once, at the API edge, into a
+BirthInstant: the Julian day in UT (positions, houses) and ET, the location
+and the UTC offset of the local time. get_hd and get_astro accept it
+directly, so the date strings are not parsed and converted again by each
+calculator. Batch callers holding Julian days build instants directly, or
+with from_arrays, without any strings.
+"""
+from datetime import datetime
+
+import swisseph as swe
+
+
+class InvalidBirthData(ValueError):
+    """Birth date, time, UTC offset or location can not be parsed or is out of range."""
+
+
+def parse_offset(timeOffset: str):
+    """
+    UTC offset string ([+-]HH:MM or [+-]HH:MM:SS) in hours, e.g. "-03:30" is -3.5.
+    """
+    # The sign applies to the minutes and seconds too
+    sign = -1 if timeOffset.strip().startswith("-") else 1
+    try:
+        parts = [abs(int(t)) for t in timeOffset.split(":")]
+    except ValueError:
+        raise InvalidBirthData("Invalid UTC offset: {}".format(timeOffset)) from None
+    if len(parts) not in (2, 3) or parts[0] > 14 or any(part > 59 for part in parts[1:]):
+        raise InvalidBirthData("Invalid UTC offset: {}".format(timeOffset))
+    hours = parts[0] + parts[1] / 60
+    if len(parts) == 3:
+        hours += parts[2] / 3600
+    return sign * hours
+
+
+def _check_location(location):
+    if location is None:
+        return None
+    try:
+        latitude, longitude = float(location[0]), float(location[1])
+    except (TypeError, ValueError, IndexError):
+        raise InvalidBirthData("Invalid location: {}".format(location)) from None
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise InvalidBirthData("Location out of range: {}".format(location))
+    return (latitude, longitude)
+
+
+class BirthInstant:
+    """
+    A validated moment and place of birth.
+
+    Parameters
+    ----------
+    jd_ut: float
+        Julian day (UT).
+    location: tuple(float, float) or None
+        (latitude, longitude) in degrees. None if not known (yet): the
+        location-dependent parts of the charts are then pending.
+    utc_offset: float
+        UTC offset of the local birth time in hours, e.g. -6.0.
+    jd_et: float
+        Julian day (ET), computed from jd_ut if not given.
+    timestamp: tuple
+        Local (year, month, day, hour, minute, second, utc_offset), computed
+        from jd_ut if not given.
+    """
+    __slots__ = ("jd_ut", "jd_et", "location", "utc_offset", "_timestamp")
+
+    def __init__(self, jd_ut, location=None, utc_offset=0.0, jd_et=None, timestamp=None):
+        self.jd_ut = float(jd_ut)
+        self.jd_et = float(jd_et) if jd_et is not None else self.jd_ut + swe.deltat(self.jd_ut)
+        self.location = _check_location(location)
+        self.utc_offset = float(utc_offset)
+        self._timestamp = timestamp
+
+    @classmethod
+    def from_strings(cls, birthDate: str, birthTime: str, timeOffset: str, location=None):
+        """
+        Parse API birth data.
+
+        Parameters
+        ----------
+        birthDate: str
+            Should be in the format YYYY/MM/DD
+        birthTime : str
+            Should be in the format HH:MM. Optionally HH:MM:SS.
+        timeOffset: str
+            UTC offset. Should be in the format HH:MM. Optionally HH:MM:SS.
+        location: tuple(float, float) or None
+            (latitude, longitude)
+
+        Raises
+        ------
+        InvalidBirthData
+            If a field can not be parsed or is not a valid date, time or location.
+        """
+        try:
+            year, month, day = [int(s) for s in birthDate.split("/")]
+            time_parts = [int(t) for t in birthTime.split(":")]
+        except ValueError:
+            raise InvalidBirthData("Invalid birth date or time: {} {}".format(birthDate, birthTime)) from None
+        if len(time_parts) == 2:
+            # Was in form HH:MM
+            time_parts.append(0)
+        if len(time_parts) != 3:
+            raise InvalidBirthData("Invalid birth time: {}".format(birthTime))
+        hour, minute, second = time_parts
+        try:
+            datetime(year, month, day, hour, minute, second)
+        except ValueError as exc:
+            raise InvalidBirthData("Invalid birth date or time: {} {} ({})".format(
+                birthDate, birthTime, exc)) from None
+        offset = parse_offset(timeOffset)
+
+        utc = swe.utc_time_zone(year, month, day, hour, minute, float(second), offset)
+        jd_et, jd_ut = swe.utc_to_jd(*utc, swe.GREG_CAL)
+        return cls(jd_ut, location, offset, jd_et=jd_et,
+                   timestamp=(year, month, day, hour, minute, second, offset))
+
+    @property
+    def timestamp(self):
+        """Local (year, month, day, hour, minute, second, utc_offset), as hd_features takes it."""
+        if self._timestamp is None:
+            year, month, day, hour, minute, second = swe.jdut1_to_utc(self.jd_ut, swe.GREG_CAL)
+            local = swe.utc_time_zone(year, month, day, hour, minute, second, -self.utc_offset)
+            self._timestamp = tuple(int(value) for value in local[:5]) + (local[5], self.utc_offset)
+        return self._timestamp
+
+    def key(self):
+        """Key of identical charts: the same moment and place, whatever the local time format."""
+        return (round(self.jd_ut, 9), self.location)
+
+    def with_location(self, location):
+        """The same moment at another (or a now known) location."""
+        return BirthInstant(self.jd_ut, location, self.utc_offset, self.jd_et, self._timestamp)
+
+    def __repr__(self):
+        return "BirthInstant(jd_ut={!r}, location={!r}, utc_offset={!r})".format(
+            self.jd_ut, self.location, self.utc_offset)
+
+
+def as_instant(birth, birthTime=None, timeOffset=None, location=None):
+    """
+    The BirthInstant of calculator arguments: an instant as it is, or the
+    API strings (birthDate, birthTime, timeOffset) and location.
+    """
+    if isinstance(birth, BirthInstant):
+        return birth
+    return BirthInstant.from_strings(birth, birthTime, timeOffset, location)
+
+
+def from_arrays(jd_ut, latitudes=None, longitudes=None, utc_offsets=None):
+    """
+    Instants of a batch given as arrays (e.g. numpy) of Julian days (UT) and
+    optional coordinates and UTC offsets.
+
+    Returns
+    -------
+    list of BirthInstant
+    """
+    n = len(jd_ut)
+    if (latitudes is None) != (longitudes is None):
+        raise InvalidBirthData("Latitudes and longitudes must be given together")
+    locations = zip(latitudes, longitudes) if latitudes is not None else [None] * n
+    offsets = utc_offsets if utc_offsets is not None else [0.0] * n
+    return [BirthInstant(jd, location, offset)
+            for jd, location, offset in zip(jd_ut, locations, offsets)]
@@ -0,0 +1,253 @@
+"""
+bodygraph.py
+
+Server-side SVG bodygraph of a Human Design chart (get_hd output).
+
+The image is assembled from SVG fragments rendered once at import: every
+center (open or defined), gate and half-channel in each activation state
+(personality, design or both), and the rows of the activation columns as
+they are first used. A render only looks up and joins fragments, no geometry
+is computed per chart.
+
+Everything drawn follows from the gates and lines of the 26 personality and
+design activations, so they are the chart's signature: renders are cached by
+signature and identical charts are rendered once.
+"""
+import threading
+from collections import OrderedDict
+
+from human_design_lib import hd_constants
+from human_design_lib.hd_features import channel_tables
+from human_design_lib.hd_index import ACTIVATION_KEYS
+from metrics import record_cache, timed
+
+WIDTH, HEIGHT = 560, 600
+# Width of the activation columns left (design) and right (personality) of the graph
+COLUMN_WIDTH = 100
+
+# Activation states of a gate (bit 0 personality, bit 1 design)
+OPEN, PERSONALITY, DESIGN, BOTH = 0, 1, 2, 3
+
+PERSONALITY_COLOR = "#1a1a1a"
+DESIGN_COLOR = "#c0392b"
+INACTIVE_COLOR = "#e3e3e3"
+OUTLINE_COLOR = "#555555"
+
+# Center outlines (graph coordinates) and fill if defined
+CENTER_SHAPES = {"HD": [(180, 20), (220, 85), (140, 85)],
+                 "AA": [(140, 100), (220, 100), (180, 165)],
+                 "TT": [(145, 185), (215, 185), (215, 260), (145, 260)],
+                 "GC": [(180, 278), (224, 322), (180, 366), (136, 322)],
+                 "HT": [(282, 328), (290, 380), (240, 368)],
+                 "SP": [(345, 390), (345, 480), (268, 435)],
+                 "SN": [(15, 390), (92, 435), (15, 480)],
+                 "SL": [(145, 405), (215, 405), (215, 480), (145, 480)],
+                 "RT": [(145, 505), (215, 505), (215, 580), (145, 580)]}
+CENTER_COLORS = {"HD": "#f4d03f", "AA": "#52be80", "TT": "#a0522d", "GC": "#f4d03f",
+                 "HT": "#e74c3c", "SP": "#a0522d", "SN": "#a0522d", "SL": "#e74c3c",
+                 "RT": "#a0522d"}
+
+# Gate positions (graph coordinates), on the side of the center their channel leaves
+GATE_POSITIONS = {
+    64: (160, 76), 61: (180, 76), 63: (200, 76),
+    47: (160, 108), 24: (180, 108), 4: (200, 108), 17: (165, 128), 11: (195, 128), 43: (180, 152),
+    62: (160, 193), 23: (180, 193), 56: (200, 193), 16: (153, 212), 20: (153, 234),
+    35: (207, 207), 12: (207, 226), 45: (207, 245), 31: (160, 252), 8: (180, 252), 33: (200, 252),
+    1: (180, 290), 7: (164, 308), 13: (196, 308), 10: (148, 322), 25: (212, 322),
+    15: (164, 336), 2: (180, 354), 46: (196, 336),
+    21: (278, 338), 51: (252, 364), 26: (265, 368), 40: (282, 366),
+    36: (335, 402), 22: (318, 412), 37: (300, 422), 6: (280, 435), 49: (335, 440),
+    55: (335, 455), 30: (335, 470),
+    48: (25, 402), 57: (42, 412), 44: (60, 422), 50: (80, 435), 18: (25, 440),
+    28: (25, 455), 32: (25, 470),
+    5: (160, 413), 14: (180, 413), 29: (200, 413), 34: (153, 435), 27: (153, 458),
+    59: (207, 445), 42: (160, 472), 3: (180, 472), 9: (200, 472),
+    53: (160, 513), 60: (180, 513), 52: (200, 513), 54: (153, 532), 38: (153, 551),
+    58: (153, 570), 19: (207, 532), 39: (207, 551), 41: (207, 570)}
+
+CHANNEL_LIST = [(int(a), int(b)) for a, b in channel_tables["channel_list"]]
+# Centers of the gates, from the channels between centers
+GATE_CENTERS = {}
+for (gate_a, gate_b), (center_a, center_b) in hd_constants.GATES_CHAKRA_DICT.items():
+    GATE_CENTERS[gate_a], GATE_CENTERS[gate_b] = center_a, center_b
+
+CHART_PLANETS = [planet for label, planet in ACTIVATION_KEYS if label == "prs"]
+PLANET_SYMBOLS = {"Sun": "☉", "Earth": "⊕", "Moon": "☽",
+                  "North_Node": "☊", "South_Node": "☋", "Mercury": "☿",
+                  "Venus": "♀", "Mars": "♂", "Jupiter": "♃", "Saturn": "♄",
+                  "Uranus": "♅", "Neptune": "♆", "Pluto": "♇"}
+
+
+def _graph_point(point):
+    return point[0] + COLUMN_WIDTH, point[1]
+
+
+def _points(points):
+    return " ".join("{},{}".format(*_graph_point(point)) for point in points)
+
+
+def _center_fragment(center, defined):
+    fill = CENTER_COLORS[center] if defined else "#ffffff"
+    return '<polygon points="{}" fill="{}" stroke="{}" stroke-width="1.5"/>'.format(
+        _points(CENTER_SHAPES[center]), fill, OUTLINE_COLOR)
+
+
+def _half_channel_fragment(gate, partner, state):
+    (x1, y1), (x2, y2) = _graph_point(GATE_POSITIONS[gate]), _graph_point(GATE_POSITIONS[partner])
+    xm, ym = (x1 + x2) / 2, (y1 + y2) / 2
+    line = '<line x1="{}" y1="{}" x2="{:g}" y2="{:g}" stroke="{{}}" stroke-width="{{}}"/>'.format(
+        x1, y1, xm, ym)
+    if state == BOTH:
+        # Design stripe on a personality line
+        return line.format(PERSONALITY_COLOR, 7) + line.format(DESIGN_COLOR, 3)
+    return line.format(PERSONALITY_COLOR if state == PERSONALITY else DESIGN_COLOR, 7)
+
+
+def _gate_fragment(gate, state):
+    x, y = _graph_point(GATE_POSITIONS[gate])
+    if state == OPEN:
+        fill, ring, text = "#ffffff", OUTLINE_COLOR, "#333333"
+    else:
+        fill = DESIGN_COLOR if state == DESIGN else PERSONALITY_COLOR
+        ring, text = (DESIGN_COLOR if state == BOTH else fill), "#ffffff"
+    return ('<circle cx="{}" cy="{}" r="7" fill="{}" stroke="{}" stroke-width="{}"/>'
+            '<text x="{}" y="{}" fill="{}">{}</text>').format(
+        x, y, fill, ring, 2 if state == BOTH else 1, x, y + 3, text, gate)
+
+
+def _build_fragments():
+    centers = {(center, defined): _center_fragment(center, defined)
+               for center in CENTER_SHAPES for defined in (False, True)}
+    gates = {(gate, state): _gate_fragment(gate, state)
+             for gate in GATE_POSITIONS for state in (OPEN, PERSONALITY, DESIGN, BOTH)}
+    # Half-channels from each gate towards the middle of its channel
+    halves = {}
+    for channel, (gate_a, gate_b) in enumerate(CHANNEL_LIST):
+        for gate, partner in ((gate_a, gate_b), (gate_b, gate_a)):
+            for state in (PERSONALITY, DESIGN, BOTH):
+                halves[(channel, gate, state)] = _half_channel_fragment(gate, partner, state)
+    # All channels inactive, the background of every chart
+    background = "".join(
+        '<line x1="{}" y1="{}" x2="{}" y2="{}" stroke="{}" stroke-width="7"/>'.format(
+            *_graph_point(GATE_POSITIONS[a]), *_graph_point(GATE_POSITIONS[b]), INACTIVE_COLOR)
+        for a, b in CHANNEL_LIST)
+    return centers, gates, halves, background
+
+
+CENTER_FRAGMENTS, GATE_FRAGMENTS, HALF_CHANNEL_FRAGMENTS, CHANNEL_BACKGROUND = _build_fragments()
+
+HEADER = ('<svg xmlns="http://www.w3.org/2000/svg" width="{w}" height="{h}" viewBox="0 0 {w} {h}" '
+          'font-family="sans-serif">'
+          '<rect width="{w}" height="{h}" fill="#ffffff"/>'
+          '<text x="{dx}" y="24" font-size="14" fill="{dc}" text-anchor="middle">Design</text>'
+          '<text x="{px}" y="24" font-size="14" fill="{pc}" text-anchor="middle">Personality</text>'
+          ).format(w=WIDTH, h=HEIGHT, dx=COLUMN_WIDTH // 2, dc=DESIGN_COLOR,
+                   px=WIDTH - COLUMN_WIDTH // 2, pc=PERSONALITY_COLOR)
+GATE_GROUP = '<g font-size="8" text-anchor="middle">'
+FOOTER = "</svg>"
+
+_ACTIVATION_ROWS = {}
+
+
+def _activation_fragment(half, row, gate, line):
+    """Row of an activation column, rendered on first use."""
+    key = (half, row, gate, line)
+    fragment = _ACTIVATION_ROWS.get(key)
+    if fragment is None:
+        x = 10 if half == "des" else WIDTH - COLUMN_WIDTH + 10
+        color = DESIGN_COLOR if half == "des" else PERSONALITY_COLOR
+        fragment = '<text x="{}" y="{}" font-size="13" fill="{}">{} {}.{}</text>'.format(
+            x, 56 + row * 24, color, PLANET_SYMBOLS[CHART_PLANETS[row]], gate, line)
+        # Concurrent renders may store the same string, that is harmless
+        _ACTIVATION_ROWS[key] = fragment
+    return fragment
+
+
+def chart_signature(planets):
+    """
+    (gate, line) of the 26 activations in the order of hd_index.ACTIVATION_KEYS.
+
+    Parameters
+    ----------
+    planets: dict
+        The "planets" of get_hd.
+    """
+    halves = {"prs": planets["personality"], "des": planets["design"]}
+    return tuple((halves[label][planet]["gate"], halves[label][planet]["line"])
+                 for label, planet in ACTIVATION_KEYS)
+
+
+def render_signature(signature):
+    """
+    SVG bodygraph of a chart signature (chart_signature).
+
+    Returns
+    -------
+    str
+    """
+    states = {}
+    parts = [HEADER]
+    for (label, _), (gate, line), row in zip(ACTIVATION_KEYS, signature,
+                                             list(range(len(CHART_PLANETS))) * 2):
+        states[gate] = states.get(gate, OPEN) | (PERSONALITY if label == "prs" else DESIGN)
+        parts.append(_activation_fragment(label, row, gate, line))
+
+    parts.append(CHANNEL_BACKGROUND)
+    defined = set()
+    for channel, (gate_a, gate_b) in enumerate(CHANNEL_LIST):
+        state_a, state_b = states.get(gate_a, OPEN), states.get(gate_b, OPEN)
+        if state_a:
+            parts.append(HALF_CHANNEL_FRAGMENTS[(channel, gate_a, state_a)])
+        if state_b:
+            parts.append(HALF_CHANNEL_FRAGMENTS[(channel, gate_b, state_b)])
+        if state_a and state_b:
+            defined.add(GATE_CENTERS[gate_a])
+            defined.add(GATE_CENTERS[gate_b])
+
+    parts.extend(CENTER_FRAGMENTS[(center, center in defined)] for center in CENTER_SHAPES)
+    parts.append(GATE_GROUP)
+    parts.extend(GATE_FRAGMENTS[(gate, states.get(gate, OPEN))] for gate in GATE_POSITIONS)
+    parts.append("</g>")
+    parts.append(FOOTER)
+    return "".join(parts)
+
+
+class BodygraphRenderer:
+    """
+    Bodygraph renders cached by chart signature (least recently used are
+    evicted first).
+
+    Parameters
+    ----------
+    max_entries: int
+        Number of rendered charts kept. 0 disables the cache.
+    """
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+
+    def render(self, hd_info):
+        """
+        SVG bodygraph of get_hd output, as UTF-8 bytes.
+        """
+        signature = chart_signature(hd_info["planets"])
+        with self._lock:
+            svg = self._cache.get(signature)
+            if svg is not None:
+                self._cache.move_to_end(signature)
+        record_cache("bodygraph", svg is not None)
+        if svg is not None:
+            return svg
+
+        with timed("bodygraph"):
+            svg = render_signature(signature).encode()
+        if self.max_entries > 0:
+            with self._lock:
+                self._cache[signature] = svg
+                if len(self._cache) > self.max_entries:
+                    self._cache.popitem(last=False)
+        return svg
+
+    def __len__(self):
+        return len(self._cache)
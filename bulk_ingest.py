@@ -0,0 +1,229 @@
+"""
+bulk_ingest.py
+
+Command line pipeline that computes charts for a CSV file of birth records.
+
+The input is read as a stream. Rows are processed in batches: the distinct
+places of a batch are geocoded once (through a persistent cache), then the
+charts are computed in a process pool. Results are written in input order
+to an NDJSON file and to columnar part files. A checkpoint is written every
+--checkpoint-rows rows, so a crashed run started again with the same
+arguments resumes after the last checkpoint. Memory is bounded by the batch
+size and the number of batches in flight.
+
+Input columns: birthDate, birthTime, birthPlace and optionally id.
+
+Example:
+    python bulk_ingest.py births.csv out_dir --workers 8
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import swisseph
+import flatlib
+
+from geocoding import GeocodeCache, geocode, normalize_place
+from human_design_lib.hd_columnar import ColumnarWriter
+
+CHECKPOINT_FILE = "checkpoint.json"
+NDJSON_FILE = "charts.ndjson"
+COLUMNAR_DIR = "columnar"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Computes charts for a CSV file of birth records.")
+
+    parser.add_argument("input", help="CSV file with the columns birthDate, birthTime, birthPlace"
+                        " and optionally id.")
+    parser.add_argument("out_dir", help="Directory for NDJSON, columnar parts and checkpoint.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Number of worker processes.")
+    parser.add_argument("--batch-size", type=int, default=500,
+                        help="Rows per batch sent to the process pool.")
+    parser.add_argument("--checkpoint-rows", type=int, default=50000,
+                        help="Rows between checkpoints (and columnar part files).")
+    parser.add_argument("--geocode-cache", default=None,
+                        help="SQLite file for geocoding results. Defaults to out_dir/geocode.sqlite.")
+    parser.add_argument("--geocode-workers", type=int, default=8,
+                        help="Concurrent geocoding requests.")
+
+    return parser.parse_args()
+
+
+def _init_worker():
+    # Connect to extra ephemeris files (for Chiron)
+    swisseph.set_ephe_path(os.path.join(flatlib.PATH_RES, "swefiles"))
+
+
+def compute_batch(rows):
+    """
+    Compute charts for a batch of located rows in a worker process.
+
+    Parameters
+    ----------
+    rows: list of tuple(dict, location or str)
+        Input row and its location, or the geocoding error message.
+
+    Returns
+    -------
+    list of dict
+        One result per row, with the key "error" if the row failed.
+    """
+    from birth import BirthInstant
+    from details import processBirthTime, local_time_offset, compute_details
+
+    results = []
+    for row, location in rows:
+        record = {"id": row.get("id")}
+        try:
+            if isinstance(location, str):
+                raise ValueError(location)
+            birthTime, timeOffset = processBirthTime(row["birthTime"], default_offset=None)
+            if timeOffset is None:
+                timeOffset, record["timezone"] = local_time_offset(row["birthDate"], birthTime,
+                                                                   location)
+            birth = BirthInstant.from_strings(row["birthDate"], birthTime, timeOffset, location)
+            record["jd_ut"] = birth.jd_ut
+            record.update(compute_details(birth))
+        except Exception as exc:
+            record["error"] = "{}: {}".format(type(exc).__name__, exc)
+        results.append(record)
+    return results
+
+
+def columnar_row(record):
+    """Flat summary of one result for the columnar output."""
+    hd_info = record.get("human_design", {})
+    planets = hd_info.get("planets", {})
+    return {"id": str(record["id"]),
+            "error": record.get("error", ""),
+            "type": hd_info.get("type", ""),
+            "authority": hd_info.get("authority", ""),
+            "profile": hd_info.get("profile", ""),
+            "definition": hd_info.get("definition", ""),
+            "cross": hd_info.get("incarnation cross", ""),
+            "personality_sun_gate": planets.get("personality", {}).get("Sun", {}).get("gate", 0),
+            "design_sun_gate": planets.get("design", {}).get("Sun", {}).get("gate", 0),
+            # Input of human_design_lib.hd_cycles, NaN if the row failed
+            "jd_ut": record.get("jd_ut", float("nan"))}
+
+
+def load_checkpoint(out_dir):
+    path = os.path.join(out_dir, CHECKPOINT_FILE)
+    if not os.path.exists(path):
+        return {"rows_done": 0, "ndjson_bytes": 0, "parts": 0}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_checkpoint(out_dir, checkpoint):
+    path = os.path.join(out_dir, CHECKPOINT_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+def read_batches(path, skip_rows, batch_size):
+    """Stream the CSV file in batches of rows, skipping rows already done."""
+    with open(path, newline="") as f:
+        reader = csv.DictReader(f)
+        for row_number, row in enumerate(reader):
+            if "id" not in row or row["id"] in (None, ""):
+                row["id"] = row_number
+            if row_number < skip_rows:
+                continue
+            yield row
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def run(args):
+    os.makedirs(args.out_dir, exist_ok=True)
+    checkpoint = load_checkpoint(args.out_dir)
+    maps_key = os.environ.get("MAPS_API_KEY")
+    cache = GeocodeCache(args.geocode_cache or os.path.join(args.out_dir, "geocode.sqlite"))
+
+    # Drop output written after the last checkpoint
+    ndjson_path = os.path.join(args.out_dir, NDJSON_FILE)
+    ndjson = open(ndjson_path, "ab")
+    ndjson.truncate(checkpoint["ndjson_bytes"])
+    ndjson.seek(checkpoint["ndjson_bytes"])
+    columnar = ColumnarWriter(os.path.join(args.out_dir, COLUMNAR_DIR),
+                              rows_per_part=args.checkpoint_rows + args.batch_size,
+                              first_part=checkpoint["parts"])
+
+    rows_done = checkpoint["rows_done"]
+    rows_since_checkpoint = 0
+    rows_this_run = 0
+    t_start = time.perf_counter()
+    batches = batched(read_batches(args.input, rows_done, args.batch_size), args.batch_size)
+
+    def locate(batch):
+        places = cache.geocode_many([row["birthPlace"] for row in batch],
+                                    lambda place: geocode(place, maps_key),
+                                    workers=args.geocode_workers)
+        located = []
+        for row in batch:
+            location = places[normalize_place(row["birthPlace"])]
+            if isinstance(location, Exception):
+                location = "Could not geocode {}: {}".format(row["birthPlace"], location)
+            located.append((row, location))
+        return located
+
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker) as pool:
+        in_flight = deque()
+        for batch in itertools.chain(batches, [None]):
+            if batch is not None:
+                in_flight.append(pool.submit(compute_batch, locate(batch)))
+                if len(in_flight) < 2 * args.workers:
+                    continue
+
+            # Write finished batches in input order
+            while in_flight and (batch is None or len(in_flight) >= 2 * args.workers):
+                results = in_flight.popleft().result()
+                for record in results:
+                    ndjson.write((json.dumps(record) + "\n").encode())
+                    columnar.append(columnar_row(record))
+                rows_done += len(results)
+                rows_since_checkpoint += len(results)
+                rows_this_run += len(results)
+
+                if rows_since_checkpoint >= args.checkpoint_rows:
+                    ndjson.flush()
+                    os.fsync(ndjson.fileno())
+                    write_checkpoint(args.out_dir, {"rows_done": rows_done,
+                                                    "ndjson_bytes": ndjson.tell(),
+                                                    "parts": columnar.flush()})
+                    rows_since_checkpoint = 0
+
+                elapsed = time.perf_counter() - t_start
+                sys.stderr.write("\rrows: {}  rows/sec: {:.1f}".format(
+                    rows_done, rows_this_run / elapsed if elapsed else 0.0))
+
+    ndjson.flush()
+    os.fsync(ndjson.fileno())
+    write_checkpoint(args.out_dir, {"rows_done": rows_done,
+                                    "ndjson_bytes": ndjson.tell(),
+                                    "parts": columnar.flush()})
+    ndjson.close()
+    cache.close()
+    sys.stderr.write("\n")
+
+
+if __name__ == "__main__":
+    run(parse_args())
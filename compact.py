@@ -0,0 +1,266 @@
+"""
+compact.py
+
+Compact, integer-coded encoding of the /generate-details response.
+
+Names (types, authorities, profiles, signs, ...) are replaced by indexes into
+a versioned code table, planets and spheres become fixed-order arrays of
+[gate, line], and everything that follows from gate and line (Gene Key
+Shadow/Gift/Siddhi and line names, the gate.line number) is dropped. The code
+table is served by the API, so clients decode with one table lookup per field.
+
+The compact structure is sent as JSON or, if the optional msgpack package is
+installed, as MessagePack.
+"""
+import json
+import re
+
+from flatlib import const
+
+from gene_keys import GENE_KEYS, GK_LINES, GK_SPHERES
+from human_design_lib import hd_constants
+from human_design_lib.hd_constants import PENDING
+from human_design_lib.hd_features import channel_tables
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# 2: Core and Brand spheres
+# 3: pending object signs (Pars Fortuna without location)
+# 4: stream groups
+CODE_TABLE_VERSION = 4
+
+COMPACT_JSON_MEDIA_TYPE = "application/vnd.hda.compact+json"
+MSGPACK_MEDIA_TYPE = "application/x-msgpack"
+
+ANGLE_NAMES = ["Ascending", "Midheaven", "Descending", "IC"]
+
+# Optional response keys copied as they are (pending fields, resolved time zone)
+PASSED_KEYS = ["pending", "timezone"]
+# Optional section keys copied as they are, under the compact key
+PASSED_SECTION_KEYS = {("human_design", "extra bodies"): "hd_extra",
+                       ("astrology", "Fixed Stars"): "stars",
+                       ("astrology", "Extra Bodies"): "astro_extra"}
+
+
+def _cross_names():
+    names = list(hd_constants.IC_NAMES.values()) + list(hd_constants.IC_JUX_NAMES.values())
+    return sorted(set(names))
+
+
+def build_code_table():
+    """
+    The code table of CODE_TABLE_VERSION. Lists are indexed by the codes of
+    the compact encoding.
+    """
+    return {
+        "version": CODE_TABLE_VERSION,
+        "types": list(hd_constants.STRATEGIES),
+        "authorities": ["Emotional - Solar Plexus", "Sacral", "Splenic",
+                        "Ego Manifested - Heart", "G Center", "Ego Projected",
+                        "Environmental", "Lunar", "unknown?"],
+        "profiles": ["{} - {}".format(profile, name)
+                     for profile, name in hd_constants.PROFILE_TYP.items()],
+        "definitions": list(hd_constants.DEFINITION_NAMES.values()),
+        "strategies": list(hd_constants.STRATEGIES.values()),
+        "themes": list(hd_constants.THEMES.values()),
+        "cross_types": ["RAC", "LAC", "JXP"],
+        "cross_names": _cross_names(),
+        "personality": ["Strategic", "Receptive"],
+        "brain": ["Active", "Passive"],
+        "environment style": ["Observed", "Observer"],
+        "view perspective": ["Focused", "Peripheral"],
+        "chakras": list(hd_constants.CHAKRA_NAMES.values()),
+        "channels": [[int(a), int(b)] for a, b in channel_tables["channel_list"]],
+        "circuits": channel_tables["circuit_names"],
+        "circuit groups": channel_tables["circuit_group_names"],
+        "awareness streams": channel_tables["stream_names"],
+        "stream groups": channel_tables["stream_group_names"],
+        "hd_planets": list(hd_constants.SWE_PLANET_DICT) + list(hd_constants.SWE_ANGLE_DICT),
+        "gene_keys": {str(gate): [keys["Shadow"], keys["Gift"], keys["Siddhi"]]
+                      for gate, keys in GENE_KEYS.items()},
+        "gk_spheres": [[name, half, planet, theme] for name, half, planet, theme in GK_SPHERES],
+        "gk_lines": {theme: [lines[line] for line in range(1, 7)]
+                     for theme, lines in GK_LINES.items()},
+        "signs": list(const.LIST_SIGNS),
+        "astro_objects": list(const.LIST_OBJECTS) + ["Lilith", "Earth"],
+        "angles": ANGLE_NAMES,
+    }
+
+
+CODE_TABLE = build_code_table()
+_INDEX = {key: {value: idx for idx, value in enumerate(values)}
+          for key, values in CODE_TABLE.items() if isinstance(values, list)
+          and values and isinstance(values[0], str)}
+
+_CROSS_RE = re.compile(r"^(\w+) - \(\((\d+), (\d+)\), \((\d+), (\d+)\)\) (.*)$")
+
+
+def _encode_cross(cross):
+    match = _CROSS_RE.match(cross)
+    typ, name = match.group(1), match.group(6)
+    return [_INDEX["cross_types"][typ], _INDEX["cross_names"][name]]
+
+
+def _decode_cross(code, planets):
+    prs, dsn = planets["personality"], planets["design"]
+    gates = ((prs["Sun"]["gate"], prs["Earth"]["gate"]),
+             (dsn["Sun"]["gate"], dsn["Earth"]["gate"]))
+    return "{} - {} {}".format(CODE_TABLE["cross_types"][code[0]], gates,
+                               CODE_TABLE["cross_names"][code[1]])
+
+
+def _encode_counts(key, counts):
+    return [[_INDEX[key][name], count] for name, count in counts.items()]
+
+
+def _decode_counts(key, pairs):
+    return {CODE_TABLE[key][code]: count for code, count in pairs}
+
+
+def _encode_activation(activation):
+    if activation["gate"] == PENDING:
+        return [0, 0]
+    return [activation["gate"], activation["line"]]
+
+
+def _decode_activation(code):
+    gate, line = code
+    if gate == 0:
+        return {"gate": PENDING, "line": PENDING}
+    return {"gate": gate, "line": line}
+
+
+def encode_compact(details):
+    """
+    Integer-coded form of a /generate-details response (see decode_compact).
+    """
+    hd = details["human_design"]
+    planets = hd["planets"]
+    planet_names = CODE_TABLE["hd_planets"]
+    compact_hd = [
+        _INDEX["types"][hd["type"]],
+        _INDEX["authorities"][hd["authority"]],
+        _encode_cross(hd["incarnation cross"]),
+        _INDEX["profiles"][hd["profile"]],
+        _INDEX["definitions"][hd["definition"]],
+        _INDEX["personality"][hd["personality"]],
+        _INDEX["brain"][hd["brain"]],
+        _INDEX["environment style"][hd["environment style"]],
+        _INDEX["view perspective"][hd["view perspective"]],
+        [[int(channel[:2]), int(channel[2:])] for channel in hd["channels"]],
+        [_INDEX["chakras"][chakra] for chakra in hd["active chakras"]],
+        _encode_counts("circuits", hd["circuits"]),
+        _encode_counts("circuit groups", hd["circuit groups"]),
+        _encode_counts("awareness streams", hd["awareness streams"]),
+        _encode_counts("stream groups", hd["stream groups"]),
+        [_encode_activation(planets["personality"][p]) for p in planet_names],
+        [_encode_activation(planets["design"][p]) for p in planet_names],
+    ]
+
+    astro = details["astrology"]
+    # A pending gate, line or house is 0, a pending sign None (see hd_constants.PENDING)
+    compact_astro = [
+        [[None if astro[obj]["sign"] == PENDING else _INDEX["signs"][astro[obj]["sign"]],
+          0 if astro[obj]["house"] == PENDING else int(astro[obj]["house"][5:])]
+         for obj in CODE_TABLE["astro_objects"]],
+        [None if astro[angle]["sign"] == PENDING else _INDEX["signs"][astro[angle]["sign"]]
+         for angle in ANGLE_NAMES],
+    ]
+
+    # Gene keys follow from the planets, only the sphere order is needed
+    compact = {"v": CODE_TABLE_VERSION, "hd": compact_hd, "astro": compact_astro}
+    compact.update({key: details[key] for key in PASSED_KEYS if key in details})
+    compact.update({short: details[section][key]
+                    for (section, key), short in PASSED_SECTION_KEYS.items()
+                    if key in details[section]})
+    return compact
+
+
+def decode_compact(compact):
+    """
+    Rebuild the full /generate-details response from its compact form.
+    """
+    if compact["v"] != CODE_TABLE_VERSION:
+        raise ValueError("Unsupported code table version {}".format(compact["v"]))
+    table = CODE_TABLE
+    (typ, auth, cross, profile, definition, personality, brain, env, view,
+     channels, chakras, circuits, circuit_groups, streams, stream_groups, prs, dsn) = compact["hd"]
+
+    planets = {"personality": {name: _decode_activation(code)
+                               for name, code in zip(table["hd_planets"], prs)},
+               "design": {name: _decode_activation(code)
+                          for name, code in zip(table["hd_planets"], dsn)}}
+    type_name = table["types"][typ]
+    hd = {"type": type_name,
+          "authority": table["authorities"][auth],
+          "incarnation cross": _decode_cross(cross, planets),
+          "profile": table["profiles"][profile],
+          "definition": table["definitions"][definition],
+          "strategy": hd_constants.STRATEGIES[type_name],
+          "themes": hd_constants.THEMES[type_name],
+          "personality": table["personality"][personality],
+          "brain": table["brain"][brain],
+          "environment style": table["environment style"][env],
+          "view perspective": table["view perspective"][view],
+          "channels": ["{:02d}{:02d}".format(a, b) for a, b in channels],
+          "active chakras": [table["chakras"][code] for code in chakras],
+          "circuits": _decode_counts("circuits", circuits),
+          "circuit groups": _decode_counts("circuit groups", circuit_groups),
+          "awareness streams": _decode_counts("awareness streams", streams),
+          "stream groups": _decode_counts("stream groups", stream_groups),
+          "planets": planets}
+
+    gene_keys = {}
+    for name, half, planet, theme in table["gk_spheres"]:
+        activation = planets[half.lower()][planet]
+        shadow, gift, siddhi = table["gene_keys"][str(activation["gate"])]
+        sphere = {"number": "{}.{}".format(activation["gate"], activation["line"]),
+                  "Shadow": shadow, "Gift": gift, "Siddhi": siddhi}
+        if theme is not None:
+            sphere["line"] = table["gk_lines"][theme][activation["line"] - 1]
+        gene_keys[name] = sphere
+
+    objects, angles = compact["astro"]
+    astro = {obj: {"sign": PENDING if sign is None else table["signs"][sign],
+                   "house": "House{}".format(house) if house else PENDING}
+             for obj, (sign, house) in zip(table["astro_objects"], objects)}
+    astro.update({angle: {"sign": PENDING if sign is None else table["signs"][sign]}
+                  for angle, sign in zip(ANGLE_NAMES, angles)})
+
+    details = {"human_design": hd, "gene_keys": gene_keys, "astrology": astro}
+    for (section, key), short in PASSED_SECTION_KEYS.items():
+        if short in compact:
+            details[section][key] = compact[short]
+    details.update({key: compact[key] for key in PASSED_KEYS if key in compact})
+    return details
+
+
+def negotiate(accept):
+    """
+    Response format for an Accept header: "msgpack", "compact" or "json".
+    MessagePack is only chosen if the msgpack package is installed.
+    """
+    accept = accept or ""
+    if MSGPACK_MEDIA_TYPE in accept and msgpack is not None:
+        return "msgpack"
+    if COMPACT_JSON_MEDIA_TYPE in accept or MSGPACK_MEDIA_TYPE in accept:
+        return "compact"
+    return "json"
+
+
+def render(details, fmt):
+    """
+    Encode a response in a negotiated compact format.
+
+    Returns
+    -------
+    tuple(bytes, str)
+        Body and media type.
+    """
+    compact = encode_compact(details)
+    if fmt == "msgpack":
+        return msgpack.packb(compact), MSGPACK_MEDIA_TYPE
+    return json.dumps(compact, separators=(",", ":")).encode(), COMPACT_JSON_MEDIA_TYPE
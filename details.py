@@ -0,0 +1,97 @@
+"""
+details.py
+
+Chart details of a birth: the Human Design, Gene Keys and astrology
+calculators combined, with the parsing of birth times and their local UTC
+offsets. Shared by the API (hda_core) and the batch pipeline (bulk_ingest),
+without the web app.
+"""
+from gene_keys import get_gk
+from astrology import get_astro
+from human_design import get_hd
+from birth import as_instant
+from metrics import timed
+import timezones
+
+
+def processBirthTime(birthTime: str, default_offset="+00:00"):
+    """
+    Identifies and separates UTC offsets from the birth time string.
+    Without an offset, default_offset is returned as the offset.
+    """
+    # Determine whether there is a UTC offset
+    if "+" in birthTime:
+        # Have positive offset
+        time, offset = birthTime.split("+")
+        offset = "+" + offset
+    elif "-" in birthTime:
+        # Have negative offset
+        time, offset = birthTime.split("-")
+        offset = "-" + offset
+    else:
+        # No offset
+        time = birthTime
+        offset = default_offset  # UTC+00 unless resolved by the caller
+        
+    return time, offset
+
+
+def compute_details(birthDate, birthTime=None, timeOffset=None, location=None, fixed_stars=False,
+                    extra_bodies=()):
+    """
+    Compute Human Design, Gene Keys and astrology information for a located birth.
+
+    The birth data is parsed once; the calculators share the BirthInstant.
+
+    Parameters
+    ----------
+    birthDate: str or birth.BirthInstant
+        Should be in the format YYYY/MM/DD, or the parsed birth instant
+        (the other arguments are then not used).
+    birthTime : str
+        Should be in the format HH:MM. Optionally HH:MM:SS.
+    timeOffset: str
+        UTC offset. Should be in the format HH:MM. Optionally HH:MM:SS.
+    location: tuple(float, float)
+        Should be in the format (latitude, longitude). None if not known: the
+        angles and houses are then "pending".
+    fixed_stars: bool
+        Add the fixed-star conjunctions to the astrology information.
+    extra_bodies: list of str
+        Optional bodies (hd_constants.EXTRA_BODY_DICT) to compute.
+    """
+    birth = as_instant(birthDate, birthTime, timeOffset, location)
+
+    # Get human design info (timed by stage inside get_hd)
+    hd_info = get_hd(birth, extra_bodies=extra_bodies)
+
+    # Get astrology info
+    with timed("astrology"):
+        a_info = get_astro(birth, fixed_stars=fixed_stars, extra_bodies=extra_bodies)
+
+    # Get gene key info
+    with timed("gene_keys"):
+        gk_info = get_gk(hd_info["planets"])
+
+    return {"human_design": hd_info,
+            "gene_keys": gk_info,
+            "astrology": a_info}
+
+
+def local_time_offset(birthDate: str, birthTime: str, location):
+    """
+    UTC offset of a local birth time at a location, from the offline time
+    zone boundaries and the historical rules of the zone (see timezones.py).
+
+    Returns
+    -------
+    tuple(str, dict)
+        The offset and the time zone information ({"zone", "offset"} and
+        "note" at clock changes). Without time zone data the time is taken
+        as UTC and says so: {"zone": None, "offset": "+00:00", "note": "assumed UTC"}.
+    """
+    with timed("timezone"):
+        zone = timezones.resolve(location, birthDate, birthTime)
+    if zone is None:
+        zone = {"zone": None, "offset": "+00:00", "note": timezones.ASSUMED_UTC}
+    return zone["offset"], zone
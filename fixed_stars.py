@@ -0,0 +1,304 @@
+"""
+fixed_stars.py
+
+Fixed-star conjunctions of chart points.
+
+The Swiss Ephemeris star catalog (sefstars.txt) is read once. For every epoch
+bucket (a year by default) the ecliptic longitudes of all catalog stars are
+computed once, at the middle of the bucket, and kept sorted: precession moves
+the stars by about 50" a year, so the positions of a bucket are good to well
+under a minute of arc over the bucket (except near the ecliptic poles,
+where longitudes move faster). The stars within orb of a chart point
+are then found with two binary searches instead of a catalog lookup per star.
+
+Star positions need the ephemeris files, which index() connects to in the
+calling thread. An index missing stars is never cached, and one missing
+most of them raises StarCatalogError instead of returning wrong results.
+
+Example:
+    stars = get_fixed_stars()
+    stars.conjunctions({"Sun": 149.8, "Moon": 12.0}, 2451545.0)
+"""
+import bisect
+import os
+import threading
+from collections import OrderedDict
+
+import flatlib
+import numpy as np
+import swisseph as swe
+
+from human_design_lib import hd_ephemeris
+
+STAR_FILE = os.path.join(flatlib.PATH_RES, "swefiles", "sefstars.txt")
+# Stars up to this visual magnitude (brighter stars have smaller magnitudes)
+DEFAULT_MAGNITUDE = 3.0
+DEFAULT_ORB = 1.0
+BUCKET_DAYS = 365.25
+# Fraction of the catalog stars that may fail before an index is refused
+MAX_FAILED_FRACTION = 0.5
+
+
+class StarCatalogError(RuntimeError):
+    """The star catalog can not be read, or most of its stars can not be computed."""
+
+
+def read_catalog(path=STAR_FILE, max_magnitude=DEFAULT_MAGNITUDE):
+    """
+    Stars of a Swiss Ephemeris star file, each once: the first, traditional
+    name of a star is kept, later lines with the same nomenclature or
+    position (to the arc minute) are alternative names or test entries.
+    Stars without a traditional name are named by their nomenclature.
+
+    Returns
+    -------
+    list of tuple(str, str, float)
+        (name, nomenclature, magnitude)
+
+    Raises
+    ------
+    StarCatalogError
+        If the file can not be read or holds no star.
+    """
+    stars = []
+    seen = set()
+    try:
+        f = open(path, encoding="latin-1")
+    except OSError as exc:
+        raise StarCatalogError("Can not read the star catalog: {}".format(exc)) from exc
+    with f:
+        for line in f:
+            if line.startswith("#") or not line.strip():
+                continue
+            fields = line.split(",")
+            try:
+                name, nomenclature, magnitude = fields[0].strip(), fields[1].strip(), float(fields[13])
+                position = tuple(int(float(field)) for field in fields[3:5] + fields[6:8])
+            except (IndexError, ValueError):
+                continue
+            if magnitude > max_magnitude or nomenclature in seen or position in seen:
+                continue
+            seen.update((nomenclature, position))
+            stars.append((name or nomenclature, nomenclature, magnitude))
+    if not stars:
+        raise StarCatalogError("No star up to magnitude {} in {}".format(max_magnitude, path))
+    return stars
+
+
+class StarIndex:
+    """
+    Longitude-sorted star positions of one epoch.
+
+    Parameters
+    ----------
+    names: list of str
+    magnitudes: list of float
+    longitudes: list of float
+        Ecliptic longitudes in degrees, in any order.
+    failed: list of str
+        Catalog stars that could not be computed.
+    """
+    def __init__(self, names, magnitudes, longitudes, failed=()):
+        self.failed = list(failed)
+        order = np.argsort(np.asarray(longitudes, dtype=float) % 360, kind="stable")
+        self.names = [names[i] for i in order]
+        self.magnitudes = [float(magnitudes[i]) for i in order]
+        self.longitudes = (np.asarray(longitudes, dtype=float) % 360)[order]
+        # One turn before and after, so windows across 0 degrees need no special case
+        self._extended = np.concatenate([self.longitudes - 360, self.longitudes,
+                                         self.longitudes + 360])
+        self._extended_list = self._extended.tolist()
+
+    @classmethod
+    def at(cls, catalog, jd_ut, flags=swe.FLG_SWIEPH):
+        """
+        Index of the catalog stars (read_catalog) at a Julian day (UT).
+        Stars that can not be computed are left out and listed in failed.
+
+        Raises
+        ------
+        StarCatalogError
+            If more than MAX_FAILED_FRACTION of the stars fail (e.g. the
+            ephemeris path is not set in this thread).
+        """
+        names, magnitudes, longitudes, failed = [], [], [], []
+        error = None
+        for name, nomenclature, magnitude in catalog:
+            try:
+                position, _, _ = swe.fixstar2_ut("," + nomenclature, jd_ut, flags)
+            except swe.Error as exc:
+                failed.append(name)
+                error = exc
+                continue
+            names.append(name)
+            magnitudes.append(magnitude)
+            longitudes.append(position[0])
+        if len(failed) > MAX_FAILED_FRACTION * len(catalog):
+            raise StarCatalogError("{} of {} stars could not be computed ({})".format(
+                len(failed), len(catalog), error))
+        return cls(names, magnitudes, longitudes, failed)
+
+    def __len__(self):
+        return len(self.names)
+
+    def find(self, longitude, orb=DEFAULT_ORB):
+        """
+        Stars within orb (degrees, below 180) of a longitude.
+
+        Returns
+        -------
+        list of tuple(int, float)
+            (star position in this index, distance in degrees), by longitude.
+        """
+        n = len(self.names)
+        longitude %= 360
+        low = bisect.bisect_left(self._extended_list, longitude - orb)
+        high = bisect.bisect_right(self._extended_list, longitude + orb)
+        return [(i % n, abs(self._extended_list[i] - longitude)) for i in range(low, high)]
+
+    def find_many(self, longitudes, orb=DEFAULT_ORB):
+        """
+        Vectorized find for many longitudes.
+
+        Returns
+        -------
+        tuple(np.array, np.array, np.array)
+            Position in longitudes, star position in this index and distance
+            of every conjunction.
+        """
+        longitudes = np.asarray(longitudes, dtype=float) % 360
+        low = np.searchsorted(self._extended, longitudes - orb, side="left")
+        high = np.searchsorted(self._extended, longitudes + orb, side="right")
+        counts = high - low
+        points = np.repeat(np.arange(len(longitudes)), counts)
+        # Consecutive positions low..high-1 of every point
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        extended = np.repeat(low, counts) + offsets
+        distances = np.abs(self._extended[extended] - longitudes[points])
+        return points, extended % len(self.names), distances
+
+
+class FixedStars:
+    """
+    Star indexes per epoch bucket, computed on first use.
+
+    Parameters
+    ----------
+    path: str
+        Swiss Ephemeris star file.
+    max_magnitude: float
+        Faintest stars included.
+    bucket_days: float
+        Length of an epoch bucket.
+    max_buckets: int
+        Indexes kept, least recently used are dropped first.
+    """
+    def __init__(self, path=STAR_FILE, max_magnitude=DEFAULT_MAGNITUDE, bucket_days=BUCKET_DAYS,
+                 max_buckets=256):
+        self.catalog = read_catalog(path, max_magnitude)
+        self.bucket_days = bucket_days
+        self.max_buckets = max_buckets
+        self._lock = threading.Lock()
+        self._indexes = OrderedDict()
+
+    def bucket(self, jd_ut):
+        return int(np.floor(jd_ut / self.bucket_days))
+
+    def index(self, bucket):
+        """
+        StarIndex of a bucket, at the middle of the bucket. Indexes missing
+        stars are returned but not cached, so a later call can complete them.
+        """
+        with self._lock:
+            index = self._indexes.get(bucket)
+            if index is not None:
+                self._indexes.move_to_end(bucket)
+                return index
+        # Library and batch callers may not have connected this thread yet
+        hd_ephemeris.init_ephemeris()
+        flags = hd_ephemeris.MODE_FLAGS[hd_ephemeris.get_policy().default]
+        index = StarIndex.at(self.catalog, (bucket + 0.5) * self.bucket_days, flags)
+        if index.failed:
+            return index
+        with self._lock:
+            self._indexes[bucket] = index
+            if len(self._indexes) > self.max_buckets:
+                self._indexes.popitem(last=False)
+        return index
+
+    def conjunctions(self, points, jd_ut, orb=DEFAULT_ORB):
+        """
+        Fixed stars within orb of chart points.
+
+        Parameters
+        ----------
+        points: dict
+            Point name -> ecliptic longitude (degrees).
+        jd_ut: float
+            Julian day (UT) of the chart.
+        orb: float
+            Maximum distance in longitude, degrees.
+
+        Returns
+        -------
+        list of dict
+            {"object", "star", "orb", "magnitude"} per conjunction, in the
+            order of points and by distance.
+        """
+        index = self.index(self.bucket(jd_ut))
+        found = []
+        for name, longitude in points.items():
+            for star, distance in sorted(index.find(longitude, orb), key=lambda match: match[1]):
+                found.append({"object": name,
+                              "star": index.names[star],
+                              "orb": round(distance, 3),
+                              "magnitude": index.magnitudes[star]})
+        return found
+
+    def conjunctions_batch(self, jd_ut, longitudes, orb=DEFAULT_ORB):
+        """
+        Conjunctions of a batch of charts, vectorized per epoch bucket.
+
+        Parameters
+        ----------
+        jd_ut: array (n,)
+            Julian days (UT) of the charts.
+        longitudes: array (n, k)
+            Longitudes of k points per chart.
+
+        Returns
+        -------
+        tuple(np.array, np.array, list of str, np.array)
+            Chart row, point column, star name and distance of every
+            conjunction, grouped by bucket.
+        """
+        jd_ut = np.asarray(jd_ut, dtype=float)
+        longitudes = np.asarray(longitudes, dtype=float)
+        k = longitudes.shape[1]
+        buckets = np.floor(jd_ut / self.bucket_days).astype(np.int64)
+        rows, columns, names, distances = [], [], [], []
+        for bucket in np.unique(buckets).tolist():
+            chart_rows = np.flatnonzero(buckets == bucket)
+            index = self.index(bucket)
+            points, stars, bucket_distances = index.find_many(longitudes[chart_rows].ravel(), orb)
+            rows.append(chart_rows[points // k])
+            columns.append(points % k)
+            names.extend(index.names[star] for star in stars.tolist())
+            distances.append(bucket_distances)
+        if not rows:
+            return (np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp), [], np.zeros(0))
+        return np.concatenate(rows), np.concatenate(columns), names, np.concatenate(distances)
+
+
+_fixed_stars = None
+_fixed_stars_lock = threading.Lock()
+
+
+def get_fixed_stars():
+    """The FixedStars of the process, the catalog is read on first use."""
+    global _fixed_stars
+    if _fixed_stars is None:
+        with _fixed_stars_lock:
+            if _fixed_stars is None:
+                _fixed_stars = FixedStars()
+    return _fixed_stars
@@ -1,8 +1,17 @@
 """
 gene_keys.py
 
-List of each gate's associated gene key.
+List of each gate's associated gene key, and the Gene Keys profile.
+
+Every (sphere, gate, line) record of the profile is built once at import
+into GK_RECORDS, addressed by an integer sphere code. get_gk returns these
+shared, read-only records instead of building dicts per call, and gk_codes
+maps whole batches of activations (the n x 26 gate and line matrices in the
+order of hd_index.ACTIVATION_KEYS) to sphere codes with one numpy operation.
 """
+import numpy as np
+
+from human_design_lib.hd_index import ACTIVATION_KEYS
 
 GENE_KEYS = {
     1: {'Shadow': 'Entropy', 'Gift': 'Freshness', 'Siddhi': 'Beauty'},
@@ -159,6 +168,80 @@ def gateline(planet):
     return f"{gate}.{line}"
 
 
+# Spheres in output order: (name, half, planet, line theme in GK_LINES or None)
+GK_SPHERES = [("Life's Work", "Personality", "Sun", "lifework"),
+              ("Evolution", "Personality", "Earth", "evolution"),
+              ("Pearl", "Personality", "Jupiter", "pearl"),
+              ("Culture", "Design", "Jupiter", "culture"),
+              ("Vocation", "Design", "Mars", "vocation"),
+              ("SQ", "Design", "Venus", "sq"),
+              ("Radiance", "Design", "Sun", "radiance"),
+              ("Purpose", "Design", "Earth", "purpose"),
+              ("Attraction", "Design", "Moon", "attraction"),
+              ("IQ", "Personality", "Venus", "iq"),
+              ("EQ", "Personality", "Mars", "eq"),
+              ("Relating", "Personality", "Mercury", None),
+              ("Stability", "Personality", "Saturn", None),
+              ("Creativity", "Design", "Uranus", None),
+              ("Core", "Design", "Mars", None),
+              ("Brand", "Personality", "Sun", None)]
+
+# The Golden Path sequences, in reading order
+GK_SEQUENCES = {"Activation": ["Life's Work", "Evolution", "Radiance", "Purpose"],
+                "Venus": ["Attraction", "IQ", "EQ", "SQ", "Core"],
+                "Pearl": ["Vocation", "Culture", "Brand", "Pearl"]}
+
+SPHERE_INDEX = {sphere[0]: idx for idx, sphere in enumerate(GK_SPHERES)}
+
+# Column of each sphere's activation in the n x 26 activation matrices
+SPHERE_COLUMNS = np.array([ACTIVATION_KEYS.index(("prs" if half == "Personality" else "des", planet))
+                           for _, half, planet, _ in GK_SPHERES], dtype=np.intp)
+
+
+class GeneKeyRecord(dict):
+    """
+    Read-only sphere record ({"number", "Shadow", "Gift", "Siddhi"} and
+    "line" if the sphere has a line theme). Records are shared between all
+    profiles, so they can not be modified.
+    """
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("Gene Keys records are read-only")
+
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        return (GeneKeyRecord, (dict(self),))
+
+
+def sphere_code(sphere, gate, line):
+    """
+    Code of the record of a sphere (index in GK_SPHERES) with a gate and line
+    in GK_RECORDS.
+    """
+    return (sphere * 64 + gate - 1) * 6 + line - 1
+
+
+def _build_records():
+    records = []
+    for _, _, _, theme in GK_SPHERES:
+        for gate in range(1, 65):
+            keys = GENE_KEYS[gate]
+            for line in range(1, 7):
+                record = {"number": f"{gate}.{line}", **keys}
+                if theme is not None:
+                    record["line"] = GK_LINES[theme][line]
+                records.append(GeneKeyRecord(record))
+    return tuple(records)
+
+
+GK_RECORDS = _build_records()
+
+# (name, half key in the HD planets, planet, code of gate 1 line 1) per sphere
+_SPHERE_LOOKUP = [(name, half.lower(), planet, sphere_code(idx, 1, 1))
+                  for idx, (name, half, planet, _) in enumerate(GK_SPHERES)]
+
+
 def get_gk(planet_gates):
     """
     Create gene keys from Human Design planets with their gates and lines.
@@ -167,78 +250,58 @@ def get_gk(planet_gates):
     ----------
     planet_gates: dict
         The planets with their associated gates and lines.
+
+    Returns
+    -------
+    dict
+        Sphere name -> GeneKeyRecord, in the order of GK_SPHERES. The records
+        are shared and read-only.
+    """
+    profile = {}
+    for name, half, planet, base in _SPHERE_LOOKUP:
+        activation = planet_gates[half][planet]
+        profile[name] = GK_RECORDS[base + (activation["gate"] - 1) * 6 + activation["line"] - 1]
+    return profile
+
+
+def get_sequences(profile):
+    """
+    The Golden Path of a profile (get_gk) grouped by sequence.
+
+    Returns
+    -------
+    dict
+        Sequence name -> {sphere name: record}, see GK_SEQUENCES.
+    """
+    return {sequence: {name: profile[name] for name in names}
+            for sequence, names in GK_SEQUENCES.items()}
+
+
+def gk_codes(gates, lines):
+    """
+    Sphere codes of a batch of charts.
+
+    Parameters
+    ----------
+    gates: array (n, 26)
+        Gates of the personality and design activations in the order of
+        hd_index.ACTIVATION_KEYS (the activations of a ChartIndex).
+    lines: array (n, 26)
+        Lines of the same activations.
+
+    Returns
+    -------
+    np.array
+        int32 (n, len(GK_SPHERES)), codes into GK_RECORDS.
+    """
+    gates = np.asarray(gates)[:, SPHERE_COLUMNS].astype(np.int32)
+    lines = np.asarray(lines)[:, SPHERE_COLUMNS].astype(np.int32)
+    spheres = np.arange(len(GK_SPHERES), dtype=np.int32)
+    return (spheres * 64 + gates - 1) * 6 + lines - 1
+
+
+def profile_of_codes(codes):
+    """
+    Profile (as get_gk returns it) of one row of gk_codes.
     """
-    prs = planet_gates["personality"]
-    dsn = planet_gates["design"]
-
-    # Life's Work - Personality Sun
-    lifework = {"number": gateline(prs["Sun"]),
-                **GENE_KEYS[prs["Sun"]["gate"]],
-                "line": GK_LINES["lifework"][prs["Sun"]["line"]]}
-    # Evolution - Personality Earth
-    evolution = {"number": gateline(prs["Earth"]),
-                 **GENE_KEYS[prs["Earth"]["gate"]],
-                 "line": GK_LINES["evolution"][prs["Earth"]["line"]]}
-    # Pearl - Personality Jupiter
-    pearl = {"number": gateline(prs["Jupiter"]),
-             **GENE_KEYS[prs["Jupiter"]["gate"]],
-             "line": GK_LINES["pearl"][prs["Jupiter"]["line"]]}
-    # Culture - Design Jupiter
-    culture = {"number": gateline(dsn["Jupiter"]),
-               **GENE_KEYS[dsn["Jupiter"]["gate"]],
-               "line": GK_LINES["culture"][dsn["Jupiter"]["line"]]}
-    # Vocation - Design Mars
-    vocation = {"number": gateline(dsn["Mars"]),
-                **GENE_KEYS[dsn["Mars"]["gate"]],
-                "line": GK_LINES["vocation"][dsn["Mars"]["line"]]}
-    # SQ - Design Venus
-    sq = {"number": gateline(dsn["Venus"]),
-          **GENE_KEYS[dsn["Venus"]["gate"]],
-          "line": GK_LINES["sq"][dsn["Venus"]["line"]]}
-    # Radiance - Design Sun
-    radiance = {"number": gateline(dsn["Sun"]),
-                **GENE_KEYS[dsn["Sun"]["gate"]],
-                "line": GK_LINES["radiance"][dsn["Sun"]["line"]]}
-    # Purpose - Design Earth
-    purpose = {"number": gateline(dsn["Earth"]),
-               **GENE_KEYS[dsn["Earth"]["gate"]],
-               "line": GK_LINES["purpose"][dsn["Earth"]["line"]]}
-    # Attraction - Design Moon
-    attraction = {"number": gateline(dsn["Moon"]),
-                  **GENE_KEYS[dsn["Moon"]["gate"]],
-                  "line": GK_LINES["attraction"][dsn["Moon"]["line"]]}
-    # IQ - Personality Venus
-    iq = {"number": gateline(prs["Venus"]),
-          **GENE_KEYS[prs["Venus"]["gate"]],
-          "line": GK_LINES["iq"][prs["Venus"]["line"]]}
-    # EQ - Personality Mars
-    eq = {"number": gateline(prs["Mars"]),
-          **GENE_KEYS[prs["Mars"]["gate"]],
-          "line": GK_LINES["eq"][prs["Mars"]["line"]]}
-    # Relating - Personality Mercury
-    relating = {"number": gateline(prs["Mercury"]),
-                **GENE_KEYS[prs["Mercury"]["gate"]]}
-    #relating["line"] = GK_LINES[prs["Sun"]["line"]]
-    # Stability - Personality Saturn
-    stability = {"number": gateline(prs["Saturn"]),
-                 **GENE_KEYS[prs["Saturn"]["gate"]]}
-    #stability["line"] = GK_LINES[prs["Sun"]["line"]]
-    # Creativity - Design Uranus
-    creativity = {"number": gateline(dsn["Uranus"]),
-                  **GENE_KEYS[dsn["Uranus"]["gate"]]}
-    #creativity["line"] = GK_LINES[prs["Sun"]["line"]]
-
-    return {"Life's Work": lifework,
-            "Evolution": evolution,
-            "Pearl": pearl,
-            "Culture": culture,
-            "Vocation": vocation,
-            "SQ": sq,
-            "Radiance": radiance,
-            "Purpose": purpose,
-            "Attraction": attraction,
-            "IQ": iq,
-            "EQ": eq,
-            "Relating": relating,
-            "Stability": stability,
-            "Creativity": creativity}
+    return {name: GK_RECORDS[code] for (name, _, _, _), code in zip(GK_SPHERES, codes.tolist())}
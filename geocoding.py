@@ -0,0 +1,186 @@
+"""
+geocoding.py
+
+Geocoding of birth places through Google Maps, with a persistent cache for
+batch use and a bounded in-process cache for the server.
+"""
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+def normalize_place(place: str):
+    """
+    Normalize a place string so trivially different spellings share a cache entry.
+    """
+    return " ".join(place.split()).casefold()
+
+
+def geocode(place: str, maps_key=None, client=None, base_url=None, timeout=None):
+    """
+    Find the location of a place.
+
+    Parameters
+    ----------
+    place: str
+        Should be in the format City, State, Country.
+    maps_key: str
+        Google Maps API key, used if no client is given.
+    client: googlemaps.Client
+        Optional client to reuse between calls.
+    base_url: str
+        Optional base URL of the geocoding service, e.g. a local stub.
+    timeout: float
+        Optional limit in seconds of the call including the client's retries,
+        used if no client is given.
+
+    Returns
+    -------
+    tuple(float, float)
+        The location in the format (latitude, longitude).
+    """
+    if client is None:
+        # Imported on first use, it is slow to import and not needed on cache hits
+        import googlemaps
+
+        options = {}
+        if base_url:
+            options["base_url"] = base_url
+        if timeout is not None:
+            # googlemaps retries server errors for up to retry_timeout (60 s by default)
+            options.update(timeout=timeout, retry_timeout=timeout)
+        client = googlemaps.Client(key=maps_key, **options)
+    geocode_result = client.geocode(place)
+    if not geocode_result:
+        raise ValueError("Could not geocode place: {}".format(place))
+    location = geocode_result[0]["geometry"]["location"]
+    return (location["lat"], location["lng"])
+
+
+class PlaceCache:
+    """
+    In-process place -> location cache of the server, least recently used
+    places are evicted first.
+
+    Parameters
+    ----------
+    max_entries: int
+        Number of places kept. 0 disables the cache.
+    ttl_seconds: float or None
+        Age after which a place is geocoded again. None for no expiry.
+    clock: callable
+        Monotonic time, time.monotonic by default.
+    """
+    def __init__(self, max_entries=100000, ttl_seconds=None, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, place: str):
+        """Cached location of a place, or None (also if expired)."""
+        key = normalize_place(place)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            location, stored = entry
+            if self.ttl_seconds is not None and self.clock() - stored > self.ttl_seconds:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+        return location
+
+    def put(self, place: str, location):
+        if self.max_entries <= 0:
+            return
+        key = normalize_place(place)
+        with self._lock:
+            self._entries[key] = (tuple(location), self.clock())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class GeocodeCache:
+    """
+    Persistent place -> location cache backed by SQLite.
+
+    Parameters
+    ----------
+    path: str
+        SQLite database file. ":memory:" keeps the cache in memory only.
+    """
+    def __init__(self, path=":memory:"):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS places "
+                         "(place TEXT PRIMARY KEY, lat REAL, lng REAL)")
+        self._db.commit()
+
+    def get(self, place: str):
+        """Cached location of a place, or None."""
+        with self._lock:
+            row = self._db.execute("SELECT lat, lng FROM places WHERE place = ?",
+                                   (normalize_place(place),)).fetchone()
+        return row
+
+    def put(self, place: str, location):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO places VALUES (?, ?, ?)",
+                             (normalize_place(place), location[0], location[1]))
+            self._db.commit()
+
+    def geocode_many(self, places, geocoder, workers=8):
+        """
+        Geocode a batch of places, each distinct place at most once.
+
+        Parameters
+        ----------
+        places: iterable of str
+            Places, duplicates allowed.
+        geocoder: callable
+            Function place -> (latitude, longitude), called for cache misses only.
+        workers: int
+            Number of concurrent geocoder calls.
+
+        Returns
+        -------
+        dict
+            Normalized place -> location, or the exception raised for that place.
+        """
+        results = {}
+        missing = {}
+        for place in places:
+            key = normalize_place(place)
+            if key in results or key in missing:
+                continue
+            location = self.get(place)
+            if location is None:
+                missing[key] = place
+            else:
+                results[key] = tuple(location)
+
+        def lookup(place):
+            try:
+                location = geocoder(place)
+            except Exception as exc:
+                return exc
+            self.put(place, location)
+            return location
+
+        if missing:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for key, location in zip(missing, pool.map(lookup, missing.values())):
+                    results[key] = location
+        return results
+
+    def close(self):
+        with self._lock:
+            self._db.close()
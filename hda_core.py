@@ -3,18 +3,34 @@ hda_core.py
 
 API for Astrology and Human Design information.
 """
+import time
+_import_start = time.perf_counter()
+
 import os
+from concurrent.futures import ThreadPoolExecutor
+
+from typing import Annotated, Literal
 
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Header, Request, Response, WebSocket
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
-import swisseph
-import flatlib
 from contextlib import asynccontextmanager
-import googlemaps
 
-from gene_keys import get_gk
-from astrology import get_astro
-from human_design import get_hd
+from birth import BirthInstant, InvalidBirthData
+from details import processBirthTime, local_time_offset, compute_details
+from geocoding import geocode, normalize_place, PlaceCache
+from jobs import JobStore, JobManager
+from streaming import ndjson_response, iter_safe
+import compact
+import metrics
+from metrics import timed
+from human_design_lib import hd_transits
+from human_design_lib.hd_constants import EXTRA_BODY_DICT
+import startup
+from singleflight import SingleFlight
+from resilience import CircuitBreaker, HedgedCaller, Overloaded, Unavailable
+from sky import SkyService
+from bodygraph import BodygraphRenderer
 
 
 class BirthDataModel(BaseModel):
@@ -28,35 +44,34 @@ class BirthDataModel(BaseModel):
     birthTime : str
         Should be in the format HH:MM. Optionally may include seconds as HH:MM:SS.
         Potentially may include UTC offset as format HH:MM+HH:MM,
-        HH:MM:SS+HH:MM:SS, HH:MM-HH:MM, HH:MM:SS-HH:MM:SS.
+        HH:MM:SS+HH:MM:SS, HH:MM-HH:MM, HH:MM:SS-HH:MM:SS. Without an offset it
+        is the local time at the place of birth, see local_time_offset.
     birthPlace : str
         Should be in the format City, State, Country. State can be omitted. If
         country is omitted, it will be assumed as the United States of America.
+    fixedStars : bool
+        Add the fixed stars conjunct the astrology points (see fixed_stars.py).
+    extraBodies : list[str]
+        Optional bodies (Ceres, Pallas, Juno, Vesta, Pholus) to add to the
+        Human Design and astrology information.
     """
     birthDate: str
     birthTime: str
     birthPlace: str
+    fixedStars: bool = False
+    extraBodies: list[Literal[tuple(EXTRA_BODY_DICT)]] = []
 
 
-def processBirthTime(birthTime: str):
+class BatchModel(BaseModel):
     """
-    Identifies and separates UTC offsets from the birth time string.
+    A batch of births computed as a background job.
+
+    Parameters
+    ----------
+    births : list[BirthDataModel]
+        The births to compute. Results are returned in the same order.
     """
-    # Determine whether there is a UTC offset
-    if "+" in birthTime:
-        # Have positive offset
-        time, offset = birthTime.split("+")
-        offset = "+" + offset
-    elif "-" in birthTime:
-        # Have negative offset
-        time, offset = birthTime.split("-")
-        offset = "-" + offset
-    else:
-        # No offset
-        time = birthTime
-        offset = "+00:00"  # Use UTC+00 as offset
-        
-    return time, offset
+    births: list[BirthDataModel]
 
 
 @asynccontextmanager
@@ -65,46 +80,373 @@ async def lifespan(app: FastAPI):
     Handles any startup and shutdown processes.
     """
     # Start up processes
-    global maps_key
+    # Ephemeris, warm-up and heap freeze once per worker, before the first request
+    startup.init_worker()
+
+    global maps_key, maps_base_url, job_manager, sky_service
     maps_key = os.environ.get("MAPS_API_KEY")
+    maps_base_url = os.environ.get("MAPS_BASE_URL")
+    job_manager = JobManager(JobStore(os.environ.get("HDA_JOB_DIR", "jobs")),
+                             job_details,
+                             executor=ThreadPoolExecutor(
+                                 int(os.environ.get("HDA_JOB_THREADS", "4"))),
+                             workers=int(os.environ.get("HDA_JOB_WORKERS", "2")),
+                             lease_seconds=float(os.environ.get("HDA_JOB_LEASE_SECONDS", "120")))
+    await job_manager.start()
+    sky_service = SkyService(float(os.environ.get("HDA_SKY_BUCKET_SECONDS", "60")),
+                             thread_init=startup.init_ephemeris)
+    await sky_service.start()
     yield
     # Shutdown processes
+    await sky_service.stop()
+    await job_manager.stop()
+    job_manager.executor.shutdown(wait=False, cancel_futures=True)
+    geocoder.shutdown()
 
 
 # The API key for Google Maps
 maps_key = None
 
+# Optional base URL of the geocoding service (e.g. a local stub for load tests)
+maps_base_url = None
+
+# Background batch jobs, created at startup
+job_manager = None
+
+# Current sky shared by all clients, created at startup
+sky_service = None
+
+# Geocoding results of this process, bounded in size and age (0: no expiry)
+GEOCODE_CACHE_TTL = float(os.environ.get("HDA_GEOCODE_CACHE_TTL", str(30 * 86400)))
+geocode_cache = PlaceCache(int(os.environ.get("HDA_GEOCODE_CACHE_SIZE", "100000")),
+                           GEOCODE_CACHE_TTL or None)
+
+# Identical concurrent geocoding and chart calculations share one computation
+COALESCE_TIMEOUT = float(os.environ.get("HDA_COALESCE_TIMEOUT", "30"))
+geocode_flights = SingleFlight("geocode", timeout=COALESCE_TIMEOUT)
+chart_flights = SingleFlight("chart", timeout=COALESCE_TIMEOUT)
+
+# Geocoding waits at most GEOCODE_DEADLINE seconds per request, on its own
+# pool, with a hedged second attempt and a circuit breaker (see resilience.py).
+# Without a location the response is degraded: houses and angles are pending.
+GEOCODE_DEADLINE = float(os.environ.get("HDA_GEOCODE_DEADLINE", "3"))
+geocoder = HedgedCaller("geocode",
+                        max_workers=int(os.environ.get("HDA_GEOCODE_THREADS", "8")),
+                        hedge_after=float(os.environ.get("HDA_GEOCODE_HEDGE_AFTER", "1")),
+                        is_retryable=lambda exc: not isinstance(exc, ValueError))
+geocode_breaker = CircuitBreaker("geocode",
+                                 failure_threshold=int(os.environ.get("HDA_GEOCODE_BREAKER_FAILURES", "5")),
+                                 reset_seconds=float(os.environ.get("HDA_GEOCODE_BREAKER_RESET", "30")))
+PENDING_FIELDS = ["human_design.angles", "astrology.houses", "astrology.angles",
+                  "astrology.pars_fortuna"]
+
+# Rendered bodygraphs by chart signature (see bodygraph.py)
+bodygraph_renderer = BodygraphRenderer(int(os.environ.get("HDA_BODYGRAPH_CACHE", "4096")))
+
 # The application to define behaviors for
 app = FastAPI(lifespan=lifespan)
 
 
-@app.post("/generate-details")
-def generate_details(data: BirthDataModel):
-    # Connect to extra ephemeris files (for Chiron)
-    swisseph.set_ephe_path(os.path.join(flatlib.PATH_RES, "swefiles"))
+def geocode_failed(exc):
+    """Whether a geocoder exception counts against the provider in the circuit breaker."""
+    # Unknown places are answers, a full pool is our own limit (see geocode_ignored)
+    return not isinstance(exc, (ValueError, Overloaded))
+
+
+def geocode_ignored(exc):
+    """Whether a geocoder exception says nothing about the provider (it was not asked)."""
+    return isinstance(exc, Overloaded)
+
+
+def geocode_attempt(place: str):
+    # Every attempt is bounded by the deadline, so abandoned attempts do not pile up
+    return geocode(place, maps_key, base_url=maps_base_url, timeout=GEOCODE_DEADLINE)
+
+
+def geocode_with_deadline(place: str):
+    try:
+        return geocoder.call(geocode_attempt, place, timeout=GEOCODE_DEADLINE)
+    except Unavailable:
+        raise
+    except Exception as exc:
+        if not geocode_failed(exc):
+            raise
+        # Provider errors (connection, server errors) degrade like timeouts
+        raise Unavailable("geocoding failed: {}: {}".format(type(exc).__name__, exc)) from exc
+
+
+def geocode_and_cache(place: str):
+    location = geocode_breaker.call(geocode_with_deadline, place, is_failure=geocode_failed,
+                                    is_ignored=geocode_ignored)
+    geocode_cache.put(place, location)
+    return location
+
+
+def locate(place: str):
+    """
+    Location of a place, through the in-process geocoding cache. Concurrent
+    misses of the same place share one geocoder call.
+
+    Raises
+    ------
+    resilience.Unavailable or TimeoutError
+        If the geocoder does not answer within GEOCODE_DEADLINE seconds or
+        its circuit breaker is open.
+    """
+    with timed("geocode"):
+        location = geocode_cache.get(place)
+        metrics.record_cache("geocode", location is not None)
+        if location is None:
+            location = geocode_flights.do(normalize_place(place), geocode_and_cache, place,
+                                          timeout=GEOCODE_DEADLINE)
+    return tuple(location)
+
+
+@app.middleware("http")
+async def instrument(request: Request, call_next):
+    """
+    Count in-flight requests, time them and add the Server-Timing header.
+    """
+    timings = metrics.start_request()
+    metrics.REQUESTS_IN_FLIGHT.inc()
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        metrics.REQUESTS_IN_FLIGHT.dec()
+    total = time.perf_counter() - start
+    # Label by route template (e.g. /jobs/{job_id}) to keep the series count bounded
+    route = request.scope.get("route")
+    metrics.REQUEST_SECONDS.observe(total, path=route.path if route else "unmatched")
+    response.headers["Server-Timing"] = metrics.server_timing_header(timings, total)
+    return response
+
+
+@app.get("/metrics")
+def metrics_endpoint():
+    """
+    Prometheus metrics: stage and request latency histograms, cache hit
+    and miss counts and in-flight requests.
+    """
+    return PlainTextResponse(metrics.render_metrics(),
+                             media_type="text/plain; version=0.0.4")
+
+
+def calc_details(data: BirthDataModel, degrade=True):
+    """
+    Geocode and compute all information for one birth.
+
+    If geocoding is unavailable and degrade is set, the location-independent
+    information is returned right away, with the angles and houses "pending"
+    and the pending fields listed under "pending". A birth time without UTC
+    offset is local time at the place of birth, its resolved time zone is
+    returned under "timezone".
+    """
+    # Connect to extra ephemeris files (for Chiron), once per thread
+    startup.init_ephemeris()
 
     # Split UTC offset from birth time, if applicable
-    birthTime, timeOffset = processBirthTime(data.birthTime)
+    birthTime, timeOffset = processBirthTime(data.birthTime, default_offset=None)
 
     # Geolocate place of birth
-    gmaps = googlemaps.Client(key=maps_key)
-    geocode_result = gmaps.geocode(data.birthPlace)
-    location = (geocode_result[0]["geometry"]["location"]["lat"],
-                geocode_result[0]["geometry"]["location"]["lng"])
+    try:
+        location = locate(data.birthPlace)
+    except (Unavailable, TimeoutError) as exc:
+        # Local time without offset can not be placed in time without the location
+        if not degrade or timeOffset is None:
+            raise
+        metrics.DEGRADED_RESPONSES.inc(reason=type(exc).__name__)
+        location = None
     # location = (30.5254, -97.666)  # Dummy location for testing
-    
-    # Get human design info
-    hd_info = get_hd(data.birthDate, birthTime, timeOffset, location)
-    
-    # Get astrology info
-    a_info = get_astro(data.birthDate,
-                       birthTime,
-                       timeOffset,
-                       location)
-    
-    # Get gene key info
-    gk_info = get_gk(hd_info["planets"])
-    
-    return {"human_design": hd_info,
-            "gene_keys": gk_info,
-            "astrology": a_info}
+
+    zone = None
+    if timeOffset is None:
+        timeOffset, zone = local_time_offset(data.birthDate, birthTime, location)
+
+    # Parsed once; the same moment and place is the same chart whatever its notation
+    birth = BirthInstant.from_strings(data.birthDate, birthTime, timeOffset, location)
+
+    # Concurrent requests for the same chart share one calculation
+    extra_bodies = tuple(dict.fromkeys(data.extraBodies))
+    details = chart_flights.do(birth.key() + (data.fixedStars, extra_bodies), compute_details,
+                               birth, None, None, None, data.fixedStars, extra_bodies)
+    if location is None:
+        # The shared result is not modified
+        pending = PENDING_FIELDS + ["astrology.fixed_stars"] if data.fixedStars else PENDING_FIELDS
+        details = {**details, "pending": pending}
+    if zone is not None:
+        details = {**details, "timezone": zone}
+    return details
+
+
+def job_details(item: dict):
+    """
+    Compute one stored job item (a BirthDataModel as dict). Jobs are not
+    latency-bound and store no partial results: an unavailable geocoder
+    fails the item.
+    """
+    return calc_details(BirthDataModel(**item), degrade=False)
+
+
+def calc_details_or_http_error(data: BirthDataModel):
+    """calc_details with its errors mapped to HTTP errors."""
+    try:
+        return calc_details(data)
+    except InvalidBirthData as exc:
+        raise HTTPException(status_code=422, detail=str(exc))
+    except TimeoutError as exc:
+        raise HTTPException(status_code=504, detail=str(exc))
+    except Unavailable as exc:
+        raise HTTPException(status_code=503, detail=str(exc))
+
+
+@app.post("/generate-details")
+def generate_details(data: BirthDataModel, accept: Annotated[str | None, Header()] = None):
+    details = calc_details_or_http_error(data)
+
+    # Content negotiation for high-volume clients (see compact.py)
+    fmt = compact.negotiate(accept)
+    if fmt != "json":
+        body, media_type = compact.render(details, fmt)
+        return Response(content=body, media_type=media_type,
+                        headers={"X-Code-Table-Version": str(compact.CODE_TABLE_VERSION)})
+    return details
+
+
+@app.post("/bodygraph")
+def bodygraph(data: BirthDataModel):
+    """
+    SVG bodygraph of a birth: defined centers, channels, gates and the
+    personality and design activations. Identical charts are rendered once.
+    """
+    details = calc_details_or_http_error(data)
+    svg = bodygraph_renderer.render(details["human_design"])
+    return Response(content=svg, media_type="image/svg+xml")
+
+
+@app.get("/codes")
+def code_table():
+    """
+    Code table for decoding compact responses, versioned by "version".
+    """
+    return compact.CODE_TABLE
+
+
+@app.post("/generate-details/stream")
+def generate_details_stream(batch: BatchModel):
+    """
+    Details for a batch of births, streamed as one JSON line per birth.
+    """
+    return ndjson_response(iter_safe(calc_details, batch.births))
+
+
+def _parse_range(start: str, end: str):
+    try:
+        return hd_transits.date_to_juldate(start), hd_transits.date_to_juldate(end)
+    except ValueError:
+        raise HTTPException(status_code=422,
+                            detail="start and end should be in the format YYYY/MM/DD or YYYY/MM/DD HH:MM")
+
+
+def _parse_planets(planets: str):
+    names = planets.split(",") if planets else hd_transits.PLANETS
+    unknown = [name for name in names if name not in hd_transits.PLANETS]
+    if unknown:
+        raise HTTPException(status_code=422, detail="Unknown planets: {}".format(unknown))
+    return names
+
+
+@app.get("/transits/stream")
+def transits_stream(start: str, end: str, step_hours: float = 24.0, planets: str = ""):
+    """
+    Transit gates from start to end (UT), streamed as one JSON line per step.
+    """
+    if step_hours <= 0:
+        raise HTTPException(status_code=422, detail="step_hours must be positive")
+    jd_start, jd_end = _parse_range(start, end)
+    return ndjson_response(hd_transits.iter_transits(jd_start, jd_end, step_hours,
+                                                     _parse_planets(planets)),
+                           thread_init=startup.init_ephemeris)
+
+
+@app.get("/ingresses/stream")
+def ingresses_stream(start: str, end: str, planets: str = ""):
+    """
+    Gate ingress calendar from start to end (UT), streamed as one JSON line per event.
+    """
+    jd_start, jd_end = _parse_range(start, end)
+    return ndjson_response(hd_transits.iter_gate_ingresses(jd_start, jd_end,
+                                                           _parse_planets(planets)),
+                           thread_init=startup.init_ephemeris)
+
+
+@app.get("/sky")
+def current_sky(if_none_match: Annotated[str | None, Header()] = None):
+    """
+    Transit gates of the current time bucket (HDA_SKY_BUCKET_SECONDS),
+    cacheable until the bucket ends.
+    """
+    sky, text = sky_service.current()
+    etag = '"{}"'.format(sky["time"])
+    headers = {"ETag": etag,
+               "Cache-Control": "public, max-age={}".format(max(0, int(sky_service.seconds_left())))}
+    if if_none_match == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=text, media_type="application/json", headers=headers)
+
+
+@app.websocket("/sky/ws")
+async def current_sky_ws(websocket: WebSocket):
+    """
+    The current sky, sent on connect and at the start of every bucket.
+    """
+    await sky_service.subscribe(websocket)
+
+
+@app.post("/jobs", status_code=202)
+async def submit_job(batch: BatchModel):
+    """
+    Queue a batch of births as a background job.
+    """
+    job = await job_manager.submit([birth.model_dump() for birth in batch.births])
+    return {"job_id": job["id"], "status": job["status"], "total": job["total"]}
+
+
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    """
+    Status and progress of a job.
+    """
+    job = job_manager.store.load(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return {"job_id": job["id"],
+            "status": job["status"],
+            "total": job["total"],
+            "done": job["done"],
+            "errors": job["errors"],
+            "error": job.get("error")}
+
+
+@app.get("/jobs/{job_id}/results")
+def job_results(job_id: str, offset: int = 0, limit: int = 1000):
+    """
+    Results computed so far, starting at offset. Poll again with next_offset
+    for further results.
+    """
+    job = job_manager.store.load(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    results = job_manager.store.results(job_id, offset, limit)
+    return {"job_id": job_id,
+            "status": job["status"],
+            "offset": offset,
+            "next_offset": offset + len(results),
+            "results": results}
+
+
+startup.record("import", time.perf_counter() - _import_start)
+
+# Build the tables and warm up before a forking server forks its workers
+if os.environ.get("HDA_PRELOAD"):
+    startup.preload()
@@ -5,6 +5,8 @@ Function to create a human design chart from birth data.
 """
 import human_design_lib.hd_features as hdf
 import human_design_lib.hd_constants as hdconst
+from birth import as_instant, parse_offset
+from metrics import timed
 
 
 def processTimeOffset(timeOffset: str):
@@ -18,17 +20,10 @@ def processTimeOffset(timeOffset: str):
 
     Returns
     -------
-        The time offset as a floating point number. E.g. +2:30 would return 2.5.
+        The time offset as a floating point number. E.g. +2:30 would return 2.5
+        and -3:30 would return -3.5.
     """
-    parts = [int(t) for t in timeOffset.split(":")]
-    if len(parts) == 2:
-        # Was in form HH:MM
-        time = parts[0] + parts[1] / 60
-    elif len(parts) == 3:
-        # Was in form HH:MM:SS
-        time = parts[1] + parts[2] / 60
-        time += parts[0] + time / 60
-    return time
+    return parse_offset(timeOffset)
 
 
 def processPlanets(planet_dict):
@@ -103,30 +98,39 @@ def getChannels(channel_dict):
     return channels
 
 
-def get_hd(birthDate: str, birthTime, timeOffset, location):
+def get_hd(birthDate, birthTime=None, timeOffset=None, location=None, extra_bodies=()):
     """
     Create Human Design information.
     
     Parameters
     ----------
-    birthDate: str
-        Should be in the format YYYY/MM/DD
+    birthDate: str or birth.BirthInstant
+        Should be in the format YYYY/MM/DD, or the parsed birth instant
+        (the other arguments are then not used).
     birthTime : str
         Should be in the format HH:MM. Optionally HH:MM:SS.
     timeOffset: str
         UTC offset. Should be in the format HH:MM. Optionally HH:MM:SS.
+    location: tuple(float, float) or None
+        (latitude, longitude). Only the angles (ASC, MC, DSC, IC) depend on
+        it. If None, they are PENDING.
+    extra_bodies: list of str
+        Optional bodies (hd_constants.EXTRA_BODY_DICT), returned under
+        "extra bodies" in the format of "planets". They do not take part in
+        channels, type or the other features.
     """
-    # Put date and time into usable format
-    date = [int(s) for s in birthDate.split("/")]
-    time = [int(t) for t in birthTime.split(":")]
-    if len(time) == 2:
-        # Was in form HH:MM
-        time.append(0)  # Add seconds
-    offset = processTimeOffset(timeOffset)
-    bt = tuple(date + time + [offset])
-
-    # Calculate Human Design information
-    design = hdf.calc_single_hd_features(bt, location)
+    birth = as_instant(birthDate, birthTime, timeOffset, location)
+    location = birth.location
+    pending = location is None
+    if pending:
+        location = (0, 0)
+
+    # Calculate Human Design information from the instant's julian day
+    instance = hdf.hd_features(*birth.timestamp, *location)
+    with timed("hd_ephemeris"):
+        date_to_gate_dict = instance.birth_creat_date_to_gate(birth_julday=birth.jd_ut)
+    with timed("hd_channels"):
+        design = hdf.calc_gate_dict_features(date_to_gate_dict)
     gate_dict = design[7]
 
     # Repackage basic information from design
@@ -143,6 +147,22 @@ def get_hd(birthDate: str, birthTime, timeOffset, location):
             "view perspective": getViewPerspective(gate_dict),
             "channels": getChannels(design[9]),
             "active chakras": design[8],
+            "circuits": design[10]["circuits"],
+            "circuit groups": design[10]["circuit groups"],
+            "awareness streams": design[10]["awareness streams"],
+            "stream groups": design[10]["stream groups"],
             "planets": processPlanets(gate_dict)}  # Get planets and their gates and lines
 
+    if pending:
+        for half in info["planets"].values():
+            for angle in hdconst.SWE_ANGLE_DICT:
+                half[angle] = {"gate": hdconst.PENDING, "line": hdconst.PENDING}
+
+    if extra_bodies:
+        with timed("hd_extra_bodies"):
+            extra = instance.extra_bodies_to_gate(list(extra_bodies))
+        info["extra bodies"] = {half: {body: {"gate": values[1], "line": values[2]}
+                                       for body, values in extra[label].items()}
+                                for half, label in (("personality", "prs"), ("design", "des"))}
+
     return info
\ No newline at end of file
@@ -0,0 +1,278 @@
+"""
+hd_analytics.py
+
+Population-scale distributions of Human Design features over a time range.
+
+The range is split into chunks of consecutive instants (UT). Chunks are
+computed in parallel worker processes; every worker writes the per-instant
+features of its chunk as a columnar part file and returns the chunk's
+histograms. The main process merges histograms incrementally and writes a
+checkpoint after every finished chunk, so an interrupted run resumes with the
+first unfinished chunk. Memory is bounded by the chunk size and the number of
+chunks in flight, not by the length of the range.
+
+Example (every minute from 1920 to 2020):
+    python -m human_design_lib.hd_analytics 1920/01/01 2020/01/01 analytics_out
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+from collections import Counter
+
+import swisseph as swe
+import numpy as np
+
+from human_design_lib import hd_features
+from human_design_lib.hd_columnar import write_columns
+
+FEATURES = ("type", "authority", "profile", "definition", "cross")
+DEFAULT_JOINTS = (("type", "authority"),
+                  ("type", "profile"),
+                  ("type", "definition"),
+                  ("authority", "definition"),
+                  ("authority", "profile"))
+MINUTES_PER_DAY = 1440
+CHECKPOINT_FILE = "checkpoint.json"
+HISTOGRAM_FILE = "histograms.json"
+
+
+def date_to_juldate(date):
+    '''
+    convert date string YYYY/MM/DD (midnight UT) to julian day
+    '''
+    year, month, day = [int(s) for s in date.split("/")]
+    return swe.julday(year, month, day, 0.0)
+
+
+def chunk_specs(jd_start, jd_end, step_minutes, chunk_steps):
+    '''
+    lazily split [jd_start, jd_end) into chunks
+    Return:
+        generator of (chunk_id, jd_first, n_steps)
+    '''
+    n_total = int(round((jd_end - jd_start) * MINUTES_PER_DAY / step_minutes))
+    for chunk_id, first in enumerate(range(0, n_total, chunk_steps)):
+        yield (chunk_id,
+               jd_start + first * step_minutes / MINUTES_PER_DAY,
+               min(chunk_steps, n_total - first))
+
+
+def chart_features(instance, jdut):
+    '''
+    distribution features of the chart for one instant
+    Args:
+        instance(hd_features): reused instance, holds the location for angles
+        jdut(float): julian day (UT)
+    Return:
+        features(dict): keys FEATURES
+    '''
+    date_to_gate_dict = instance.birth_creat_date_to_gate(birth_julday=jdut)
+    result = hd_features.calc_gate_dict_features(date_to_gate_dict)
+    return {"type": result[0],
+            "authority": result[1],
+            "profile": result[3],
+            "definition": result[4],
+            "cross": result[2]}
+
+
+def joint_key(joint):
+    return " x ".join(joint)
+
+
+def empty_histograms(joints):
+    return {"features": {feature: {} for feature in FEATURES},
+            "joint": {joint_key(joint): {} for joint in joints}}
+
+
+def merge_histograms(total, part):
+    '''add histogram counts of part into total (in place)'''
+    for group in ("features", "joint"):
+        for name, counts in part[group].items():
+            target = total[group].setdefault(name, {})
+            for value, count in counts.items():
+                target[value] = target.get(value, 0) + count
+    return total
+
+
+def _init_worker(ephe_path):
+    if ephe_path:
+        swe.set_ephe_path(ephe_path)
+
+
+def calc_chunk(chunk_id, jd_first, n_steps, step_minutes, location, out_dir, joints):
+    '''
+    compute one chunk in a worker process
+    writes part file <out_dir>/parts/chunk-<id>.npz with columns jd + FEATURES
+    Return:
+        chunk_id(int), histograms(dict)
+    '''
+    instance = hd_features.hd_features(0, 0, 0, 0, 0, 0, 0, *location)
+    jds = jd_first + np.arange(n_steps) * (step_minutes / MINUTES_PER_DAY)
+    columns = {feature: [] for feature in FEATURES}
+    histograms = {feature: Counter() for feature in FEATURES}
+    joint_histograms = {joint: Counter() for joint in joints}
+
+    for jdut in jds:
+        features = chart_features(instance, float(jdut))
+        for feature in FEATURES:
+            columns[feature].append(features[feature])
+            histograms[feature][features[feature]] += 1
+        for joint in joints:
+            joint_histograms[joint]["|".join(features[f] for f in joint)] += 1
+
+    write_columns(os.path.join(out_dir, "parts", "chunk-{:06d}.npz".format(chunk_id)),
+                  {"jd": jds, **columns})
+
+    return chunk_id, {"features": {f: dict(c) for f, c in histograms.items()},
+                      "joint": {joint_key(j): dict(c) for j, c in joint_histograms.items()}}
+
+
+def _load_checkpoint(path, config):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        checkpoint = json.load(f)
+    if checkpoint["config"] != config:
+        raise ValueError("checkpoint in {} was written for a different configuration".format(path))
+    return checkpoint
+
+
+def _write_json(path, content):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(content, f)
+    os.replace(tmp_path, path)
+
+
+def run_analytics(start,
+                  end,
+                  out_dir,
+                  step_minutes=1,
+                  chunk_steps=MINUTES_PER_DAY * 7,
+                  workers=None,
+                  location=(0.0, 0.0),
+                  joints=DEFAULT_JOINTS,
+                  ephe_path=None,
+                  report=True):
+    '''
+    compute feature distributions for every step in [start, end)
+    Parameters
+    ----------
+    start, end : str
+        Range in the format YYYY/MM/DD (UT, end exclusive).
+    out_dir : str
+        Directory for part files, checkpoint and final histograms.
+    step_minutes : int
+        Minutes between two sampled instants.
+    chunk_steps : int
+        Instants per chunk (unit of work, checkpointing and part files).
+    workers : int
+        Number of worker processes, defaults to the CPU count.
+    location : tuple[float, float]
+        Location used for the angles, which do not enter the distributions.
+    joints : sequence of tuple[str, str]
+        Pairs of FEATURES for joint distributions.
+    ephe_path : str
+        Swiss Ephemeris file path for the workers (needed for Chiron).
+
+    Returns
+    -------
+    histograms : dict
+        {"features": {feature: {value: count}}, "joint": {"a x b": {"va|vb": count}}}
+    '''
+    joints = [tuple(joint) for joint in joints]
+    workers = workers or os.cpu_count() or 1
+    config = {"start": start, "end": end, "step_minutes": step_minutes,
+              "chunk_steps": chunk_steps, "location": list(location),
+              "joints": [list(joint) for joint in joints]}
+    os.makedirs(os.path.join(out_dir, "parts"), exist_ok=True)
+    checkpoint_path = os.path.join(out_dir, CHECKPOINT_FILE)
+
+    checkpoint = _load_checkpoint(checkpoint_path, config)
+    if checkpoint is None:
+        checkpoint = {"config": config, "done": [], "histograms": empty_histograms(joints)}
+    done = set(checkpoint["done"])
+    histograms = checkpoint["histograms"]
+
+    specs = (spec for spec in chunk_specs(date_to_juldate(start), date_to_juldate(end),
+                                          step_minutes, chunk_steps)
+             if spec[0] not in done)
+    max_pending = 2 * workers
+    n_charts = 0
+    t_start = time.perf_counter()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                initializer=_init_worker,
+                                                initargs=(ephe_path,)) as pool:
+        pending = {}
+        exhausted = False
+        while pending or not exhausted:
+            # Keep a bounded number of chunks in flight
+            while not exhausted and len(pending) < max_pending:
+                spec = next(specs, None)
+                if spec is None:
+                    exhausted = True
+                    break
+                future = pool.submit(calc_chunk, *spec, step_minutes, location, out_dir, joints)
+                pending[future] = spec
+            if not pending:
+                break
+
+            finished, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                spec = pending.pop(future)
+                chunk_id, chunk_histograms = future.result()
+                merge_histograms(histograms, chunk_histograms)
+                done.add(chunk_id)
+                checkpoint["done"] = sorted(done)
+                _write_json(checkpoint_path, checkpoint)
+                n_charts += spec[2]
+
+            if report:
+                elapsed = time.perf_counter() - t_start
+                sys.stderr.write("\rchunks done: {}  charts/sec: {:.0f}".format(
+                    len(done), n_charts / elapsed if elapsed else 0.0))
+    if report:
+        sys.stderr.write("\n")
+
+    _write_json(os.path.join(out_dir, HISTOGRAM_FILE), histograms)
+    return histograms
+
+
+def _default_ephe_path():
+    '''the Swiss Ephemeris files shipped with flatlib, if installed'''
+    try:
+        import flatlib
+    except ImportError:
+        return None
+    return os.path.join(flatlib.PATH_RES, "swefiles")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Population distributions of Human Design features.")
+    parser.add_argument("start", help="Start date (UT). Must be in the format YYYY/MM/DD.")
+    parser.add_argument("end", help="End date (UT, exclusive). Must be in the format YYYY/MM/DD.")
+    parser.add_argument("out_dir", help="Directory for part files, checkpoint and histograms.")
+    parser.add_argument("--step-minutes", type=int, default=1, help="Minutes between samples.")
+    parser.add_argument("--chunk-steps", type=int, default=MINUTES_PER_DAY * 7,
+                        help="Samples per chunk.")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes.")
+    parser.add_argument("--ephe-path", default=_default_ephe_path(),
+                        help="Swiss Ephemeris file directory.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    run_analytics(args.start,
+                  args.end,
+                  args.out_dir,
+                  step_minutes=args.step_minutes,
+                  chunk_steps=args.chunk_steps,
+                  workers=args.workers,
+                  ephe_path=args.ephe_path)
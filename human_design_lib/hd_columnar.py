@@ -0,0 +1,93 @@
+"""
+hd_columnar.py
+
+Columnar part files for large batch outputs (analytics, bulk ingestion).
+
+Every part file is a compressed numpy archive holding one array per column.
+String columns are dictionary encoded (integer codes + category array), so
+files stay small and can be loaded column by column without reading rows.
+"""
+
+import os
+
+import numpy as np
+
+
+def write_columns(path, columns, compressed=True):
+    '''
+    write one columnar part file atomically (temp file + rename), so a crash
+    never leaves a half written part behind
+    Args:
+        path(str): target file, ".npz" is appended by numpy if missing
+        columns(dict): column name -> sequence of values (equal length)
+        compressed(bool): zip compression, off for large numeric parts written
+                          faster than they compress
+    '''
+    arrays = {}
+    for name, values in columns.items():
+        arr = np.asarray(values)
+        if arr.dtype.kind in "UOS":
+            categories, codes = np.unique(arr.astype(str), return_inverse=True)
+            arrays[name + "__codes"] = codes.astype(np.int32)
+            arrays[name + "__categories"] = categories
+        else:
+            arrays[name] = arr
+    if not path.endswith(".npz"):
+        path += ".npz"
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        (np.savez_compressed if compressed else np.savez)(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+def read_columns(path, columns=None):
+    '''
+    read a part file written by write_columns, decoding string columns
+    Args:
+        path(str): part file
+        columns(list): optional, names of the columns to load
+    Return:
+        columns(dict): column name -> np.array
+    '''
+    result = {}
+    with np.load(path, allow_pickle=False) as data:
+        names = {key.split("__")[0] for key in data.files}
+        for name in sorted(names):
+            if columns is not None and name not in columns:
+                continue
+            if name + "__codes" in data.files:
+                result[name] = data[name + "__categories"][data[name + "__codes"]]
+            else:
+                result[name] = data[name]
+    return result
+
+
+class ColumnarWriter:
+    '''
+    Buffer rows and flush them as numbered part files of a fixed size.
+    Memory use is bounded by rows_per_part regardless of the total output.
+    '''
+    def __init__(self, directory, prefix="part", rows_per_part=100000, first_part=0):
+        self.directory = directory
+        self.prefix = prefix
+        self.rows_per_part = rows_per_part
+        self.part = first_part
+        self.rows = []
+        os.makedirs(directory, exist_ok=True)
+
+    def append(self, row):
+        '''add one row (dict column name -> scalar value)'''
+        self.rows.append(row)
+        if len(self.rows) >= self.rows_per_part:
+            self.flush()
+
+    def flush(self):
+        '''write buffered rows as the next part file, returns number of parts written'''
+        if self.rows:
+            columns = {key: [row.get(key) for row in self.rows] for key in self.rows[0]}
+            write_columns(os.path.join(self.directory,
+                                       "{}-{:06d}.npz".format(self.prefix, self.part)),
+                          columns)
+            self.part += 1
+            self.rows = []
+        return self.part
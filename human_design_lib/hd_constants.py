@@ -27,18 +27,25 @@ SWE_PLANET_DICT = {"Sun":0,
                     "Pluto":9,
                     "Chiron":15,
                     "Lilith": 12,
-                   #'Pholus':16,
-                   #'Ceres':17,
-                   #'Pallas':18,
-                   #'Juno':19,
-                   #'Vesta':20,
                    }
 
+# optional bodies, computed only on request and kept apart from
+# SWE_PLANET_DICT (whose positions remove_extras relies on)
+EXTRA_BODY_DICT = {"Ceres": 17,
+                   "Pallas": 18,
+                   "Juno": 19,
+                   "Vesta": 20,
+                   "Pholus": 16}
+
 SWE_ANGLE_DICT = {"ASC": 0,
                   "MC": 1,
                   "DSC": 0,  # ASC + 180
                   "IC": 1}  # MC + 180
 
+# value of the location-dependent fields (angles, houses) of a chart whose
+# location is not known yet
+PENDING = "pending"
+
 IGING_CIRCLE_LIST =  [41, 19, 13, 49, 30, 55, 37, 63, 22, 36, 25, 17, 21, 51, 42, 3, 27, 24, 2, 23, 8, 
                       20, 16, 35, 45, 12, 15, 52, 39, 53, 62, 56, 31, 33, 7, 4, 29, 59, 40, 64, 47, 6, 
                       46, 18, 48, 57, 32, 50, 28, 44, 1, 43, 14, 34, 9, 5, 26, 11, 10, 58, 38, 54, 61, 60]
@@ -228,7 +235,7 @@ circuit_group_typ_dict = {
 
 awareness_stream_dict = {
 						(58,18,48,16):"Taste",
-						(38,28,67,20):"Intuition",
+						(38,28,57,20):"Intuition",
 						(54,32,44,26):"Instinct",
 						(41,30,36,35):"Feel",
 						(39,55,22,12):"Emotion",
@@ -0,0 +1,363 @@
+"""
+hd_cycles.py
+
+Returns and life-cycle events of natal charts: solar and lunar returns,
+Saturn returns, the Uranus opposition and the Chiron return.
+
+An event is a time at which a transiting body's longitude equals the natal
+longitude (plus an angle, 180 degrees for an opposition) modulo 360. The
+longitude of every body is tabulated once for the whole batch, with its speed,
+and interpolated with cubic Hermite polynomials (errors mostly well below
+1" at the default steps). On the unwrapped table longitude, every cycle of every chart
+is a level crossing: the table intervals holding the crossings are found
+with binary searches on the running maximum and minimum (all passes of a
+retrograde loop are found), and the crossing times are refined with a few
+Newton steps on the interpolating polynomials, for all events of all charts
+at once. No ephemeris call is made per chart.
+
+A pass within one table step of a station (the body only grazing the
+longitude) can be missed.
+
+Example (events of 90 years for the charts of bulk_ingest's columnar output):
+    python -m human_design_lib.hd_cycles out_dir/columnar cycles --years 90
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import swisseph as swe
+
+from human_design_lib import hd_ephemeris
+from human_design_lib.hd_columnar import read_columns, write_columns
+from human_design_lib.hd_transits import juldate_to_iso
+
+DAYS_PER_YEAR = 365.25
+
+# body -> (swiss_ephemeris planet number, table step in days)
+CYCLE_BODIES = {"Sun": (swe.SUN, 2.0),
+                "Moon": (swe.MOON, 1.0),
+                "Saturn": (swe.SATURN, 4.0),
+                "Uranus": (swe.URANUS, 4.0),
+                "Chiron": (swe.CHIRON, 4.0)}
+
+# event -> (body, angle to the natal longitude, first multiple of 360 degrees beyond it,
+#           number of cycles or None for all)
+EVENTS = {"solar_return": ("Sun", 0.0, 1, None),
+          "lunar_return": ("Moon", 0.0, 1, None),
+          "saturn_return": ("Saturn", 0.0, 1, None),
+          "uranus_opposition": ("Uranus", 180.0, 0, 1),
+          "chiron_return": ("Chiron", 0.0, 1, None)}
+EVENT_NAMES = list(EVENTS)
+
+# Table margin beyond the last event time, longer than a retrograde loop
+MARGIN_DAYS = 5 * DAYS_PER_YEAR
+NEWTON_STEPS = 4
+
+
+class HermiteTable:
+    '''
+    unwrapped longitude and speed of a body at equidistant times, with cubic
+    Hermite interpolation
+    Args:
+        jd_start(float): julian day (UT) of the first node
+        step(float): days between nodes
+        longitudes(np.array): unwrapped longitudes (degrees) at the nodes
+        speeds(np.array): longitude speeds (degrees/day) at the nodes
+    '''
+    def __init__(self, jd_start, step, longitudes, speeds):
+        self.jd_start = jd_start
+        self.step = step
+        self.longitudes = np.asarray(longitudes, dtype=float)
+        self.speeds = np.asarray(speeds, dtype=float)
+        # Nondecreasing envelopes: highest longitude so far, lowest from here on
+        self.running_max = np.maximum.accumulate(self.longitudes)
+        self.running_min = np.minimum.accumulate(self.longitudes[::-1])[::-1]
+        # Never retrograde (Sun, Moon): every target is crossed once
+        self.direct = bool(np.all(np.diff(self.longitudes) > 0))
+
+    @classmethod
+    def compute(cls, planet_code, jd_start, jd_end, step):
+        '''table of a swiss_ephemeris planet from jd_start to at least jd_end'''
+        n_nodes = int(np.ceil((jd_end - jd_start) / step)) + 1
+        longitudes = np.empty(n_nodes)
+        speeds = np.empty(n_nodes)
+        for node in range(n_nodes):
+            position, _ = hd_ephemeris.calc_ut(jd_start + node * step, planet_code)
+            longitudes[node] = position[0]
+            speeds[node] = position[3]
+        return cls(jd_start, step, np.unwrap(longitudes, period=360), speeds)
+
+    @property
+    def jd_end(self):
+        return self.jd_start + (len(self.longitudes) - 1) * self.step
+
+    def _node(self, jd):
+        node = np.floor((np.asarray(jd, dtype=float) - self.jd_start) / self.step).astype(np.int64)
+        return np.clip(node, 0, len(self.longitudes) - 2)
+
+    def _polynomial(self, node, s):
+        '''interpolated longitude and its derivative by s at s in [0, 1] of node intervals'''
+        p0, p1 = self.longitudes[node], self.longitudes[node + 1]
+        m0, m1 = self.speeds[node] * self.step, self.speeds[node + 1] * self.step
+        s2 = s * s
+        s3 = s2 * s
+        value = ((2 * s3 - 3 * s2 + 1) * p0 + (s3 - 2 * s2 + s) * m0
+                 + (-2 * s3 + 3 * s2) * p1 + (s3 - s2) * m1)
+        derivative = ((6 * s2 - 6 * s) * (p0 - p1) + (3 * s2 - 4 * s + 1) * m0
+                      + (3 * s2 - 2 * s) * m1)
+        return value, derivative
+
+    def longitude(self, jd):
+        '''
+        interpolated unwrapped longitude (vectorized)
+        Return:
+            longitude(np.array): degrees, not reduced to [0, 360)
+        '''
+        node = self._node(jd)
+        s = (np.asarray(jd, dtype=float) - self.jd_start) / self.step - node
+        return self._polynomial(node, s)[0]
+
+    def crossings(self, targets):
+        '''
+        every time at which the unwrapped longitude equals a target (vectorized)
+        Args:
+            targets(np.array): unwrapped longitudes
+        Return:
+            target(np.array): position in targets of each crossing
+            passes(np.array): 1 for the first crossing of a target, 2, 3 for
+                              the following passes of a retrograde loop
+            jd(np.array): julian days (UT)
+        '''
+        targets = np.asarray(targets, dtype=float)
+        n_nodes = len(self.longitudes)
+        if self.direct:
+            # One crossing, in the interval starting at the last node below the target
+            node = np.searchsorted(self.longitudes, targets, side="right") - 1
+            target = np.flatnonzero((node >= 0) & (node < n_nodes - 1))
+            node = node[target]
+            passes = np.ones(len(target), dtype=np.int64)
+        else:
+            # Node reaching the target first, and node after which the body stays beyond it
+            first = np.searchsorted(self.running_max, targets, side="left")
+            last = np.searchsorted(self.running_min, targets, side="left")
+            inside = (first > 0) & (last < n_nodes)
+            target = np.flatnonzero(inside)
+            first, last = first[inside], last[inside]
+
+            # Sign changes of longitude - target over the nodes first - 1 .. last
+            width = int((last - first).max()) + 1 if len(target) else 0
+            nodes = np.minimum(first[:, None] - 1 + np.arange(width + 1), n_nodes - 1)
+            below = self.longitudes[nodes] < targets[target, None]
+            change = (below[:, :-1] != below[:, 1:]) & (nodes[:, 1:] <= last[:, None])
+            rows, columns = np.nonzero(change)
+            node = nodes[rows, columns]
+            target = target[rows]
+            # rows are ordered, so the passes of a target are consecutive
+            starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+            passes = np.arange(len(rows)) - np.repeat(starts, np.diff(np.r_[starts, len(rows)])) + 1
+
+        jd = self.jd_start + (node + self._solve(node, targets[target])) * self.step
+        return target, passes, jd
+
+    def _solve(self, node, targets):
+        '''
+        position s in [0, 1] of the crossing in node intervals holding one:
+        Newton steps kept inside a bracket of the crossing, bisection steps
+        where Newton would leave it (near stations)
+        '''
+        p0, p1 = self.longitudes[node], self.longitudes[node + 1]
+        m0, m1 = self.speeds[node] * self.step, self.speeds[node + 1] * self.step
+        # Interpolating polynomial - target = ((c3 * s + c2) * s + c1) * s - offset
+        c1 = m0
+        c2 = 3 * (p1 - p0) - 2 * m0 - m1
+        c3 = 2 * (p0 - p1) + m0 + m1
+        offset = targets - p0
+        rising = p1 > p0
+        low, high = np.zeros(len(node)), np.ones(len(node))
+        s = np.clip(offset / (p1 - p0), 0.0, 1.0)
+        for _ in range(NEWTON_STEPS):
+            value = ((c3 * s + c2) * s + c1) * s - offset
+            derivative = (3 * c3 * s + 2 * c2) * s + c1
+            # Shrink the bracket to the side of s holding the crossing
+            before = (value < 0) == rising
+            low = np.where(before, s, low)
+            high = np.where(before, high, s)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                newton = s - value / derivative
+            s = np.where((newton >= low) & (newton <= high), newton, (low + high) / 2)
+        return s
+
+
+class CycleTables:
+    '''
+    HermiteTable of every body of CYCLE_BODIES over a time range
+    Args:
+        jd_start(float), jd_end(float): julian days (UT) to cover
+    '''
+    def __init__(self, jd_start, jd_end, bodies=CYCLE_BODIES):
+        self.jd_start = jd_start
+        self.jd_end = jd_end
+        self.tables = {body: HermiteTable.compute(code, jd_start, jd_end, step)
+                       for body, (code, step) in bodies.items()}
+
+    def covers(self, jd_start, jd_end):
+        return self.jd_start <= jd_start and jd_end <= self.jd_end
+
+
+_tables = None
+
+
+def get_tables(jd_start, jd_end):
+    '''
+    CycleTables covering [jd_start, jd_end] plus the margins, reused while
+    later ranges fit (built for 1900-2150 at least)
+    '''
+    global _tables
+    jd_start, jd_end = jd_start - MARGIN_DAYS, jd_end + MARGIN_DAYS
+    if _tables is None or not _tables.covers(jd_start, jd_end):
+        _tables = CycleTables(min(jd_start, swe.julday(1900, 1, 1)),
+                              max(jd_end, swe.julday(2150, 1, 1)))
+    return _tables
+
+
+def lifetime_events(jd_birth, years=90.0, events=EVENT_NAMES, tables=None):
+    '''
+    all events of charts in the years after birth (vectorized over charts and cycles)
+    Args:
+        jd_birth(np.array): julian days (UT) of birth
+        years(float): length of the lifetime
+        events(list): names of EVENTS
+        tables(CycleTables): optional, get_tables by default
+    Return:
+        columns(dict): "row" (position in jd_birth), "event" (position in
+                       EVENT_NAMES), "cycle" (1 for the first return),
+                       "pass" (1, 2, 3 for the passes of a retrograde loop),
+                       "jd" of every event, grouped by event
+    '''
+    jd_birth = np.asarray(jd_birth, dtype=float)
+    jd_end = jd_birth + years * DAYS_PER_YEAR
+    if tables is None:
+        tables = get_tables(jd_birth.min(), jd_end.max())
+    columns = {"row": [], "event": [], "cycle": [], "pass": [], "jd": []}
+    for event in events:
+        body, angle, first_cycle, n_cycles = EVENTS[event]
+        table = tables.tables[body]
+        base = table.longitude(jd_birth) + angle
+        # Cycles whose target the body reaches before the end of the lifetime
+        reached = table.running_max[np.minimum(table._node(jd_end) + 1, len(table.longitudes) - 1)]
+        last_cycle = np.floor((reached - base) / 360).astype(np.int64)
+        if n_cycles is not None:
+            last_cycle = np.minimum(last_cycle, first_cycle + n_cycles - 1)
+        counts = np.maximum(last_cycle - first_cycle + 1, 0)
+        rows = np.repeat(np.arange(len(jd_birth)), counts)
+        cycles = first_cycle + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+        target, passes, jd = table.crossings(base[rows] + 360 * cycles)
+        rows, cycles = rows[target], cycles[target]
+        keep = (jd > jd_birth[rows]) & (jd <= jd_end[rows])
+        columns["row"].append(rows[keep])
+        columns["event"].append(np.full(keep.sum(), EVENT_NAMES.index(event), dtype=np.int8))
+        columns["cycle"].append((cycles[keep] - first_cycle + 1).astype(np.int16))
+        columns["pass"].append(passes[keep].astype(np.int8))
+        columns["jd"].append(jd[keep])
+    return {name: np.concatenate(values) for name, values in columns.items()}
+
+
+def chart_events(jd_birth, years=90.0, events=EVENT_NAMES):
+    '''
+    events of one chart in time order
+    Return:
+        list of {"event","cycle","pass","jd","time"}
+    '''
+    columns = lifetime_events(np.array([jd_birth]), years, events)
+    order = np.argsort(columns["jd"], kind="stable")
+    return [{"event": EVENT_NAMES[event], "cycle": cycle, "pass": passes, "jd": jd,
+             "time": juldate_to_iso(jd)}
+            for event, cycle, passes, jd in zip(columns["event"][order].tolist(),
+                                                columns["cycle"][order].tolist(),
+                                                columns["pass"][order].tolist(),
+                                                columns["jd"][order].tolist())]
+
+
+def read_births(path):
+    '''
+    julian days of birth of a columnar part file or directory of part files
+    with a "jd_ut" column (e.g. bulk_ingest's columnar output), in order;
+    failed rows are NaN
+    '''
+    paths = sorted(glob.glob(os.path.join(path, "*.npz"))) if os.path.isdir(path) else [path]
+    return np.concatenate([read_columns(part, ["jd_ut"])["jd_ut"].astype(float)
+                           for part in paths])
+
+
+def run_cycles(input_path, out_dir, years=90.0, events=EVENT_NAMES, chunk_rows=4000):
+    '''
+    compute the lifetime events of all charts of a columnar input and write
+    them as columnar part files of ("row","event","cycle","pass","jd"),
+    row being the chart's position in the input
+    Return:
+        summary(dict)
+    '''
+    start = time.perf_counter()
+    jd_birth = read_births(input_path)
+    valid = np.flatnonzero(np.isfinite(jd_birth))
+    os.makedirs(out_dir, exist_ok=True)
+    loaded = time.perf_counter()
+
+    if len(valid):
+        tables = get_tables(jd_birth[valid].min(), jd_birth[valid].max() + years * DAYS_PER_YEAR)
+    tabulated = time.perf_counter()
+
+    n_events = 0
+    solve_sec = write_sec = 0.0
+    for part, chunk_start in enumerate(range(0, len(valid), chunk_rows)):
+        t0 = time.perf_counter()
+        chunk = valid[chunk_start:chunk_start + chunk_rows]
+        columns = lifetime_events(jd_birth[chunk], years, events, tables)
+        columns["row"] = chunk[columns["row"]].astype(np.int32)
+        t1 = time.perf_counter()
+        write_columns(os.path.join(out_dir, "events-{:06d}.npz".format(part)), columns,
+                      compressed=False)
+        write_sec += time.perf_counter() - t1
+        solve_sec += t1 - t0
+        n_events += len(columns["jd"])
+
+    return {"charts": len(valid),
+            "skipped": len(jd_birth) - len(valid),
+            "events": n_events,
+            "event_names": list(events),
+            "load_sec": loaded - start,
+            "table_sec": tabulated - loaded,
+            "solve_sec": solve_sec,
+            "write_sec": write_sec}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Returns and life-cycle events of stored charts.")
+    parser.add_argument("input", help="Columnar part file or directory with a jd_ut column.")
+    parser.add_argument("out_dir", help="Directory for the event part files.")
+    parser.add_argument("--years", type=float, default=90.0, help="Length of the lifetime.")
+    parser.add_argument("--events", default=",".join(EVENT_NAMES),
+                        help="Comma separated events of: {}.".format(", ".join(EVENT_NAMES)))
+    parser.add_argument("--chunk-rows", type=int, default=4000,
+                        help="Charts per part file (bounds the memory use).")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    import flatlib
+
+    # Connect to extra ephemeris files (for Chiron)
+    swe.set_ephe_path(os.path.join(flatlib.PATH_RES, "swefiles"))
+    args = parse_args()
+    event_names = [name.strip() for name in args.events.split(",") if name.strip()]
+    unknown = sorted(set(event_names) - set(EVENTS))
+    if unknown:
+        sys.exit("Unknown events: {}".format(", ".join(unknown)))
+    summary = run_cycles(args.input, args.out_dir, args.years, event_names, args.chunk_rows)
+    sys.stderr.write(json.dumps(summary) + "\n")
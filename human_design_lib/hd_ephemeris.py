@@ -0,0 +1,195 @@
+'''
+ephemeris policy: which swiss_ephemeris mode computes which body
+
+modes:
+    "swiss"   -> Swiss Ephemeris data files (swefiles), most precise
+    "moshier" -> Moshier's analytical ephemeris, needs no data files
+                 (bodies Moshier does not cover, e.g. Chiron, always use
+                 the Swiss files)
+
+a policy has a default mode and optional per-body modes. The policy of the
+process is read from the environment:
+    HDA_EPHEMERIS=moshier
+    HDA_EPHEMERIS_BODIES=Moon:swiss,North_Node:swiss
+
+hd_features, the design date solver, hd_transits and astrology (through
+install_flatlib) compute positions through calc_ut/solcross_ut of this module
+'''
+import os
+import threading
+
+import flatlib
+import swisseph as swe
+
+from human_design_lib import hd_constants
+
+MODE_FLAGS = {"swiss": swe.FLG_SWIEPH,
+              "moshier": swe.FLG_MOSEPH}
+
+# body name -> swiss_ephemeris planet number (flatlib's North Node is the mean node)
+BODY_CODES = {**{name: code for name, code in hd_constants.SWE_PLANET_DICT.items()
+                 if name not in ("Earth", "South_Node")},
+              **hd_constants.EXTRA_BODY_DICT,
+              "Mean_Node": swe.MEAN_NODE}
+
+# bodies Moshier does not cover
+FILE_ONLY_CODES = {swe.CHIRON, *hd_constants.EXTRA_BODY_DICT.values()}
+
+# extra ephemeris files (Chiron, asteroids, fixed stars)
+EPHE_PATH = os.path.join(flatlib.PATH_RES, "swefiles")
+
+# extra bodies whose ephemeris was found readable, see require_bodies
+_available_bodies = set()
+
+# per thread: whether the ephemeris path is set, see init_ephemeris
+_thread_state = threading.local()
+
+
+class EphemerisPolicy:
+    '''
+    ephemeris mode per body
+    Args:
+        default(str): mode of all bodies not in bodies, see MODE_FLAGS
+        bodies(dict): body name (BODY_CODES) or planet number -> mode
+    '''
+    def __init__(self, default="swiss", bodies=None):
+        if default not in MODE_FLAGS:
+            raise ValueError("Unknown ephemeris mode: {}".format(default))
+        self.default = default
+        self.bodies = {}
+        for body, mode in (bodies or {}).items():
+            if mode not in MODE_FLAGS:
+                raise ValueError("Unknown ephemeris mode: {}".format(mode))
+            if body not in BODY_CODES and body not in BODY_CODES.values():
+                raise ValueError("Unknown body: {}".format(body))
+            self.bodies[BODY_CODES.get(body, body)] = mode
+
+    def mode(self, planet_code):
+        '''mode used for a planet number'''
+        if planet_code in FILE_ONLY_CODES:
+            return "swiss"
+        return self.bodies.get(planet_code, self.default)
+
+    def flag(self, planet_code):
+        return MODE_FLAGS[self.mode(planet_code)]
+
+    def describe(self):
+        '''policy as "default" or "default,body:mode,..."'''
+        names = {code: name for name, code in BODY_CODES.items()}
+        return ",".join([self.default] + ["{}:{}".format(names.get(code, code), mode)
+                                          for code, mode in self.bodies.items()])
+
+
+def parse_policy(default, bodies=""):
+    '''
+    policy from the HDA_EPHEMERIS/HDA_EPHEMERIS_BODIES format
+    Args:
+        default(str): mode, e.g. "moshier"
+        bodies(str): e.g. "Moon:swiss,North_Node:swiss"
+    '''
+    per_body = {}
+    for item in filter(None, (part.strip() for part in bodies.split(","))):
+        body, _, mode = item.partition(":")
+        per_body[body.strip()] = mode.strip()
+    return EphemerisPolicy(default.strip() or "swiss", per_body)
+
+
+def policy_from_env():
+    return parse_policy(os.environ.get("HDA_EPHEMERIS", "swiss"),
+                        os.environ.get("HDA_EPHEMERIS_BODIES", ""))
+
+
+_policy = policy_from_env()
+
+
+def get_policy():
+    return _policy
+
+
+def set_policy(policy):
+    '''set the policy of the process, returns the previous one'''
+    global _policy
+    previous, _policy = _policy, policy
+    return previous
+
+
+def init_ephemeris():
+    '''
+    connect the calling thread to the extra ephemeris files; the Swiss
+    Ephemeris keeps its state per thread and set_ephe_path reopens the files,
+    so this connects once in every thread that calculates, not per call
+    '''
+    if not getattr(_thread_state, "ephemeris", False):
+        swe.set_ephe_path(EPHE_PATH)
+        _thread_state.ephemeris = True
+
+
+def close_ephemeris():
+    '''close the ephemeris files of the calling thread'''
+    swe.close()
+    _thread_state.ephemeris = False
+
+
+def calc_ut(jdut, planet_code, flags=swe.FLG_SPEED):
+    '''
+    swe.calc_ut with the ephemeris flag of the policy
+    Args:
+        jdut(float): julian day (UT)
+        planet_code(int): swiss_ephemeris planet number
+        flags(int): further flags, without ephemeris flag
+    Return:
+        same as swe.calc_ut
+    '''
+    return swe.calc_ut(jdut, planet_code, flags | _policy.flag(planet_code))
+
+
+def require_bodies(names):
+    '''
+    check, once per process and body, that the ephemeris of optional bodies
+    (hd_constants.EXTRA_BODY_DICT) can be read; their asteroid files are only
+    opened when a body is first requested
+    Args:
+        names(iterable): body names
+    Raise:
+        ValueError: unknown body or ephemeris file missing
+    '''
+    for name in names:
+        if name in _available_bodies:
+            continue
+        if name not in hd_constants.EXTRA_BODY_DICT:
+            raise ValueError("Unknown extra body: {}".format(name))
+        try:
+            # swe falls back to Moshier silently if the file is missing
+            _, flags = calc_ut(2451545.0, hd_constants.EXTRA_BODY_DICT[name])
+        except swe.Error as exc:
+            raise ValueError("Ephemeris of {} not available: {}".format(name, exc)) from None
+        if not flags & swe.FLG_SWIEPH:
+            raise ValueError("Ephemeris file of {} not found".format(name))
+        _available_bodies.add(name)
+
+
+def solcross_ut(long, jdut):
+    '''swe.solcross_ut with the policy's ephemeris of the Sun'''
+    return swe.solcross_ut(long, jdut, _policy.flag(swe.SUN))
+
+
+def install_flatlib():
+    '''
+    route flatlib's object positions through the policy (flatlib calls
+    swisseph.calc_ut without flags)
+    '''
+    from flatlib.ephem import swe as flatlib_swe
+
+    def sweObject(obj, jd):
+        sweList, flg = calc_ut(jd, flatlib_swe.SWE_OBJECTS[obj])
+        return {'id': obj,
+                'lon': sweList[0],
+                'lat': sweList[1],
+                'lonspeed': sweList[3],
+                'latspeed': sweList[4]}
+
+    def sweObjectLon(obj, jd):
+        return calc_ut(jd, flatlib_swe.SWE_OBJECTS[obj])[0][0]
+
+    flatlib_swe.sweObject = sweObject
+    flatlib_swe.sweObjectLon = sweObjectLon
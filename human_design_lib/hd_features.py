@@ -15,6 +15,27 @@ import swisseph as swe
 import numpy as np
 
 from human_design_lib import hd_constants
+from human_design_lib import hd_ephemeris
+
+
+def lon_to_gate(long):
+    '''
+    convert ecliptic longitude to gate,line,color,tone,base
+    zodiac and gate-circle (IGING circle) are synchronized by IGING_offset = 58°
+    Args:
+        long(float): ecliptic longitude in degrees
+    Return:
+        gate,line,color,tone,base (tuple of int)
+    '''
+    angle = (long + hd_constants.IGING_offset) % 360 #angles max 360°
+    angle_percentage = angle/360
+
+    gate = hd_constants.IGING_CIRCLE_LIST[int(angle_percentage*64)]
+    line = int((angle_percentage*64*6)%6+1)
+    color =int((angle_percentage*64*6*6)%6+1)
+    tone =int((angle_percentage*64*6*6*6)%6+1)
+    base =int((angle_percentage*64*6*6*6*5)%5+1)
+    return gate,line,color,tone,base
 
 
 class hd_features:
@@ -101,6 +122,17 @@ class hd_features:
 
         return jdut[1]
     
+    def planet_lon(self,jdut,planet_code):
+        '''
+        ecliptic longitude of a planet, overridden by alternative ephemerides
+        Args:
+            julian day(float): timestamp in julian day format (UT)
+            planet_code(int): swiss_ephemeris planet number
+        Return:
+            longitude(float) in degrees
+        '''
+        return hd_ephemeris.calc_ut(jdut,planet_code)[0][0]
+
     def calc_create_date(self,jdut):
         ''' 
         Calculate creation date from birth data:
@@ -112,10 +144,10 @@ class hd_features:
             creation date (float): timestamp in julian day format
         '''
         design_pos = 88 
-        sun_long = swe.calc_ut(jdut, swe.SUN)[0][0]
+        sun_long = self.planet_lon(jdut, swe.SUN)
         long = swe.degnorm(sun_long - design_pos)
         tstart = jdut - 100 #aproximation is start - 100°
-        res = swe.solcross_ut(long, tstart)
+        res = hd_ephemeris.solcross_ut(long, tstart)
         #print(res)
         create_date = swe.revjul(res)
         #print(create_date)
@@ -138,9 +170,6 @@ class hd_features:
             value_dict (dict)
         '''   
         
-        """synchronize zodiac and gate-circle (IGING circle) = 58°""" 
-        offset= hd_constants.IGING_offset
-
         result_dict = {k: [] 
                        for k in ["label",
                                  "planets",
@@ -153,8 +182,7 @@ class hd_features:
                       }
 
         for idx,(planet,planet_code) in enumerate(self.SWE_PLANET_DICT.items()):
-            xx = swe.calc_ut(jdut,planet_code)
-            long = xx[0][0]
+            long = self.planet_lon(jdut,planet_code)
             
             #sun position is base of earth position
             if planet =="Earth": 
@@ -164,15 +192,8 @@ class hd_features:
             elif planet == "South_Node":
                 long = (long+180) % 360 #North Node is in opp. pos.,angles max 360°
                 
-            angle = (long + offset) % 360 #angles max 360°
-            angle_percentage = angle/360
-            
             #convert angle to gate,line,color,tone,base
-            gate = self.IGING_CIRCLE_LIST[int(angle_percentage*64)] 
-            line = int((angle_percentage*64*6)%6+1)
-            color =int((angle_percentage*64*6*6)%6+1)
-            tone =int((angle_percentage*64*6*6*6)%6+1)
-            base =int((angle_percentage*64*6*6*6*5)%5+1)
+            gate,line,color,tone,base = lon_to_gate(long)
 
             result_dict["label"].append(label)
             result_dict["planets"].append(planet)
@@ -197,15 +218,8 @@ class hd_features:
             if hang == "IC":
                 long = (long+180) % 360  # Max angle is 360
 
-            angle = (long + offset) % 360 #angles max 360°
-            angle_percentage = angle/360
-            
             #convert angle to gate,line,color,tone,base
-            gate = self.IGING_CIRCLE_LIST[int(angle_percentage*64)] 
-            line = int((angle_percentage*64*6)%6+1)
-            color =int((angle_percentage*64*6*6)%6+1)
-            tone =int((angle_percentage*64*6*6*6)%6+1)
-            base =int((angle_percentage*64*6*6*6*5)%5+1)
+            gate,line,color,tone,base = lon_to_gate(long)
 
             result_dict["label"].append(label)
             result_dict["planets"].append(hang)
@@ -218,15 +232,18 @@ class hd_features:
             
         return result_dict
 
-    def birth_creat_date_to_gate(self):
+    def birth_creat_date_to_gate(self,birth_julday=None):
         '''
         concatenate birth- and create date_to_gate_dict 
            Args:
                 time_stamp(tuple): format(year,month,day,hour,minute,second,timezone_offset)
+                birth_julday(float): optional, julian day (UT) of birth, skips
+                                     conversion of time_stamp if given
            Return: 
                 date_to_gate_dict(dict): keys->[planets,label,longitude,gate,line,color,tone,base]
         '''
-        birth_julday = self.timestamp_to_juldate()
+        if birth_julday is None:
+            birth_julday = self.timestamp_to_juldate()
         create_julday = self.calc_create_date(birth_julday)
         birth_planets = self.date_to_gate(birth_julday,"prs")
         create_planets = self.date_to_gate(create_julday,"des")
@@ -235,10 +252,31 @@ class hd_features:
             for key in birth_planets.keys()
                             }
         self.date_to_gate_dict = date_to_gate_dict
+        self.birth_julday = birth_julday
+        self.create_julday = create_julday
         self.create_date = swe.jdut1_to_utc(create_julday)[:-1]
         
         return date_to_gate_dict
     
+    def extra_bodies_to_gate(self,bodies):
+        '''
+        gates of optional bodies (hd_constants.EXTRA_BODY_DICT) at birth and
+        create date, after birth_creat_date_to_gate; kept apart from
+        date_to_gate_dict so its positions (remove_extras) do not move
+           Args:
+                bodies(list): body names
+           Return:
+                extra_dict(dict): label ("prs","des") -> body -> (lon,gate,line,color,tone,base)
+        '''
+        hd_ephemeris.require_bodies(bodies)
+        extra_dict = {}
+        for label,jdut in (("prs",self.birth_julday),("des",self.create_julday)):
+            extra_dict[label] = {}
+            for body in bodies:
+                long = self.planet_lon(jdut,hd_constants.EXTRA_BODY_DICT[body])
+                extra_dict[label][body] = (long,*lon_to_gate(long))
+        return extra_dict
+
     def day_chart(self):
         '''calculate day chart
            Args:
@@ -658,9 +696,136 @@ def calc_full_gates_chakra_dict(gates_chakra_dict):
     
     return full_dict
 
-#from chakra dict create full_dict (add keys in reversed order) 
+#from chakra dict create full_dict (add keys in reversed order)
 full_dict = calc_full_gates_chakra_dict(hd_constants.GATES_CHAKRA_DICT)
 
+def calc_channel_index_tables(gates_chakra_dict):
+    '''
+    precompute lookup tables that map channels to a fixed channel index (0..35)
+    and each channel index to its circuit, circuit group, awareness stream and
+    stream group. Tables are plain numpy arrays, so classification of a chart is
+    a single fancy-indexing step on top of channel detection.
+    Args:
+        gates_chakra_dict(dict): Constants are stored in hd_constants format {(64,47):("HD","AA"),...}
+    Return:
+        tables(dict): keys: channel_list,channel_index,circuit_names,circuit_group_names,
+                            stream_names,stream_group_names,channel_circuit,
+                            channel_circuit_group,channel_stream,channel_stream_group
+    '''
+    channel_list = list(gates_chakra_dict.keys())
+    #gate x gate table, -1 where two gates do not form a channel
+    channel_index = np.full((65,65),-1,dtype=np.int8)
+    for idx,(gate_a,gate_b) in enumerate(channel_list):
+        channel_index[gate_a,gate_b] = idx
+        channel_index[gate_b,gate_a] = idx
+
+    #names in order of first appearance in hd_constants
+    circuit_names = list(dict.fromkeys(hd_constants.circuit_typ_dict.values()))
+    circuit_group_names = list(dict.fromkeys(hd_constants.circuit_group_typ_dict.values()))
+    stream_names = list(dict.fromkeys(hd_constants.awareness_stream_dict.values()))
+    stream_group_names = list(dict.fromkeys(hd_constants.awareness_stream_group_dict.values()))
+
+    #channel index -> circuit, circuit group
+    channel_circuit = np.full(len(channel_list),-1,dtype=np.int8)
+    channel_circuit_group = np.full(len(channel_list),-1,dtype=np.int8)
+    for channel,circuit in hd_constants.circuit_typ_dict.items():
+        idx = channel_index[channel]
+        channel_circuit[idx] = circuit_names.index(circuit)
+        channel_circuit_group[idx] = circuit_group_names.index(
+            hd_constants.circuit_group_typ_dict[circuit])
+
+    #channel index -> awareness stream, stream group (streams consist of two channels)
+    channel_stream = np.full(len(channel_list),-1,dtype=np.int8)
+    channel_stream_group = np.full(len(channel_list),-1,dtype=np.int8)
+    for gates,stream in hd_constants.awareness_stream_dict.items():
+        for channel in (gates[:2],gates[2:]):
+            idx = channel_index[channel]
+            channel_stream[idx] = stream_names.index(stream)
+            channel_stream_group[idx] = stream_group_names.index(
+                hd_constants.awareness_stream_group_dict[stream])
+
+    return {"channel_list":channel_list,
+            "channel_index":channel_index,
+            "circuit_names":circuit_names,
+            "circuit_group_names":circuit_group_names,
+            "stream_names":stream_names,
+            "stream_group_names":stream_group_names,
+            "channel_circuit":channel_circuit,
+            "channel_circuit_group":channel_circuit_group,
+            "channel_stream":channel_stream,
+            "channel_stream_group":channel_stream_group,
+           }
+
+#channel index and circuitry lookup tables
+channel_tables = calc_channel_index_tables(hd_constants.GATES_CHAKRA_DICT)
+
+def _one_hot(codes,size):
+    '''(n_channels x size) matrix, row i has a one at column codes[i] (none for -1)'''
+    matrix = np.zeros((len(codes),size),dtype=np.int32)
+    valid = codes >= 0
+    matrix[np.arange(len(codes))[valid],codes[valid]] = 1
+    return matrix
+
+#channel -> category count matrices for batch classification
+circuitry_matrices = {
+    "circuits":(channel_tables["circuit_names"],
+                _one_hot(channel_tables["channel_circuit"],
+                         len(channel_tables["circuit_names"]))),
+    "circuit groups":(channel_tables["circuit_group_names"],
+                      _one_hot(channel_tables["channel_circuit_group"],
+                               len(channel_tables["circuit_group_names"]))),
+    "awareness streams":(channel_tables["stream_names"],
+                         _one_hot(channel_tables["channel_stream"],
+                                  len(channel_tables["stream_names"]))),
+    "stream groups":(channel_tables["stream_group_names"],
+                     _one_hot(channel_tables["channel_stream_group"],
+                              len(channel_tables["stream_group_names"]))),
+}
+
+def get_channel_vector(active_channels_dict):
+    '''
+    convert active channels to a boolean vector over the fixed channel index
+    Args:
+        active_channels_dict(dict): all active channels, keys: ["label","planets","gate","ch_gate"]
+    Return:
+        channel_vector(np.array): bool, len 36, True where channel is defined
+    '''
+    channel_vector = np.zeros(len(channel_tables["channel_list"]),dtype=bool)
+    idx = channel_tables["channel_index"][
+        np.asarray(active_channels_dict["gate"],dtype=int),
+        np.asarray(active_channels_dict["ch_gate"],dtype=int)
+    ]
+    channel_vector[idx[idx>=0]] = True
+    return channel_vector
+
+def calc_circuitry_array(channel_matrix):
+    '''
+    batch classification of many charts for population statistics
+    Args:
+        channel_matrix(np.array): shape (n_charts,36), bool/int,
+                                  e.g. stacked output of get_channel_vector
+    Return:
+        circuitry(dict): keys: "circuits","circuit groups","awareness streams","stream groups"
+                         values: (names(list), counts(np.array) shape (n_charts,len(names)))
+    '''
+    channel_matrix = np.atleast_2d(np.asarray(channel_matrix,dtype=np.int32))
+    return {key:(names,channel_matrix @ matrix)
+            for key,(names,matrix) in circuitry_matrices.items()}
+
+def get_circuitry(active_channels_dict):
+    '''
+    circuit, circuit group, awareness stream and stream group classification of active channels
+    each category is mapped to the number of defined channels belonging to it
+    Args:
+        active_channels_dict(dict): all active channels, keys: ["label","planets","gate","ch_gate"]
+    Return:
+        circuitry(dict): keys: "circuits","circuit groups","awareness streams","stream groups"
+                         e.g. {"circuits":{"Knowledge":2,"Ego":1},...}
+    '''
+    counts = calc_circuitry_array(get_channel_vector(active_channels_dict))
+    return {key:{name:int(count) for name,count in zip(names,values[0]) if count}
+            for key,(names,values) in counts.items()}
+
 def calc_full_channel_meaning_dict():
     """from meaning dict create full dict (add keys in reversed ordere.g. (1,2)/(2,1))"""
     meaning_dict = hd_constants.CHANNEL_MEANING_DICT
@@ -723,6 +888,58 @@ def remove_extras(original_dict):
 
     return reduced_dict
         
+def check_timestamp(timestamp):
+    '''
+    sanity check for input format and values of a timestamp
+    (year,month,day,hour,minute,second,tz_offset), raises ValueError
+    '''
+    if ((len(timestamp)!=7)
+    | (len([elem for elem in timestamp[1:6] if elem <0]))
+    | (timestamp[1]>12) 
+    | (timestamp[2]>31) 
+    | (timestamp[3]>24) 
+    | (timestamp[4]>60) 
+    | (timestamp[5]>60)
+        ):
+        sys.stderr.write("Format should be:\
+        Year,Month,day,hour,min,sec,timezone_offset,\nIs date correct?")
+        raise ValueError('check timestamp Format') 
+
+def calc_gate_dict_features(date_to_gate_dict,channel_meaning=False):
+    '''
+    calc key hd_features from an already computed date_to_gate_dict
+    (output of hd_features.birth_creat_date_to_gate)
+    Args:
+        date_to_gate_dict(dict): keys->[planets,label,longitude,gate,line,color,tone,base]
+        channel_meaning(bool): add meaning to channels
+    Return:
+        same tuple as calc_single_hd_features
+    '''
+    active_channels_dict,active_chakras = get_channels_and_active_chakras(
+        remove_extras(date_to_gate_dict),
+        meaning=channel_meaning)
+    typ = get_typ(active_channels_dict,active_chakras)
+    auth = get_auth(active_chakras,active_channels_dict)
+    inc_cross = get_inc_cross(date_to_gate_dict)
+    strategy = hd_constants.STRATEGIES[typ]
+    theme = hd_constants.THEMES[typ]
+    profile = get_profile(date_to_gate_dict)
+    split = get_split(active_channels_dict,active_chakras)
+    circuitry = get_circuitry(active_channels_dict)
+    active_chakras = [hd_constants.CHAKRA_NAMES[c] for c in active_chakras]
+
+    return (typ,                   # 0
+            auth,                  # 1
+            inc_cross,             # 2
+            profile,               # 3
+            split,                 # 4
+            strategy,              # 5
+            theme,                 # 6
+            date_to_gate_dict,     # 7
+            active_chakras,        # 8
+            active_channels_dict,  # 9
+            circuitry)             # 10
+
 def calc_single_hd_features(timestamp,
                             location,
                             report=False,
@@ -757,52 +974,44 @@ def calc_single_hd_features(timestamp,
     incarnation cross(tuple): format ((1,2),(3,4))
     profile(tuple): format (1,2)
     active_channels(dict):  keys [planets,labels,gates and channel gates]
+    circuitry(dict): circuits, circuit groups, awareness streams and stream groups of active channels
     '''
     ####santity check for input format and values
-    if ((len(timestamp)!=7)
-    | (len([elem for elem in timestamp[1:6] if elem <0]))
-    | (timestamp[1]>12) 
-    | (timestamp[2]>31) 
-    | (timestamp[3]>24) 
-    | (timestamp[4]>60) 
-    | (timestamp[5]>60)
-        ):
-        sys.stderr.write("Format should be:\
-        Year,Month,day,hour,min,sec,timezone_offset,\nIs date correct?")
-        raise ValueError('check timestamp Format') 
+    check_timestamp(timestamp)
+
+    instance = hd_features(*timestamp, *location) #create instance of hd_features class
+
+    if day_chart_only:
+        date_to_gate_dict = instance.day_chart()
     else:
-        instance = hd_features(*timestamp, *location) #create instance of hd_features class
-
-        if day_chart_only:
-            date_to_gate_dict = instance.day_chart(instance.time_stamp)
-        else:
-            date_to_gate_dict = instance.birth_creat_date_to_gate()
-            active_channels_dict,active_chakras = get_channels_and_active_chakras(
-                remove_extras(date_to_gate_dict),
-                meaning=channel_meaning)
-            typ = get_typ(active_channels_dict,active_chakras)
-            auth = get_auth(active_chakras,active_channels_dict)
-            inc_cross = get_inc_cross(date_to_gate_dict)
-            strategy = hd_constants.STRATEGIES[typ]
-            theme = hd_constants.THEMES[typ]
-            profile = get_profile(date_to_gate_dict)
-            split = get_split(active_channels_dict,active_chakras)
-            variables = get_variables(date_to_gate_dict)
-            active_chakras = [hd_constants.CHAKRA_NAMES[c] for c in active_chakras]
-
-            if report == True:
-                print("birth date: {}".format(timestamp[:-2]))
-                print("create date: {}".format(instance.create_date))
-                print("energie-type: {}".format(typ))
-                print("inner authority: {}".format(auth))
-                print("inc. cross: {}".format(inc_cross))
-                print("profile: {}".format(profile))
-                print("active chakras: {}".format(active_chakras))
-                print("split: {}".format(split))
-                print("variables: {}".format(variables))
-                print(date_to_gate_dict)
-                print(active_channels_dict)
-         
+        date_to_gate_dict = instance.birth_creat_date_to_gate()
+        (typ,
+         auth,
+         inc_cross,
+         profile,
+         split,
+         strategy,
+         theme,
+         date_to_gate_dict,
+         active_chakras,
+         active_channels_dict,
+         circuitry) = calc_gate_dict_features(date_to_gate_dict,channel_meaning)
+        variables = get_variables(date_to_gate_dict)
+
+        if report == True:
+            print("birth date: {}".format(timestamp[:-2]))
+            print("create date: {}".format(instance.create_date))
+            print("energie-type: {}".format(typ))
+            print("inner authority: {}".format(auth))
+            print("inc. cross: {}".format(inc_cross))
+            print("profile: {}".format(profile))
+            print("active chakras: {}".format(active_chakras))
+            print("split: {}".format(split))
+            print("variables: {}".format(variables))
+            print("circuitry: {}".format(circuitry))
+            print(date_to_gate_dict)
+            print(active_channels_dict)
+     
     if day_chart_only==False:
         return  (typ,                   # 0
                  auth,                  # 1
@@ -813,7 +1022,8 @@ def calc_single_hd_features(timestamp,
                  theme,                 # 6
                  date_to_gate_dict,     # 7
                  active_chakras,        # 8
-                 active_channels_dict)  # 9
+                 active_channels_dict,  # 9
+                 circuitry)             # 10
     else:
         return date_to_gate_dict
 
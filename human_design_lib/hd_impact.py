@@ -0,0 +1,186 @@
+"""
+hd_impact.py
+
+Daily transit impact over all stored charts.
+
+A chart's open half-channels are channels of which it has exactly one gate.
+A transit completes such a channel when the transiting planets activate the
+other gate. The transit gates are computed once (one ephemeris evaluation per
+step for the whole user base); the charts are matched with the inverted gate
+bitmaps of a ChartIndex, so every channel costs two bitmap operations over
+n_charts / 64 words and no ephemeris call per user.
+
+Example (users completed by the transits of one UT day):
+    python -m human_design_lib.hd_impact charts.npz impacts.ndjson --date 2024/03/01
+"""
+
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+
+from human_design_lib import hd_features
+from human_design_lib import hd_transits
+from human_design_lib.hd_index import ChartIndex, ACTIVATION_KEYS, BIT_VALUES, popcount
+
+# Planets whose transits count, the planets that define channels in a chart
+TRANSIT_PLANETS = list(dict.fromkeys(planet for _, planet in ACTIVATION_KEYS))
+
+CHANNEL_LIST = hd_features.channel_tables["channel_list"]
+# Gate bit masks of both gates of every channel (channel order of channel_tables)
+CHANNEL_GATE_A = np.array([1 << (int(a) - 1) for a, _ in CHANNEL_LIST], dtype=np.uint64)
+CHANNEL_GATE_B = np.array([1 << (int(b) - 1) for _, b in CHANNEL_LIST], dtype=np.uint64)
+CHANNEL_NAMES = ["{:02d}{:02d}".format(int(a), int(b)) for a, b in CHANNEL_LIST]
+
+
+def transit_gate_bits(jd_start, jd_end=None, step_hours=1.0, planets=TRANSIT_PLANETS):
+    '''
+    gate bitmask (bit gate-1) of the transiting planets at jd_start, or of
+    every gate they activate from jd_start to jd_end (sampled every
+    step_hours, shorter than the Moon's ~10 hours in a gate)
+    Return:
+        bits(int)
+    '''
+    instants = [jd_start]
+    if jd_end is not None:
+        instants = list(np.arange(jd_start, jd_end, step_hours / 24)) + [jd_end]
+    bits = 0
+    for jdut in instants:
+        for transit in hd_transits.transit_gates(jdut, planets).values():
+            bits |= 1 << (transit["gate"] - 1)
+    return bits
+
+
+def gates_of_bits(bits):
+    '''sorted gates of a gate bitmask'''
+    return [gate for gate in range(1, 65) if bits >> (gate - 1) & 1]
+
+
+def completed_channel_bitmaps(index, transit_bits):
+    '''
+    row bitmaps of the charts whose open half-channel is completed by the
+    transit gates, one per channel the transit can complete
+    Return:
+        dict channel position (channel_tables order) -> bitmap (uint64 words)
+    '''
+    all_rows = index._all_bitmap()
+    bitmaps = {}
+    for channel, (gate_a, gate_b) in enumerate(CHANNEL_LIST):
+        has_a = bool(transit_bits & int(CHANNEL_GATE_A[channel]))
+        has_b = bool(transit_bits & int(CHANNEL_GATE_B[channel]))
+        if not (has_a or has_b):
+            continue
+        chart_a = index.gate_bitmaps[int(gate_a) - 1]
+        chart_b = index.gate_bitmaps[int(gate_b) - 1]
+        bitmap = np.zeros_like(all_rows)
+        if has_b:
+            # The chart has gate a only, the transit brings b
+            bitmap |= chart_a & ~chart_b
+        if has_a:
+            bitmap |= chart_b & ~chart_a
+        bitmaps[channel] = bitmap & all_rows
+    return bitmaps
+
+
+def transit_impacts(index, transit_bits):
+    '''
+    completed channels of every affected chart (vectorized over all charts)
+    Args:
+        index(ChartIndex): stored charts
+        transit_bits(int): transit gate bitmask (transit_gate_bits)
+    Return:
+        chart_ids(np.array): int64, ids of the affected charts
+        channel_bits(np.array): uint64, bit set per completed channel
+                                (channel_tables order)
+    '''
+    completed = np.zeros(index.size, dtype=np.uint64)
+    for channel, bitmap in completed_channel_bitmaps(index, transit_bits).items():
+        rows = np.flatnonzero(np.unpackbits(bitmap.view(np.uint8), bitorder="little"))
+        completed[rows[rows < index.size]] |= BIT_VALUES[channel]
+    affected = np.flatnonzero(completed)
+    return index.chart_ids[affected], completed[affected]
+
+
+def iter_impacts(chart_ids, channel_bits):
+    '''
+    one record per affected chart
+    Return:
+        generator of {"id","channels"}, channels as "GGGG" strings
+    '''
+    for chart_id, bits in zip(chart_ids.tolist(), channel_bits.tolist()):
+        yield {"id": chart_id, "channels": channel_names(bits)}
+
+
+def channel_names(bits):
+    '''channels ("GGGG") of a completed-channel bitmask'''
+    return [CHANNEL_NAMES[c] for c in range(len(CHANNEL_NAMES)) if bits >> c & 1]
+
+
+def write_impacts(f, chart_ids, channel_bits):
+    '''
+    write the NDJSON lines of iter_impacts; the channel part of a line is
+    formatted once per distinct set of completed channels
+    '''
+    patterns, inverse = np.unique(channel_bits, return_inverse=True)
+    suffixes = [', "channels": {}}}\n'.format(json.dumps(channel_names(bits)))
+                for bits in patterns.tolist()]
+    f.writelines('{{"id": {}{}'.format(chart_id, suffixes[pattern])
+                 for chart_id, pattern in zip(chart_ids.tolist(), inverse.tolist()))
+
+
+def run_impact(index_path, out_path, date, whole_day=True, step_hours=1.0):
+    '''
+    compute the transit impact of a UT day (or of its midnight) for all charts
+    of a saved ChartIndex and write one NDJSON line per affected chart
+    Return:
+        summary(dict)
+    '''
+    start = time.perf_counter()
+    index = ChartIndex.load(index_path)
+    loaded = time.perf_counter()
+
+    jd_start = hd_transits.date_to_juldate(date)
+    transit_bits = transit_gate_bits(jd_start, jd_start + 1 if whole_day else None, step_hours)
+    chart_ids, channel_bits = transit_impacts(index, transit_bits)
+    matched = time.perf_counter()
+
+    with open(out_path, "w") as f:
+        write_impacts(f, chart_ids, channel_bits)
+    written = time.perf_counter()
+
+    return {"date": date,
+            "charts": len(index),
+            "affected": len(chart_ids),
+            "completions": int(popcount(channel_bits).sum()),
+            "transit_gates": gates_of_bits(transit_bits),
+            "load_sec": loaded - start,
+            "match_sec": matched - loaded,
+            "write_sec": written - matched}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Charts whose open half-channels the day's transits complete.")
+    parser.add_argument("index", help="Chart index file (ChartIndex.save).")
+    parser.add_argument("out", help="NDJSON output, one line per affected chart.")
+    parser.add_argument("--date", default=time.strftime("%Y/%m/%d", time.gmtime()),
+                        help="UT day in the format YYYY/MM/DD. Defaults to today.")
+    parser.add_argument("--instant", action="store_true",
+                        help="Use the transits at 00:00 UT only instead of the whole day.")
+    parser.add_argument("--step-hours", type=float, default=1.0,
+                        help="Sampling step of the whole-day transits.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    import os
+    import flatlib
+    import swisseph as swe
+
+    # Connect to extra ephemeris files (for Chiron)
+    swe.set_ephe_path(os.path.join(flatlib.PATH_RES, "swefiles"))
+    args = parse_args()
+    summary = run_impact(args.index, args.out, args.date,
+                         whole_day=not args.instant, step_hours=args.step_hours)
+    sys.stderr.write(json.dumps(summary) + "\n")
@@ -0,0 +1,258 @@
+"""
+hd_index.py
+
+Inverted gate/channel/center index over stored charts.
+
+Every chart is stored as one row of columnar arrays:
+    gate_bits     uint64, bit (gate - 1) set for every activated gate
+    channel_bits  uint64, bit set for every defined channel (channel index of
+                  hd_features.channel_tables)
+    center_bits   uint16, bit set for every defined center (order of CHAKRA_LIST)
+    activations   uint8 (n_charts, 26), gate of each personality/design planet
+                  in the order of hd_features.remove_extras
+On top of the rows, one bitmap over all rows is kept per gate, channel and
+center. Boolean queries are answered with bitmap intersections/unions, and
+inserts only set bits, so the index can grow incrementally.
+
+Example:
+    index = ChartIndex()
+    index.insert(user_id, *hd_features.calc_single_hd_features(ts, loc)[7:10])
+    index.query(all_of=[("channel", (34, 20)), ("activation", "des", "Sun", 1)])
+"""
+
+import numpy as np
+
+from human_design_lib import hd_constants
+from human_design_lib import hd_features
+
+N_GATES = 64
+N_CHANNELS = len(hd_features.channel_tables["channel_list"])
+N_CENTERS = len(hd_constants.CHAKRA_LIST)
+
+# (label, planet) of the activations that define gates and channels
+ACTIVATION_KEYS = [(label, planet)
+                   for label in ("prs", "des")
+                   for planet in list(hd_constants.SWE_PLANET_DICT)[:13]]
+ACTIVATION_INDEX = {key: idx for idx, key in enumerate(ACTIVATION_KEYS)}
+
+CENTER_INDEX = {chakra: idx for idx, chakra in enumerate(hd_constants.CHAKRA_LIST)}
+CENTER_INDEX.update({hd_constants.CHAKRA_NAMES[chakra]: idx
+                     for chakra, idx in list(CENTER_INDEX.items())})
+
+# Bit i of a uint64 word
+BIT_VALUES = np.left_shift(np.uint64(1), np.arange(64, dtype=np.uint64))
+
+
+def popcount(words):
+    '''
+    vectorized popcount of uint64 words
+    '''
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words)
+    # numpy < 2.0: count through the bytes of each word
+    byte_counts = np.unpackbits(np.ascontiguousarray(words).view(np.uint8)).reshape(-1, 64)
+    return byte_counts.sum(axis=1).reshape(np.shape(words))
+
+
+def chart_bitsets(date_to_gate_dict, active_channels_dict, active_chakras):
+    '''
+    convert one chart to its index row
+    Args:
+        date_to_gate_dict(dict): output of hd_feature class (full, incl. extras)
+        active_channels_dict(dict): output of get_channels_and_active_chakras
+        active_chakras(iterable): chakra codes ("SL") or names ("Sacral")
+    Return:
+        gate_bits(int), channel_bits(int), center_bits(int), activations(np.array)
+    '''
+    reduced = hd_features.remove_extras(date_to_gate_dict)
+    activations = np.asarray(reduced["gate"], dtype=np.uint8)
+
+    gate_bits = 0
+    for gate in activations:
+        gate_bits |= 1 << (int(gate) - 1)
+
+    channel_bits = 0
+    for idx in np.flatnonzero(hd_features.get_channel_vector(active_channels_dict)):
+        channel_bits |= 1 << int(idx)
+
+    center_bits = 0
+    for chakra in active_chakras:
+        center_bits |= 1 << CENTER_INDEX[chakra]
+
+    return gate_bits, channel_bits, center_bits, activations
+
+
+def channel_bit(channel):
+    '''bit position of a channel given as (gate, gate) in any order'''
+    idx = int(hd_features.channel_tables["channel_index"][channel])
+    if idx < 0:
+        raise ValueError("{} is not a channel".format(channel))
+    return idx
+
+
+class ChartIndex:
+    '''
+    Columnar chart store with inverted bitmap indexes per gate, channel and center.
+    '''
+    def __init__(self, capacity=1024):
+        capacity = max(64, -(-int(capacity) // 64) * 64)
+        self.size = 0
+        self.chart_ids = np.zeros(capacity, dtype=np.int64)
+        self.gate_bits = np.zeros(capacity, dtype=np.uint64)
+        self.channel_bits = np.zeros(capacity, dtype=np.uint64)
+        self.center_bits = np.zeros(capacity, dtype=np.uint16)
+        self.activations = np.zeros((capacity, len(ACTIVATION_KEYS)), dtype=np.uint8)
+        n_words = capacity // 64
+        self.gate_bitmaps = np.zeros((N_GATES, n_words), dtype=np.uint64)
+        self.channel_bitmaps = np.zeros((N_CHANNELS, n_words), dtype=np.uint64)
+        self.center_bitmaps = np.zeros((N_CENTERS, n_words), dtype=np.uint64)
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def capacity(self):
+        return len(self.chart_ids)
+
+    def _grow(self, min_capacity):
+        '''double capacity (multiple of 64 rows) until min_capacity fits'''
+        capacity = self.capacity
+        while capacity < min_capacity:
+            capacity *= 2
+        if capacity == self.capacity:
+            return
+        n_words = capacity // 64
+        for name in ("chart_ids", "gate_bits", "channel_bits", "center_bits", "activations"):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+        for name in ("gate_bitmaps", "channel_bitmaps", "center_bitmaps"):
+            old = getattr(self, name)
+            new = np.zeros((old.shape[0], n_words), dtype=np.uint64)
+            new[:, :old.shape[1]] = old
+            setattr(self, name, new)
+
+    def insert_rows(self, chart_ids, gate_bits, channel_bits, center_bits, activations):
+        '''
+        append many precomputed rows (vectorized), returns their row numbers
+        '''
+        chart_ids = np.atleast_1d(np.asarray(chart_ids, dtype=np.int64))
+        n = len(chart_ids)
+        start = self.size
+        self._grow(start + n)
+        rows = np.arange(start, start + n)
+        self.chart_ids[rows] = chart_ids
+        self.gate_bits[rows] = np.asarray(gate_bits, dtype=np.uint64)
+        self.channel_bits[rows] = np.asarray(channel_bits, dtype=np.uint64)
+        self.center_bits[rows] = np.asarray(center_bits, dtype=np.uint16)
+        self.activations[rows] = np.asarray(activations, dtype=np.uint8).reshape(n, -1)
+        self.size = start + n
+
+        # Set the row bits in the inverted bitmaps of every key present in the row
+        words = rows >> 6
+        row_bits = BIT_VALUES[rows & 63]
+        for bitmaps, values, n_keys in ((self.gate_bitmaps, self.gate_bits[rows], N_GATES),
+                                        (self.channel_bitmaps, self.channel_bits[rows], N_CHANNELS),
+                                        (self.center_bitmaps,
+                                         self.center_bits[rows].astype(np.uint64), N_CENTERS)):
+            for key in range(n_keys):
+                has_key = (values & BIT_VALUES[key]) != 0
+                if has_key.any():
+                    np.bitwise_or.at(bitmaps[key], words[has_key], row_bits[has_key])
+        return rows
+
+    def insert(self, chart_id, date_to_gate_dict, active_chakras, active_channels_dict):
+        '''
+        insert one chart, arguments in the order of calc_single_hd_features()[7:10]
+        Return:
+            row(int): row number of the chart
+        '''
+        gate_bits, channel_bits, center_bits, activations = chart_bitsets(
+            date_to_gate_dict, active_channels_dict, active_chakras)
+        return int(self.insert_rows([chart_id], [gate_bits], [channel_bits],
+                                    [center_bits], [activations])[0])
+
+    def _all_bitmap(self):
+        '''bitmap with a bit for every stored row'''
+        n_words = self.capacity // 64
+        bitmap = np.zeros(n_words, dtype=np.uint64)
+        full_words, rest = divmod(self.size, 64)
+        bitmap[:full_words] = np.uint64(0xFFFFFFFFFFFFFFFF)
+        if rest:
+            bitmap[full_words] = BIT_VALUES[:rest].sum(dtype=np.uint64)
+        return bitmap
+
+    def _rows_to_bitmap(self, mask):
+        '''pack a boolean row mask (len size) into a bitmap'''
+        padded = np.zeros(self.capacity, dtype=bool)
+        padded[:self.size] = mask
+        return np.packbits(padded, bitorder="little").view(np.uint64)
+
+    def bitmap(self, term):
+        '''
+        bitmap of rows matching a single term:
+            ("gate", 1)
+            ("channel", (34, 20))
+            ("center", "SL") or ("center", "Sacral")
+            ("activation", "des", "Sun", 1)   design Sun in gate 1
+        '''
+        kind = term[0]
+        if kind == "gate":
+            return self.gate_bitmaps[term[1] - 1]
+        elif kind == "channel":
+            return self.channel_bitmaps[channel_bit(tuple(term[1]))]
+        elif kind == "center":
+            return self.center_bitmaps[CENTER_INDEX[term[1]]]
+        elif kind == "activation":
+            column = ACTIVATION_INDEX[(term[1], term[2])]
+            return self._rows_to_bitmap(self.activations[:self.size, column] == term[3])
+        raise ValueError("unknown query term {}".format(term))
+
+    def query_bitmap(self, all_of=(), any_of=(), none_of=()):
+        '''
+        bitmap of rows matching every term of all_of, at least one term of
+        any_of (if given) and no term of none_of
+        '''
+        result = self._all_bitmap()
+        for term in all_of:
+            result &= self.bitmap(term)
+        if any_of:
+            union = np.zeros_like(result)
+            for term in any_of:
+                union |= self.bitmap(term)
+            result &= union
+        for term in none_of:
+            result &= ~self.bitmap(term)
+        return result
+
+    def count(self, all_of=(), any_of=(), none_of=()):
+        '''number of charts matching the query'''
+        return int(popcount(self.query_bitmap(all_of, any_of, none_of)).sum())
+
+    def query(self, all_of=(), any_of=(), none_of=()):
+        '''
+        chart ids matching the query (see query_bitmap)
+        Return:
+            chart_ids(np.array): int64, in insertion order
+        '''
+        bitmap = self.query_bitmap(all_of, any_of, none_of)
+        rows = np.flatnonzero(np.unpackbits(bitmap.view(np.uint8), bitorder="little"))
+        return self.chart_ids[rows[rows < self.size]]
+
+    def save(self, path):
+        '''store rows in a compressed numpy archive, bitmaps are rebuilt on load'''
+        np.savez_compressed(path,
+                            chart_ids=self.chart_ids[:self.size],
+                            gate_bits=self.gate_bits[:self.size],
+                            channel_bits=self.channel_bits[:self.size],
+                            center_bits=self.center_bits[:self.size],
+                            activations=self.activations[:self.size])
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            index = cls(capacity=len(data["chart_ids"]))
+            index.insert_rows(data["chart_ids"], data["gate_bits"], data["channel_bits"],
+                              data["center_bits"], data["activations"])
+        return index
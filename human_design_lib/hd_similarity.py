@@ -0,0 +1,212 @@
+"""
+hd_similarity.py
+
+Nearest-neighbour search over bit-packed chart vectors.
+
+A chart vector is 16 uint64 words, split into segments:
+    prs_gates   64 bits   gates activated by personality planets
+    des_gates   64 bits   gates activated by design planets
+    prs_lines  384 bits   gate.line activated by personality planets
+    des_lines  384 bits   gate.line activated by design planets
+    centers      9 bits   defined centers (order of CHAKRA_LIST)
+    channels    36 bits   defined channels (hd_features.channel_tables)
+Distances are computed block by block with xor/and/or and a vectorized
+popcount per segment, then combined with per-segment weights. A million
+charts are 128 MB and one query scans them in a few tens of milliseconds.
+
+Example:
+    index = SimilarityIndex()
+    index.add(user_id, chart_vector(*hd_features.calc_single_hd_features(ts, loc)[7:10]))
+    index.search(query_vector, k=10, metric="jaccard", weights={"channels": 3})
+"""
+
+import numpy as np
+
+from human_design_lib import hd_features
+from human_design_lib.hd_index import popcount, CENTER_INDEX
+
+# Segment name -> (first word, end word)
+SEGMENTS = {"prs_gates": (0, 1),
+            "des_gates": (1, 2),
+            "prs_lines": (2, 8),
+            "des_lines": (8, 14),
+            "centers": (14, 15),
+            "channels": (15, 16)}
+N_WORDS = 16
+DEFAULT_WEIGHTS = {name: 1.0 for name in SEGMENTS}
+BLOCK_SIZE = 65536
+
+
+def _int_to_words(value, n_words):
+    '''split a python int bitset into little-endian uint64 words'''
+    return [(value >> (64 * i)) & 0xFFFFFFFFFFFFFFFF for i in range(n_words)]
+
+
+def chart_vector(date_to_gate_dict, active_chakras, active_channels_dict):
+    '''
+    bit-packed vector of one chart, arguments in the order of
+    calc_single_hd_features()[7:10]
+    Return:
+        vector(np.array): uint64, len N_WORDS
+    '''
+    reduced = hd_features.remove_extras(date_to_gate_dict)
+    gates = {"prs": 0, "des": 0}
+    lines = {"prs": 0, "des": 0}
+    for label, gate, line in zip(reduced["label"], reduced["gate"], reduced["line"]):
+        gates[label] |= 1 << (int(gate) - 1)
+        lines[label] |= 1 << ((int(gate) - 1) * 6 + int(line) - 1)
+
+    centers = 0
+    for chakra in active_chakras:
+        centers |= 1 << CENTER_INDEX[chakra]
+
+    channels = 0
+    for idx in np.flatnonzero(hd_features.get_channel_vector(active_channels_dict)):
+        channels |= 1 << int(idx)
+
+    words = ([gates["prs"], gates["des"]]
+             + _int_to_words(lines["prs"], 6)
+             + _int_to_words(lines["des"], 6)
+             + [centers, channels])
+    return np.array(words, dtype=np.uint64)
+
+
+def segment_counts(words):
+    '''
+    sum popcount per segment
+    Args:
+        words(np.array): uint64, shape (n, N_WORDS)
+    Return:
+        counts(np.array): shape (n, len(SEGMENTS))
+    '''
+    bits = popcount(words).astype(np.int32)
+    return np.stack([bits[:, start:end].sum(axis=1) for start, end in SEGMENTS.values()], axis=1)
+
+
+def weighted_hamming(block, query, word_weights):
+    '''weighted number of differing bits'''
+    return popcount(block ^ query) @ word_weights
+
+
+def weighted_jaccard(block, query, word_weights):
+    '''1 - weighted |intersection| / weighted |union|'''
+    intersection = popcount(block & query) @ word_weights
+    union = popcount(block | query) @ word_weights
+    return 1.0 - intersection / np.maximum(union, 1e-12)
+
+
+# Pluggable distances: fn(block(n, N_WORDS), query(N_WORDS,), word_weights(N_WORDS,)) -> (n,)
+DISTANCES = {"hamming": weighted_hamming,
+             "jaccard": weighted_jaccard}
+
+
+def register_distance(name, fn):
+    '''add a distance function usable as metric=name in SimilarityIndex.search'''
+    DISTANCES[name] = fn
+
+
+def word_weights(weights=None):
+    '''
+    per-word weights from segment weights (dict, missing segments default to 1),
+    so a weighted popcount is one matrix-vector product
+    '''
+    merged = {**DEFAULT_WEIGHTS, **(weights or {})}
+    unknown = set(merged) - set(SEGMENTS)
+    if unknown:
+        raise ValueError("unknown segments {}".format(sorted(unknown)))
+    result = np.zeros(N_WORDS, dtype=np.float32)
+    for name, (start, end) in SEGMENTS.items():
+        result[start:end] = merged[name]
+    return result
+
+
+class SimilarityIndex:
+    '''
+    Store of chart vectors with blocked top-k search.
+    '''
+    def __init__(self, capacity=1024):
+        self.size = 0
+        self.chart_ids = np.zeros(capacity, dtype=np.int64)
+        self.vectors = np.zeros((capacity, N_WORDS), dtype=np.uint64)
+
+    def __len__(self):
+        return self.size
+
+    def _grow(self, min_capacity):
+        capacity = max(len(self.chart_ids), 1)
+        while capacity < min_capacity:
+            capacity *= 2
+        if capacity == len(self.chart_ids):
+            return
+        chart_ids = np.zeros(capacity, dtype=np.int64)
+        vectors = np.zeros((capacity, N_WORDS), dtype=np.uint64)
+        chart_ids[:self.size] = self.chart_ids[:self.size]
+        vectors[:self.size] = self.vectors[:self.size]
+        self.chart_ids, self.vectors = chart_ids, vectors
+
+    def add_many(self, chart_ids, vectors):
+        '''append many charts, vectors shape (n, N_WORDS)'''
+        chart_ids = np.atleast_1d(np.asarray(chart_ids, dtype=np.int64))
+        vectors = np.asarray(vectors, dtype=np.uint64).reshape(len(chart_ids), N_WORDS)
+        self._grow(self.size + len(chart_ids))
+        self.chart_ids[self.size:self.size + len(chart_ids)] = chart_ids
+        self.vectors[self.size:self.size + len(chart_ids)] = vectors
+        self.size += len(chart_ids)
+
+    def add(self, chart_id, vector):
+        self.add_many([chart_id], [vector])
+
+    def search(self, query, k=10, metric="hamming", weights=None, block_size=BLOCK_SIZE):
+        '''
+        k nearest stored charts to query
+        Parameters
+        ----------
+        query : np.array
+            Chart vector (chart_vector).
+        k : int
+            Number of results.
+        metric : str
+            Name of a distance in DISTANCES.
+        weights : dict
+            Segment name -> weight, missing segments default to 1.
+
+        Returns
+        -------
+        list[tuple[int, float]]
+            (chart_id, distance), nearest first.
+        '''
+        distance = DISTANCES[metric]
+        weights = word_weights(weights)
+        query = np.asarray(query, dtype=np.uint64)
+        best_rows = np.empty(0, dtype=np.int64)
+        best_dist = np.empty(0, dtype=np.float64)
+
+        for start in range(0, self.size, block_size):
+            block = self.vectors[start:min(start + block_size, self.size)]
+            dist = distance(block, query, weights)
+            # Keep the block's k best, then merge with the running best
+            if len(dist) > k:
+                keep = np.argpartition(dist, k)[:k]
+            else:
+                keep = np.arange(len(dist))
+            best_rows = np.concatenate([best_rows, keep + start])
+            best_dist = np.concatenate([best_dist, dist[keep]])
+            if len(best_dist) > k:
+                keep = np.argpartition(best_dist, k)[:k]
+                best_rows, best_dist = best_rows[keep], best_dist[keep]
+
+        order = np.argsort(best_dist, kind="stable")
+        return [(int(self.chart_ids[row]), float(dist))
+                for row, dist in zip(best_rows[order], best_dist[order])]
+
+    def save(self, path):
+        np.savez_compressed(path,
+                            chart_ids=self.chart_ids[:self.size],
+                            vectors=self.vectors[:self.size])
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            index = cls(capacity=max(len(data["chart_ids"]), 1))
+            index.add_many(data["chart_ids"], data["vectors"])
+        return index
@@ -0,0 +1,121 @@
+"""
+hd_transits.py
+
+Transit (sky) positions in gates and gate ingress events over time ranges.
+
+All functions work on julian days (UT) and are generators where they cover a
+range, so callers can stream results of any length with constant memory.
+"""
+
+import swisseph as swe
+
+from human_design_lib import hd_constants
+from human_design_lib import hd_ephemeris
+from human_design_lib.hd_features import lon_to_gate
+
+PLANETS = list(hd_constants.SWE_PLANET_DICT)
+
+
+def planet_lon(jdut, planet):
+    '''
+    ecliptic longitude of a planet in SWE_PLANET_DICT
+    Earth and South Node are opposite of Sun and North Node
+    '''
+    long = hd_ephemeris.calc_ut(jdut, hd_constants.SWE_PLANET_DICT[planet])[0][0]
+    if planet in ("Earth", "South_Node"):
+        long = (long + 180) % 360
+    return long
+
+
+def transit_gates(jdut, planets=PLANETS):
+    '''
+    gate and line of every planet at one instant
+    Args:
+        jdut(float): julian day (UT)
+        planets(list): planet names of SWE_PLANET_DICT
+    Return:
+        transits(dict): planet -> {"lon","gate","line"}
+    '''
+    transits = {}
+    for planet in planets:
+        long = planet_lon(jdut, planet)
+        gate, line, _, _, _ = lon_to_gate(long)
+        transits[planet] = {"lon": long, "gate": gate, "line": line}
+    return transits
+
+
+def date_to_juldate(date):
+    '''
+    "YYYY/MM/DD" or "YYYY/MM/DD HH:MM" (UT) -> julian day
+    '''
+    day_part, _, time_part = date.partition(" ")
+    year, month, day = [int(s) for s in day_part.split("/")]
+    hour, minute = [int(s) for s in time_part.split(":")] if time_part else (0, 0)
+    return swe.julday(year, month, day, hour + minute / 60)
+
+
+def juldate_to_iso(jdut):
+    '''julian day (UT) -> "YYYY-MM-DDTHH:MM:SSZ"'''
+    year, month, day, hours = swe.revjul(jdut)
+    seconds = int(round(hours * 3600))
+    if seconds >= 86400:
+        # Rounded up to midnight of the next day
+        year, month, day, _ = swe.revjul(jdut + 0.5 / 86400)
+        seconds = 0
+    return "{:04d}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}Z".format(
+        year, month, day, seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def iter_transits(jd_start, jd_end, step_hours=24.0, planets=PLANETS):
+    '''
+    transit gates at every step in [jd_start, jd_end)
+    Return:
+        generator of {"time","planets"}
+    '''
+    n_steps = int((jd_end - jd_start) * 24 / step_hours)
+    for step in range(n_steps):
+        jdut = jd_start + step * step_hours / 24
+        yield {"time": juldate_to_iso(jdut),
+               "planets": transit_gates(jdut, planets)}
+
+
+def _gate_index(long):
+    '''position of a longitude in IGING_CIRCLE_LIST'''
+    return int(((long + hd_constants.IGING_offset) % 360) / 360 * 64)
+
+
+def iter_gate_ingresses(jd_start, jd_end, planets=PLANETS, step_hours=1.0, precision_sec=1.0):
+    '''
+    times at which planets move into a new gate, in time order
+    the range is sampled every step_hours, changes between two samples are
+    refined by bisection (step_hours must be shorter than the fastest
+    planet's time in a gate, ~10 hours for the Moon)
+    Return:
+        generator of {"time","jd","planet","gate","previous_gate"}
+    '''
+    step = step_hours / 24
+    precision = precision_sec / 86400
+    previous = {planet: _gate_index(planet_lon(jd_start, planet)) for planet in planets}
+    jdut = jd_start
+    while jdut < jd_end:
+        jd_next = min(jdut + step, jd_end)
+        events = []
+        for planet in planets:
+            current = _gate_index(planet_lon(jd_next, planet))
+            if current == previous[planet]:
+                continue
+            low, high = jdut, jd_next
+            while high - low > precision:
+                middle = (low + high) / 2
+                if _gate_index(planet_lon(middle, planet)) == previous[planet]:
+                    low = middle
+                else:
+                    high = middle
+            events.append({"time": juldate_to_iso(high),
+                           "jd": high,
+                           "planet": planet,
+                           "gate": hd_constants.IGING_CIRCLE_LIST[current],
+                           "previous_gate": hd_constants.IGING_CIRCLE_LIST[previous[planet]]})
+            previous[planet] = current
+        yield from sorted(events, key=lambda event: event["jd"])
+        jdut = jd_next
@@ -0,0 +1,344 @@
+"""
+jobs.py
+
+Background batch jobs for the API.
+
+A submitted batch is stored on disk and its id is put on an asyncio queue.
+Worker tasks take jobs from the queue and compute them chunk by chunk in an
+executor, appending each chunk's results to the job's NDJSON file and
+updating its progress. Clients poll the progress and download results
+incrementally. On startup, and periodically afterwards, jobs that were
+queued or running are put back on the queue and continue after the last
+finished chunk.
+
+Several server processes can share the job directory: a job is only run
+by the holder of its lease file, created atomically for every run. The
+owner written in the lease never changes; its heartbeat is the file's
+modification time, touched by a timer task while the job runs. A lease
+whose heartbeat is older than the lease time (its process died or hangs)
+is taken over.
+
+Layout of the job directory:
+    <job_id>/job.json        status and progress
+    <job_id>/lease           owner of the run in progress, heartbeat as mtime
+    <job_id>/input.json      submitted items
+    <job_id>/results.ndjson  one result per line, in input order
+"""
+import asyncio
+import json
+import os
+import time
+import uuid
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# Seconds without heartbeat after which a lease is taken over
+LEASE_SECONDS = 120.0
+
+
+def _write_json(path, content):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(content, f)
+    os.replace(tmp_path, path)
+
+
+class JobStore:
+    """
+    Job state persisted in a local directory.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, job_id, name):
+        return os.path.join(self.directory, job_id, name)
+
+    def create(self, items):
+        job_id = uuid.uuid4().hex
+        os.makedirs(os.path.join(self.directory, job_id))
+        _write_json(self._path(job_id, "input.json"), items)
+        job = {"id": job_id,
+               "status": QUEUED,
+               "total": len(items),
+               "done": 0,
+               "results_bytes": 0,
+               "errors": 0,
+               "created": time.time(),
+               "finished": None}
+        self.save(job)
+        return job
+
+    def save(self, job):
+        _write_json(self._path(job["id"], "job.json"), job)
+
+    def load(self, job_id):
+        """Job state, or None if the job does not exist."""
+        # Job ids are hex strings, reject anything that could leave the directory
+        if not job_id.isalnum():
+            return None
+        try:
+            with open(self._path(job_id, "job.json")) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def items(self, job_id):
+        with open(self._path(job_id, "input.json")) as f:
+            return json.load(f)
+
+    def append_results(self, job, results):
+        """Append results after the last saved offset (drops partial writes of a crash)."""
+        with open(self._path(job["id"], "results.ndjson"), "ab") as f:
+            f.truncate(job["results_bytes"])
+            for result in results:
+                f.write((json.dumps(result) + "\n").encode())
+            f.flush()
+            os.fsync(f.fileno())
+            job["results_bytes"] = f.tell()
+
+    def results(self, job_id, offset=0, limit=None):
+        """Saved results from offset (number of results to skip)."""
+        job = self.load(job_id)
+        results = []
+        path = self._path(job_id, "results.ndjson")
+        if job is None or not os.path.exists(path):
+            return results
+        position = 0
+        with open(path, "rb") as f:
+            for number, line in enumerate(f):
+                position += len(line)
+                if position > job["results_bytes"]:
+                    break
+                if number < offset:
+                    continue
+                if limit is not None and len(results) >= limit:
+                    break
+                results.append(json.loads(line))
+        return results
+
+    def _lease_state(self, path):
+        """(owner, heartbeat age in seconds) of a lease file, None if there is none."""
+        try:
+            with open(path) as f:
+                content = f.read()
+            age = time.time() - os.stat(path).st_mtime
+        except FileNotFoundError:
+            return None
+        try:
+            owner = json.loads(content)["owner"]
+        except (ValueError, KeyError):
+            # Created but not written yet (or never, if its process died): ages like any lease
+            owner = None
+        return owner, age
+
+    def acquire_lease(self, job_id, owner, lease_seconds=LEASE_SECONDS):
+        """
+        Claim a job for owner (unique per run). True if the lease was
+        created, or taken over from a heartbeat older than lease_seconds.
+        """
+        path = self._path(job_id, "lease")
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                state = self._lease_state(path)
+                if state is not None and state[1] < lease_seconds:
+                    return False
+                if state is not None and not self._remove_stale_lease(path, state[0],
+                                                                      lease_seconds):
+                    return False
+                continue
+            with os.fdopen(fd, "w") as f:
+                json.dump({"owner": owner, "pid": os.getpid()}, f)
+            return True
+        return False
+
+    def _remove_stale_lease(self, path, stale_owner, lease_seconds):
+        """Remove a stale lease unless it was replaced or renewed meanwhile."""
+        # Rename is atomic: of several processes taking over, one moves the file
+        moved = "{}.{}".format(path, uuid.uuid4().hex)
+        try:
+            os.rename(path, moved)
+        except FileNotFoundError:
+            return True
+        state = self._lease_state(moved)
+        if state is not None and (state[0] != stale_owner or state[1] < lease_seconds):
+            # A live lease: put it back, unless a new one was created in the meantime
+            try:
+                os.link(moved, path)
+            except FileExistsError:
+                pass
+            os.remove(moved)
+            return False
+        os.remove(moved)
+        return True
+
+    def renew_lease(self, job_id, owner):
+        """
+        Refresh the heartbeat. False if the lease is no longer owner's. Only
+        the modification time is written, so a lease taken over meanwhile
+        keeps its new owner.
+        """
+        path = self._path(job_id, "lease")
+        state = self._lease_state(path)
+        if state is None or state[0] != owner:
+            return False
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def release_lease(self, job_id, owner):
+        path = self._path(job_id, "lease")
+        state = self._lease_state(path)
+        if state is not None and state[0] == owner:
+            os.remove(path)
+
+    def unfinished(self):
+        """Ids of queued or running jobs, oldest first."""
+        jobs = []
+        for job_id in os.listdir(self.directory):
+            job = self.load(job_id)
+            if job is not None and job["status"] in (QUEUED, RUNNING):
+                jobs.append(job)
+        return [job["id"] for job in sorted(jobs, key=lambda job: job["created"])]
+
+
+class JobManager:
+    """
+    Queue and worker tasks for background jobs.
+
+    Parameters
+    ----------
+    store: JobStore
+        Persistence of jobs.
+    compute: callable
+        Function item -> result, run in the executor. Exceptions are stored
+        as {"error": message} results.
+    executor: concurrent.futures.Executor
+        Executor for compute, None for the event loop's default executor.
+    workers: int
+        Number of jobs processed concurrently.
+    chunk_size: int
+        Items computed between two progress updates.
+    lease_seconds: float
+        Heartbeat age after which a job is taken over; unfinished jobs are
+        looked for at this interval and heartbeats renewed four times as often.
+    """
+    def __init__(self, store, compute, executor=None, workers=2, chunk_size=50,
+                 lease_seconds=LEASE_SECONDS):
+        self.store = store
+        self.compute = compute
+        self.executor = executor
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.lease_seconds = lease_seconds
+        self.queue = None
+        self.queued = set()
+        # Jobs run by this manager, requeued ids of them are skipped
+        self.running = set()
+        self.tasks = []
+
+    async def start(self):
+        """Start worker tasks and requeue unfinished jobs."""
+        self.queue = asyncio.Queue()
+        self._requeue()
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self.tasks.append(asyncio.create_task(self._rescan()))
+
+    def _enqueue(self, job_id):
+        if job_id not in self.queued:
+            self.queued.add(job_id)
+            self.queue.put_nowait(job_id)
+
+    def _requeue(self):
+        for job_id in self.store.unfinished():
+            self._enqueue(job_id)
+
+    async def _rescan(self):
+        """Pick up jobs left by stopped processes once their leases are stale."""
+        while True:
+            await asyncio.sleep(self.lease_seconds)
+            self._requeue()
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def submit(self, items):
+        """Store and queue a job. Called on the event loop (the queue is not thread-safe)."""
+        job = await asyncio.get_running_loop().run_in_executor(None, self.store.create, items)
+        self._enqueue(job["id"])
+        return job
+
+    def _compute_chunk(self, items):
+        results = []
+        for item in items:
+            try:
+                results.append(self.compute(item))
+            except Exception as exc:
+                results.append({"error": "{}: {}".format(type(exc).__name__, exc)})
+        return results
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job_id = await self.queue.get()
+            self.queued.discard(job_id)
+            try:
+                # Jobs running here or leased by another run are skipped
+                if job_id in self.running:
+                    continue
+                owner = "{}-{}".format(os.getpid(), uuid.uuid4().hex)
+                if not self.store.acquire_lease(job_id, owner, self.lease_seconds):
+                    continue
+                self.running.add(job_id)
+                heartbeat = asyncio.create_task(self._heartbeat(job_id, owner))
+                try:
+                    await self._run(loop, job_id, heartbeat)
+                finally:
+                    heartbeat.cancel()
+                    self.running.discard(job_id)
+                    self.store.release_lease(job_id, owner)
+            finally:
+                self.queue.task_done()
+
+    async def _heartbeat(self, job_id, owner):
+        """Renew a lease until cancelled; returns when the lease was lost."""
+        while True:
+            await asyncio.sleep(self.lease_seconds / 4)
+            if not self.store.renew_lease(job_id, owner):
+                return
+
+    async def _run(self, loop, job_id, heartbeat):
+        # Loaded after the lease is held: the progress of an earlier owner is kept
+        job = self.store.load(job_id)
+        if job is None or job["status"] not in (QUEUED, RUNNING):
+            return
+        job["status"] = RUNNING
+        self.store.save(job)
+        try:
+            items = self.store.items(job_id)
+            while job["done"] < job["total"]:
+                chunk = items[job["done"]:job["done"] + self.chunk_size]
+                results = await loop.run_in_executor(self.executor, self._compute_chunk, chunk)
+                if heartbeat.done():
+                    # Lease lost (taken over after a stall), the new owner continues the job
+                    return
+                self.store.append_results(job, results)
+                job["done"] += len(results)
+                job["errors"] += sum(1 for result in results if "error" in result)
+                self.store.save(job)
+            job["status"] = DONE
+        except Exception as exc:
+            job["status"] = FAILED
+            job["error"] = "{}: {}".format(type(exc).__name__, exc)
+        job["finished"] = time.time()
+        self.store.save(job)
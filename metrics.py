@@ -0,0 +1,188 @@
+"""
+metrics.py
+
+Low-overhead instrumentation: per-stage timings for the Server-Timing header
+and Prometheus-style metrics for the /metrics endpoint.
+
+Stages are timed with the timed() context manager. Every stage is observed in
+the hda_stage_seconds histogram and, if a request is active in the current
+context (see start_request), appended to the request's Server-Timing entries.
+A stage costs two perf_counter calls, a bisect and a short lock.
+"""
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, value) for key, value in labels) + "}"
+
+
+class Histogram:
+    """
+    Cumulative-bucket histogram with one series per label set.
+    """
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][idx] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help_text),
+                 "# TYPE {} histogram".format(self.name)]
+        with self._lock:
+            series = {key: (list(counts), total, count)
+                      for key, (counts, total, count) in self._series.items()}
+        for key, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append("{}_bucket{} {}".format(
+                    self.name, _label_text(key + (("le", bound),)), cumulative))
+            lines.append("{}_sum{} {}".format(self.name, _label_text(key), total))
+            lines.append("{}_count{} {}".format(self.name, _label_text(key), count))
+        return lines
+
+
+class Counter:
+    """
+    Monotonic counter with one series per label set.
+    """
+    kind = "counter"
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help_text),
+                 "# TYPE {} {}".format(self.name, self.kind)]
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            lines.append("{}{} {}".format(self.name, _label_text(key), value))
+        return lines
+
+
+class Gauge(Counter):
+    """
+    Value that can go up and down.
+    """
+    kind = "gauge"
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = value
+
+
+STAGE_SECONDS = Histogram("hda_stage_seconds", "Duration of calculation stages.")
+REQUEST_SECONDS = Histogram("hda_request_seconds", "Duration of HTTP requests.")
+REQUESTS_IN_FLIGHT = Gauge("hda_requests_in_flight", "HTTP requests being processed.")
+CACHE_REQUESTS = Counter("hda_cache_requests_total", "Cache lookups by cache and result.")
+STARTUP_SECONDS = Gauge("hda_startup_seconds", "Duration of the startup phases of this process.")
+COALESCED_CALLS = Counter("hda_singleflight_calls_total",
+                          "Calls through single-flight groups, by group and role (leader or shared).")
+
+SKY_SUBSCRIBERS = Gauge("hda_sky_subscribers", "WebSocket subscribers of the current sky.")
+
+BREAKER_STATE = Gauge("hda_circuit_breaker_state",
+                      "State of circuit breakers (0 closed, 1 half-open, 2 open).")
+HEDGED_CALLS = Counter("hda_hedged_calls_total",
+                       "Attempts of calls to external services, by call and role (primary or hedge).")
+DEGRADED_RESPONSES = Counter("hda_degraded_responses_total",
+                             "Responses without the location-dependent parts, by reason.")
+
+REGISTRY = [STAGE_SECONDS, REQUEST_SECONDS, REQUESTS_IN_FLIGHT, CACHE_REQUESTS, STARTUP_SECONDS,
+            COALESCED_CALLS, SKY_SUBSCRIBERS, BREAKER_STATE, HEDGED_CALLS, DEGRADED_RESPONSES]
+
+# Server-Timing entries [(stage, seconds)] of the request in the current context
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+def start_request():
+    """
+    Start collecting stage timings for the request in the current context.
+    The returned list is filled by timed() (also from threadpool workers,
+    which run in a copy of the context).
+    """
+    timings = []
+    _request_timings.set(timings)
+    return timings
+
+
+@contextmanager
+def timed(stage):
+    """
+    Time a calculation stage.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((stage, elapsed))
+
+
+def record_cache(cache, hit):
+    """
+    Count a cache lookup, hit rate = hits / (hits + misses).
+    """
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+
+
+def server_timing_header(timings, total=None):
+    """
+    Server-Timing header value, durations in milliseconds.
+    """
+    entries = ["{};dur={:.2f}".format(stage, seconds * 1000) for stage, seconds in timings]
+    if total is not None:
+        entries.append("total;dur={:.2f}".format(total * 1000))
+    return ", ".join(entries)
+
+
+def render_metrics():
+    """
+    All metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
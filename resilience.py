@@ -0,0 +1,243 @@
+"""
+resilience.py
+
+Deadlines, circuit breaking and hedged retries for calls to external services.
+
+A slow provider must not hold request threads: calls run in a small dedicated
+pool and the caller waits at most until its deadline. If the first attempt has
+not answered after a hedge delay (or failed), a second attempt is started and
+the first answer wins. Consecutive failures open a circuit breaker, after
+which callers fail immediately until a probe call succeeds again. A full pool
+also fails immediately instead of queueing behind the slow calls.
+"""
+import concurrent.futures
+import threading
+import time
+
+from metrics import BREAKER_STATE, HEDGED_CALLS
+
+
+class Unavailable(Exception):
+    """The service can not answer in time: deadline exceeded, circuit open or overloaded."""
+
+
+class DeadlineExceeded(Unavailable):
+    pass
+
+
+class CircuitOpen(Unavailable):
+    pass
+
+
+class Overloaded(Unavailable):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker.
+
+    Closed: calls pass. After failure_threshold consecutive failures it opens
+    and rejects calls for reset_seconds, then lets a single probe call through
+    (half-open). The probe's success closes it, its failure opens it again.
+
+    Parameters
+    ----------
+    name: str
+        Name of the breaker in the metrics.
+    failure_threshold: int
+        Consecutive failures that open the breaker.
+    reset_seconds: float
+        Seconds the breaker stays open before a probe.
+    clock: callable
+        Monotonic time, time.monotonic by default.
+    """
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name, failure_threshold=5, reset_seconds=30.0, clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._set_state(self.CLOSED)
+
+    def _set_state(self, state):
+        self._state = state
+        BREAKER_STATE.set(self.STATE_VALUES[state], breaker=self.name)
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == self.OPEN and self.clock() - self._opened_at >= self.reset_seconds:
+                return self.HALF_OPEN
+            return self._state
+
+    def retry_after(self):
+        """Seconds until the next probe is allowed (0 unless open)."""
+        with self._lock:
+            if self._state != self.OPEN:
+                return 0.0
+            return max(0.0, self._opened_at + self.reset_seconds - self.clock())
+
+    def allow(self):
+        """
+        Whether a call may proceed. In the half-open state only one caller
+        (the probe) is allowed until it reports its result.
+        """
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if self.clock() - self._opened_at < self.reset_seconds:
+                    return False
+                self._set_state(self.HALF_OPEN)
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._probing = False
+            if self._state != self.CLOSED:
+                self._set_state(self.CLOSED)
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._opened_at = self.clock()
+                self._set_state(self.OPEN)
+
+    def release(self):
+        """End a call that says nothing about the service: frees the probe slot only."""
+        with self._lock:
+            self._probing = False
+
+    def call(self, function, *args, is_failure=lambda exc: True, is_ignored=lambda exc: False):
+        """
+        Run function(*args) through the breaker.
+
+        Parameters
+        ----------
+        is_failure: callable
+            exception -> whether it counts as a failure of the service. E.g. a
+            "not found" answer is an answer and does not open the breaker.
+        is_ignored: callable
+            exception -> whether it counts neither as failure nor as success,
+            e.g. a local limit rejected the call before the service was asked.
+
+        Raises
+        ------
+        CircuitOpen
+            If the breaker rejects the call.
+        """
+        if not self.allow():
+            raise CircuitOpen("{} unavailable (circuit open)".format(self.name))
+        try:
+            result = function(*args)
+        except BaseException as exc:
+            if is_ignored(exc):
+                self.release()
+            elif is_failure(exc):
+                self.failure()
+            else:
+                self.success()
+            raise
+        self.success()
+        return result
+
+
+class HedgedCaller:
+    """
+    Calls with a deadline and hedged retries on a bounded pool.
+
+    Parameters
+    ----------
+    name: str
+        Name of the calls in the metrics.
+    max_workers: int
+        Concurrent attempts. A call finding all workers busy fails with
+        Overloaded instead of waiting behind them.
+    hedge_after: float
+        Seconds without an answer after which another attempt is started.
+    attempts: int
+        Attempts per call, including the first.
+    is_retryable: callable
+        exception -> whether a failed attempt is retried. Other exceptions
+        are raised right away.
+    """
+    def __init__(self, name, max_workers=8, hedge_after=1.0, attempts=2,
+                 is_retryable=lambda exc: True):
+        self.name = name
+        self.hedge_after = hedge_after
+        self.attempts = attempts
+        self.is_retryable = is_retryable
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(max_workers)
+
+    def _submit(self, function, args, role):
+        if not self._slots.acquire(blocking=False):
+            return None
+        HEDGED_CALLS.inc(call=self.name, role=role)
+        future = self._pool.submit(function, *args)
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def call(self, function, *args, timeout):
+        """
+        Return the first successful result of function(*args).
+
+        Attempts still running at the deadline are abandoned (they finish in
+        the pool, so function should bound its own duration). If every attempt
+        fails or one fails with a non-retryable exception, that exception is
+        raised.
+
+        Raises
+        ------
+        DeadlineExceeded
+            If no attempt succeeded within timeout seconds.
+        Overloaded
+            If no worker was free for the first attempt.
+        """
+        deadline = time.monotonic() + timeout
+        pending = set()
+        started = 0
+        error = None
+        next_hedge = 0.0
+        while True:
+            now = time.monotonic()
+            if started < self.attempts and (not pending or now >= next_hedge):
+                future = self._submit(function, args, "primary" if started == 0 else "hedge")
+                if future is None and started == 0:
+                    raise Overloaded("{} overloaded".format(self.name))
+                started = started + 1 if future is not None else self.attempts
+                if future is not None:
+                    pending.add(future)
+                next_hedge = now + self.hedge_after
+            if not pending:
+                raise error
+            remaining = deadline - now
+            if remaining <= 0:
+                raise DeadlineExceeded("{} did not answer within {:g} s".format(self.name, timeout))
+            wait = remaining if started >= self.attempts else min(remaining, next_hedge - now)
+            done, pending = concurrent.futures.wait(
+                pending, timeout=max(wait, 0), return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+                if not self.is_retryable(error):
+                    raise error
+                # A failed attempt is retried right away
+                next_hedge = 0.0
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
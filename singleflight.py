@@ -0,0 +1,124 @@
+"""
+singleflight.py
+
+Coalescing of identical in-flight calls.
+
+Concurrent calls with the same key share one computation: the first caller
+(the leader) runs the function, callers arriving while it runs wait for its
+result or exception. Nothing is cached, the next call after completion
+computes again. The shared result is the same object for all callers and
+must not be mutated.
+
+Threads use do(), coroutines do_async(); both can wait for the same
+computation, as the in-flight call is a concurrent.futures.Future.
+"""
+import asyncio
+import concurrent.futures
+import threading
+
+from metrics import COALESCED_CALLS
+
+
+class SingleFlight:
+    """
+    A group of coalesced calls.
+
+    Parameters
+    ----------
+    name: str
+        Name of the group in the metrics.
+    timeout: float
+        Default seconds a caller waits for a shared result before TimeoutError.
+        None waits indefinitely.
+    """
+    def __init__(self, name, timeout=None):
+        self.name = name
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._tasks = set()
+
+    def _join(self, key):
+        """The in-flight future of key and whether the caller leads it."""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                COALESCED_CALLS.inc(group=self.name, role="shared")
+                return future, False
+            future = self._calls[key] = concurrent.futures.Future()
+            COALESCED_CALLS.inc(group=self.name, role="leader")
+            return future, True
+
+    def _settle(self, key, future, result=None, exception=None):
+        # Leave the group first, later callers start a new computation
+        with self._lock:
+            del self._calls[key]
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def _run(self, key, future, function, args):
+        try:
+            result = function(*args)
+        except BaseException as exc:
+            self._settle(key, future, exception=exc)
+        else:
+            self._settle(key, future, result)
+
+    def in_flight(self):
+        """Number of computations in flight."""
+        with self._lock:
+            return len(self._calls)
+
+    def do(self, key, function, *args, timeout=None):
+        """
+        Return function(*args), sharing the computation with concurrent calls
+        of the same key.
+
+        The leader runs function in the calling thread, the timeout applies to
+        the callers waiting for it. Exceptions of function are raised in every
+        caller.
+
+        Raises
+        ------
+        TimeoutError
+            If the shared result is not ready within timeout seconds.
+        """
+        future, leader = self._join(key)
+        if leader:
+            self._run(key, future, function, args)
+        try:
+            return future.result(timeout=self.timeout if timeout is None else timeout)
+        except concurrent.futures.TimeoutError:
+            raise TimeoutError("Timed out waiting for {} {!r}".format(self.name, key)) from None
+
+    async def do_async(self, key, function, *args, timeout=None):
+        """
+        Coroutine version of do(). A coroutine function is awaited by the
+        leader, a plain function runs in the event loop's default executor.
+        A caller that times out does not cancel the shared computation.
+        """
+        future, leader = self._join(key)
+        if leader:
+            if asyncio.iscoroutinefunction(function):
+                task = asyncio.ensure_future(self._run_async(key, future, function, args))
+                # Keep a reference until done, the event loop only holds weak ones
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+            else:
+                asyncio.get_running_loop().run_in_executor(
+                    None, self._run, key, future, function, args)
+        try:
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)),
+                                          self.timeout if timeout is None else timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError("Timed out waiting for {} {!r}".format(self.name, key)) from None
+
+    async def _run_async(self, key, future, function, args):
+        try:
+            result = await function(*args)
+        except BaseException as exc:
+            self._settle(key, future, exception=exc)
+        else:
+            self._settle(key, future, result)
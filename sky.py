@@ -0,0 +1,171 @@
+"""
+sky.py
+
+The current sky: transit gates of all planets, shared by every client.
+
+Time is divided into buckets of a configurable length. The sky of a bucket is
+computed once, at the bucket's start time, and cached until the bucket ends,
+so all clients in a bucket get the identical sky (and the same JSON bytes)
+whatever their number. A ticker task computes the sky at each bucket boundary
+and wakes every WebSocket subscriber, which then sends the new sky: one
+ephemeris calculation per tick, independent of the number of subscribers.
+"""
+import asyncio
+import json
+import math
+import sys
+import threading
+import time
+
+from starlette.concurrency import run_in_threadpool
+from starlette.websockets import WebSocketDisconnect
+
+from metrics import timed, SKY_SUBSCRIBERS
+from human_design_lib import hd_transits
+
+# Julian day of the Unix epoch
+UNIX_EPOCH_JD = 2440587.5
+
+# Seconds before the ticker tries again after a failed calculation
+RETRY_SECONDS = 1.0
+
+
+def unix_to_juldate(timestamp):
+    return UNIX_EPOCH_JD + timestamp / 86400
+
+
+class SkyService:
+    """
+    Time-bucketed cache and WebSocket fan-out of the current sky.
+
+    Parameters
+    ----------
+    bucket_seconds: float
+        Length of a bucket. The sky is computed once per bucket.
+    planets: list of str
+        Planets of hd_transits.PLANETS to include.
+    thread_init: callable
+        Called in the calculating thread first (e.g. ephemeris setup).
+    clock: callable
+        Current Unix time, time.time by default.
+    """
+    def __init__(self, bucket_seconds=60, planets=hd_transits.PLANETS, thread_init=None,
+                 clock=time.time):
+        self.bucket_seconds = bucket_seconds
+        self.planets = list(planets)
+        self.thread_init = thread_init
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._latest = None  # (bucket, sky, text)
+        self._changed = None
+        self._ticker = None
+
+    def bucket(self, timestamp=None):
+        """Number of the bucket containing timestamp (Unix time, default now)."""
+        if timestamp is None:
+            timestamp = self.clock()
+        return math.floor(timestamp / self.bucket_seconds)
+
+    def compute(self, bucket):
+        """The sky at the start of a bucket."""
+        if self.thread_init is not None:
+            self.thread_init()
+        start = bucket * self.bucket_seconds
+        jdut = unix_to_juldate(start)
+        with timed("sky"):
+            planets = hd_transits.transit_gates(jdut, self.planets)
+        return {"time": hd_transits.juldate_to_iso(jdut),
+                "expires": hd_transits.juldate_to_iso(unix_to_juldate(start + self.bucket_seconds)),
+                "bucket_seconds": self.bucket_seconds,
+                "planets": planets}
+
+    def current(self):
+        """
+        Sky of the current bucket and its JSON text, computed at most once
+        per bucket (concurrent callers of a new bucket wait for one calculation).
+        """
+        bucket = self.bucket()
+        latest = self._latest
+        if latest is not None and latest[0] >= bucket:
+            return latest[1], latest[2]
+        with self._lock:
+            latest = self._latest
+            if latest is None or latest[0] < bucket:
+                sky = self.compute(bucket)
+                latest = self._latest = (bucket, sky, json.dumps(sky))
+        return latest[1], latest[2]
+
+    def seconds_left(self):
+        """Seconds until the current bucket expires."""
+        return (self.bucket() + 1) * self.bucket_seconds - self.clock()
+
+    # WebSocket fan-out
+
+    async def start(self):
+        self._changed = asyncio.Event()
+        self._ticker = asyncio.create_task(self._tick())
+
+    async def stop(self):
+        if self._ticker is not None:
+            self._ticker.cancel()
+            try:
+                await self._ticker
+            except asyncio.CancelledError:
+                pass
+            self._ticker = None
+
+    async def _tick(self):
+        while True:
+            try:
+                await run_in_threadpool(self.current)
+                self._publish()
+                # Wake up just after the next bucket starts
+                delay = self.seconds_left() + 0.001
+            except Exception as exc:
+                # The ticker must survive a failed calculation, or subscribers
+                # would never get another sky
+                sys.stderr.write("sky: tick failed, retrying in {} s: {}: {}\n".format(
+                    RETRY_SECONDS, type(exc).__name__, exc))
+                delay = min(RETRY_SECONDS, self.seconds_left() + 0.001)
+            await asyncio.sleep(delay)
+
+    def _publish(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def subscribe(self, websocket):
+        """
+        Send the current sky to a WebSocket and every new one until the
+        client disconnects. Messages from the client are ignored.
+        """
+        await websocket.accept()
+        SKY_SUBSCRIBERS.inc()
+        receive = asyncio.ensure_future(websocket.receive())
+        try:
+            sent_bucket = None
+            while True:
+                # Take the event before reading, a publish in between is not missed
+                changed = self._changed
+                latest = self._latest
+                if latest is None:
+                    await run_in_threadpool(self.current)
+                    continue
+                if latest[0] != sent_bucket:
+                    try:
+                        await websocket.send_text(latest[2])
+                    except RuntimeError:
+                        # The socket was closed before the send
+                        break
+                    sent_bucket = latest[0]
+                wait = asyncio.ensure_future(changed.wait())
+                done, _ = await asyncio.wait({receive, wait}, return_when=asyncio.FIRST_COMPLETED)
+                if receive in done:
+                    wait.cancel()
+                    if receive.result()["type"] == "websocket.disconnect":
+                        break
+                    receive = asyncio.ensure_future(websocket.receive())
+        except WebSocketDisconnect:
+            pass
+        finally:
+            receive.cancel()
+            SKY_SUBSCRIBERS.dec()
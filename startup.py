@@ -0,0 +1,108 @@
+"""
+startup.py
+
+One-time process initialization for the API.
+
+The lookup tables (channel, chakra and circuitry tables, the compact code
+table, the Gene Keys) are built when hda_core imports their modules. After
+that prepare() warms the ephemeris with a dummy calculation and freezes the
+heap with gc.freeze(), so the collector no longer touches the objects: after a
+fork they stay in pages shared copy-on-write by all workers.
+
+Servers that fork workers from a preloaded application (e.g. gunicorn
+--preload) should set HDA_PRELOAD=1, which runs preload() when hda_core is
+imported in the master process. Every worker still calls init_worker() from
+the lifespan handler: ephemeris files must not be shared between processes,
+so each worker opens its own and warms them before the first request.
+Request threads connect to the ephemeris on their first calculation
+(hd_ephemeris.init_ephemeris), as the Swiss Ephemeris state is thread-local.
+"""
+import gc
+import os
+import sys
+import time
+
+from metrics import STARTUP_SECONDS
+from human_design_lib.hd_ephemeris import init_ephemeris, close_ephemeris
+
+# Birth used to warm up the calculations (see warm_up)
+WARM_UP_BIRTH = ("1995/02/07", "08:00", "-06:00", (30.5083, -97.6789))
+
+# Seconds of each startup phase of this process
+timings = {}
+
+_prepared = False
+
+
+def record(phase, seconds):
+    timings[phase] = seconds
+    STARTUP_SECONDS.set(seconds, phase=phase)
+
+
+def warm_up():
+    """
+    One full calculation, so files are opened, read into the caches and
+    lazily initialized code paths run before the first request.
+    """
+    from details import compute_details
+    import timezones
+    from fixed_stars import get_fixed_stars
+
+    compute_details(*WARM_UP_BIRTH)
+    # Loads the time zone boundaries, before the heap is frozen
+    timezones.resolve(WARM_UP_BIRTH[3], WARM_UP_BIRTH[0], WARM_UP_BIRTH[1])
+    # Reads the fixed-star catalog
+    get_fixed_stars()
+
+
+def prepare():
+    """
+    Warm up and freeze the heap. Runs at most once per process, after the
+    calculation modules (and so their tables) are imported by hda_core.
+    """
+    global _prepared
+    if _prepared:
+        return
+    start = time.perf_counter()
+    init_ephemeris()
+    warm_up()
+    record("warm_up", time.perf_counter() - start)
+
+    # Move everything alive to the permanent generation
+    gc.collect()
+    gc.freeze()
+    _prepared = True
+
+
+def preload():
+    """
+    prepare() in the master process of a forking server. The master does not
+    serve requests, its ephemeris files are closed before the workers fork.
+    """
+    prepare()
+    close_ephemeris()
+
+
+def init_worker():
+    """
+    Per-process initialization called from the lifespan handler. A worker
+    forked from a preloaded master only opens and warms the ephemeris.
+    Reports the startup times on stderr.
+    """
+    if _prepared:
+        start = time.perf_counter()
+        init_ephemeris()
+        warm_up()
+        record("warm_up", time.perf_counter() - start)
+    else:
+        prepare()
+    sys.stderr.write("startup (pid {}): {}\n".format(
+        os.getpid(), "  ".join("{} {:.1f} ms".format(phase, seconds * 1000)
+                               for phase, seconds in timings.items())))
+
+    import timezones
+
+    if timezones.get_locator() is None:
+        sys.stderr.write("startup (pid {}): warning: no time zone data (set HDA_TZ_BOUNDARIES or "
+                         "install timezonefinder), birth times without UTC offset are taken as "
+                         "UTC\n".format(os.getpid()))
@@ -0,0 +1,57 @@
+"""
+streaming.py
+
+Streaming NDJSON responses built from generator pipelines.
+
+Each item of a generator is computed in the threadpool only when the previous
+line has been sent, so the server never runs ahead of a slow client
+(backpressure), memory stays constant for any output length, and the first
+line is sent as soon as the first item is ready.
+"""
+import json
+
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+_END = object()
+
+
+def _next(iterator, thread_init):
+    if thread_init is not None:
+        thread_init()
+    return next(iterator, _END)
+
+
+async def ndjson_lines(iterable, thread_init=None):
+    """
+    Encode items of a (blocking) iterable as NDJSON lines, advancing it in
+    the threadpool one item at a time. thread_init, if given, is called in
+    the worker thread before each step (e.g. per-thread library state).
+    """
+    iterator = iter(iterable)
+    while True:
+        item = await run_in_threadpool(_next, iterator, thread_init)
+        if item is _END:
+            break
+        yield (json.dumps(item) + "\n").encode()
+
+
+def ndjson_response(iterable, thread_init=None):
+    """
+    StreamingResponse with one JSON line per item of iterable.
+    """
+    return StreamingResponse(ndjson_lines(iterable, thread_init), media_type=NDJSON_MEDIA_TYPE)
+
+
+def iter_safe(function, items):
+    """
+    Apply function to each item, yielding {"error": message} for failed items
+    so one bad item does not end the stream.
+    """
+    for item in items:
+        try:
+            yield function(item)
+        except Exception as exc:
+            yield {"error": "{}: {}".format(type(exc).__name__, exc)}
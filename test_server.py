@@ -2,27 +2,77 @@
 test_server.py
 
 This file contains functions for testing the server.
+
+Single request (prints the response):
+    python test_server.py URL DATE TIME PLACE
+
+Load test (async client, reports latency histogram, throughput and errors):
+    python test_server.py URL --concurrency 32 --duration 60 --warmup 5
+    python test_server.py URL --rate 200 --corpus births.csv
+
+Offline load test of the whole stack (local geocoder stub + local server):
+    python test_server.py http://127.0.0.1:8000/generate-details --geocoder-stub 8765 --serve
 """
 import argparse
-import requests
+import asyncio
+import csv
+import hashlib
 import json
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+# Places used by the random birth generator
+RANDOM_PLACES = ["Round Rock, TX", "New York, NY", "London, United Kingdom",
+                 "Paris, France", "Tokyo, Japan", "Sydney, Australia",
+                 "Buenos Aires, Argentina", "Mumbai, India", "Cape Town, South Africa",
+                 "Reykjavik, Iceland", "Honolulu, HI", "Toronto, Canada"]
+
+# Latency histogram bucket upper bounds in milliseconds
+HISTOGRAM_BOUNDS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, math.inf]
 
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Tests the server with test birth information.")
 
     parser.add_argument("url", help="The URL of the server.")
-    parser.add_argument("date", help="The date of birth. Must be in the format YYYY/MM/DD.")
-    parser.add_argument("time", help="The time of birth. Must be in one of the following forms:"
+    parser.add_argument("date", nargs="?", help="The date of birth. Must be in the format YYYY/MM/DD."
+                        " If date, time and place are given, a single request is sent.")
+    parser.add_argument("time", nargs="?", help="The time of birth. Must be in one of the following forms:"
                         " HH:MM, HH:MM@HH:MM, HH:MM:SS, HH:MM:SS@HH:MM:SS, where '@' can be '-' or '+'.")
-    parser.add_argument("place", help="The location of birth. Must be in the form CITY, STATE, COUNTRY,"
+    parser.add_argument("place", nargs="?", help="The location of birth. Must be in the form CITY, STATE, COUNTRY,"
                         " where STATE and COUNTRY are optional but recommended for disambiguation purposes.")
 
+    load = parser.add_argument_group("load test")
+    load.add_argument("--concurrency", type=int, default=16,
+                      help="Maximum number of requests in flight.")
+    load.add_argument("--rate", type=float, default=None,
+                      help="Open-loop arrival rate in requests/sec (Poisson arrivals). By default"
+                      " every connection sends its next request as soon as the previous one finished.")
+    load.add_argument("--duration", type=float, default=30.0, help="Measured seconds.")
+    load.add_argument("--warmup", type=float, default=5.0, help="Seconds before measuring starts.")
+    load.add_argument("--corpus", default=None,
+                      help="CSV or NDJSON file of births (birthDate, birthTime, birthPlace)."
+                      " Births are generated randomly if omitted.")
+    load.add_argument("--seed", type=int, default=0, help="Seed of the random birth generator.")
+    load.add_argument("--geocoder-stub", type=int, default=None, metavar="PORT",
+                      help="Start a local geocoder stub on PORT.")
+    load.add_argument("--serve", action="store_true",
+                      help="Start the server (uvicorn hda_core:app) on the URL's port,"
+                      " using the geocoder stub if started.")
+
     return parser.parse_args()
 
-if __name__ == "__main__":
-    # Get arguments
-    args = parse_args()
+
+def single_request(args):
+    import requests
 
     # Create test data
     # Example test data
@@ -44,3 +94,265 @@ if __name__ == "__main__":
         else:
             print(part + ": " + str(json_res[part]))
         print("")
+
+
+def load_corpus(path):
+    """Births from a CSV or NDJSON file."""
+    fields = ("birthDate", "birthTime", "birthPlace")
+    with open(path, newline="") as f:
+        if path.endswith((".ndjson", ".jsonl")):
+            rows = [json.loads(line) for line in f if line.strip()]
+        else:
+            rows = list(csv.DictReader(f))
+    return [{field: row[field] for field in fields} for row in rows]
+
+
+def random_births(seed):
+    """Endless generator of random births."""
+    rng = random.Random(seed)
+    while True:
+        offset = rng.choice(range(-10, 13))
+        yield {"birthDate": "{}/{:02d}/{:02d}".format(rng.randint(1920, 2020),
+                                                      rng.randint(1, 12), rng.randint(1, 28)),
+               "birthTime": "{:02d}:{:02d}{}{:02d}:00".format(rng.randint(0, 23), rng.randint(0, 59),
+                                                             "-" if offset < 0 else "+", abs(offset)),
+               "birthPlace": rng.choice(RANDOM_PLACES)}
+
+
+class GeocoderStubHandler(BaseHTTPRequestHandler):
+    """
+    Answers Google geocoding requests with a location derived from the address.
+    """
+    def do_GET(self):
+        query = parse_qs(urlsplit(self.path).query)
+        address = query.get("address", [""])[0]
+        digest = hashlib.sha256(address.encode()).digest()
+        # flatlib's house and diurnal calculations fail at polar latitudes
+        lat = int.from_bytes(digest[:4], "big") / 2**32 * 120 - 60
+        lng = int.from_bytes(digest[4:8], "big") / 2**32 * 360 - 180
+        body = json.dumps({"status": "OK",
+                           "results": [{"geometry": {"location": {"lat": lat, "lng": lng}}}]})
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_geocoder_stub(port):
+    server = ThreadingHTTPServer(("127.0.0.1", port), GeocoderStubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_server(url, stub_port):
+    """Start uvicorn with hda_core:app on the URL's port, wait until it accepts connections."""
+    import socket
+
+    parts = urlsplit(url)
+    env = dict(os.environ)
+    if stub_port is not None:
+        env["MAPS_BASE_URL"] = "http://127.0.0.1:{}".format(stub_port)
+        env.setdefault("MAPS_API_KEY", "AIzaLoadTestStub")  # googlemaps checks the key prefix
+    process = subprocess.Popen([sys.executable, "-m", "uvicorn", "hda_core:app",
+                                "--host", parts.hostname, "--port", str(parts.port or 80),
+                                "--log-level", "warning"],
+                               env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+    for _ in range(100):
+        try:
+            socket.create_connection((parts.hostname, parts.port or 80), timeout=0.1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("Server did not start")
+
+
+class HTTPConnection:
+    """
+    Minimal keep-alive HTTP/1.1 client connection for JSON POST requests.
+    """
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.path = parts.path or "/"
+        self.reader = None
+        self.writer = None
+
+    async def post_json(self, payload):
+        """Send a request, return (status, body bytes)."""
+        body = json.dumps(payload).encode()
+        if self.writer is not None:
+            try:
+                return await self._exchange(body)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # Server closed the idle keep-alive connection, resend on a new one
+                await self.close()
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        return await self._exchange(body)
+
+    async def _exchange(self, body):
+        self.writer.write("POST {} HTTP/1.1\r\nHost: {}:{}\r\nContent-Type: application/json\r\n"
+                          "Content-Length: {}\r\n\r\n".format(self.path, self.host, self.port,
+                                                              len(body)).encode() + body)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed by server")
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, _, value = line.decode().partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get("transfer-encoding") == "chunked":
+            data = b""
+            while True:
+                size = int((await self.reader.readline()).strip(), 16)
+                chunk = await self.reader.readexactly(size + 2)
+                if size == 0:
+                    break
+                data += chunk[:-2]
+        else:
+            data = await self.reader.readexactly(int(headers.get("content-length", 0)))
+
+        if headers.get("connection") == "close":
+            await self.close()
+        return status, data
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class LoadStats:
+    def __init__(self):
+        self.latencies_ms = []
+        self.errors = Counter()
+        self.ok = 0
+
+    def record(self, latency_ms, error=None):
+        self.latencies_ms.append(latency_ms)
+        if error is None:
+            self.ok += 1
+        else:
+            self.errors[error] += 1
+
+    def report(self, duration):
+        total = len(self.latencies_ms)
+        print("requests: {}  ok: {}  errors: {}  throughput: {:.1f} req/s".format(
+            total, self.ok, total - self.ok, total / duration if duration else 0.0))
+        if not total:
+            return
+        latencies = sorted(self.latencies_ms)
+        for label, q in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("p99.9", 0.999)):
+            print("{:>6}: {:10.2f} ms".format(label, latencies[min(total - 1, int(q * total))]))
+        print("{:>6}: {:10.2f} ms".format("max", latencies[-1]))
+
+        print("latency histogram:")
+        counts = Counter()
+        for latency in latencies:
+            counts[next(b for b in HISTOGRAM_BOUNDS_MS if latency <= b)] += 1
+        largest = max(counts.values())
+        for bound in HISTOGRAM_BOUNDS_MS:
+            if counts[bound]:
+                print("  <= {:>7} ms {:8d} {}".format(bound if bound != math.inf else "inf",
+                                                     counts[bound],
+                                                     "#" * max(1, 50 * counts[bound] // largest)))
+        if self.errors:
+            print("errors:")
+            for error, count in self.errors.most_common():
+                print("  {:8d} {}".format(count, error))
+
+
+async def send(connection, birth, stats, measure_from, scheduled):
+    """Send one request; latency counts from the scheduled start (open loop)."""
+    error = None
+    try:
+        status, _ = await connection.post_json(birth)
+        if status != 200:
+            error = "HTTP {}".format(status)
+    except Exception as exc:
+        error = type(exc).__name__
+        await connection.close()
+    latency_ms = (time.perf_counter() - scheduled) * 1000
+    if scheduled >= measure_from:
+        stats.record(latency_ms, error)
+
+
+async def run_load(args, births):
+    stats = LoadStats()
+    start = time.perf_counter()
+    measure_from = start + args.warmup
+    end = measure_from + args.duration
+    connections = asyncio.Queue()
+    for _ in range(args.concurrency):
+        connections.put_nowait(HTTPConnection(args.url))
+
+    async def closed_loop_worker():
+        while time.perf_counter() < end:
+            connection = await connections.get()
+            await send(connection, next(births), stats, measure_from, time.perf_counter())
+            connections.put_nowait(connection)
+
+    async def open_loop_request(scheduled):
+        connection = await connections.get()
+        try:
+            await send(connection, next(births), stats, measure_from, scheduled)
+        finally:
+            connections.put_nowait(connection)
+
+    if args.rate is None:
+        await asyncio.gather(*[closed_loop_worker() for _ in range(args.concurrency)])
+    else:
+        rng = random.Random(args.seed)
+        tasks = []
+        scheduled = start
+        while scheduled < end:
+            scheduled += rng.expovariate(args.rate)
+            await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+            tasks.append(asyncio.create_task(open_loop_request(scheduled)))
+            tasks = [task for task in tasks if not task.done()]
+        await asyncio.gather(*tasks)
+
+    while not connections.empty():
+        await connections.get_nowait().close()
+    stats.report(args.duration)
+
+
+def load_test(args):
+    if args.corpus:
+        corpus = load_corpus(args.corpus)
+        births = (corpus[i % len(corpus)] for i in range(sys.maxsize))
+    else:
+        births = random_births(args.seed)
+
+    stub = start_geocoder_stub(args.geocoder_stub) if args.geocoder_stub is not None else None
+    server = start_server(args.url, args.geocoder_stub) if args.serve else None
+    try:
+        asyncio.run(run_load(args, births))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        if stub is not None:
+            stub.shutdown()
+
+
+if __name__ == "__main__":
+    # Get arguments
+    args = parse_args()
+
+    if args.date and args.time and args.place:
+        single_request(args)
+    else:
+        load_test(args)
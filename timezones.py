@@ -0,0 +1,387 @@
+"""
+timezones.py
+
+Offline time zone and historical UTC offset of a birth place.
+
+The time zone of a location is looked up in a local index of time zone
+boundaries, built from the GeoJSON releases of timezone-boundary-builder
+(https://github.com/evansiroky/timezone-boundary-builder), preferably the
+"combined-with-oceans" file. The index is a grid of cells, each listing the
+zones whose polygons overlap it, and per zone and grid row the boundary edges
+crossing that row: a lookup tests only the few edges of its own row. With the
+oceans included every point has a zone, so the last candidate of a cell (the
+only one in most cells) needs no polygon test.
+
+The UTC offset of a local birth time follows from the zone's transitions in
+the system time zone database (zoneinfo), including historical rules and
+local mean time before standard time.
+
+HDA_TZ_BOUNDARIES is the boundary file: a GeoJSON file, or an index saved by
+    python timezones.py combined-with-oceans.json timezones.npz
+which loads much faster. Without it, the timezonefinder package is used if
+installed. Without either, birth times are taken as UTC and marked with the
+note ASSUMED_UTC.
+"""
+import argparse
+import json
+import math
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+import numpy as np
+
+try:
+    from timezonefinder import TimezoneFinder
+except ImportError:
+    TimezoneFinder = None
+
+DEFAULT_CELL_DEGREES = 1.0
+
+# Note of local times taken as UTC for lack of time zone data
+ASSUMED_UTC = "assumed UTC"
+
+# Bands of at most this many edges are tested in Python instead of numpy
+SMALL_BAND = 48
+
+
+def nautical_zone(lon):
+    """
+    Nautical time zone of a longitude, e.g. "Etc/GMT+5" for 75 degrees west
+    (the sign of the Etc zones is inverted).
+    """
+    hours = int(round(lon / 15))
+    if hours == 0:
+        return "Etc/GMT"
+    return "Etc/GMT{:+d}".format(-hours)
+
+
+def _feature_rings(geometry):
+    """Rings of a Polygon or MultiPolygon geometry as lists of polygons of rings."""
+    if geometry["type"] == "Polygon":
+        return [geometry["coordinates"]]
+    if geometry["type"] == "MultiPolygon":
+        return geometry["coordinates"]
+    raise ValueError("Unsupported geometry: {}".format(geometry["type"]))
+
+
+class TimezoneIndex:
+    """
+    Grid index of time zone polygons.
+
+    Parameters
+    ----------
+    names: list of str
+        Zone name (tzid) of each shape.
+    cell_starts, cell_shapes: np.array
+        Shapes overlapping each grid cell, cell i holding
+        cell_shapes[cell_starts[i]:cell_starts[i + 1]].
+    band_keys, band_starts, edges: np.array
+        Boundary edges (x1, y1, x2, y2 rows of edges) of each shape and grid
+        row, key shape * n_rows + row, sorted by key.
+    cell_degrees: float
+        Size of a grid cell.
+    complete: bool
+        Whether the polygons cover the globe (data with oceans).
+    """
+    def __init__(self, names, cell_starts, cell_shapes, band_keys, band_starts, edges,
+                 cell_degrees=DEFAULT_CELL_DEGREES, complete=False):
+        self.names = list(names)
+        self.cell_degrees = float(cell_degrees)
+        self.n_rows = int(round(180 / self.cell_degrees))
+        self.n_cols = int(round(360 / self.cell_degrees))
+        self.cell_starts = np.asarray(cell_starts, dtype=np.int64)
+        self.cell_shapes = np.asarray(cell_shapes, dtype=np.int32)
+        self.band_keys = np.asarray(band_keys, dtype=np.int64)
+        self.band_starts = np.asarray(band_starts, dtype=np.int64)
+        self.edges = np.asarray(edges, dtype=np.float64)
+        self.complete = bool(complete)
+        # Python lists for the lookup, indexing them is faster than numpy scalars
+        self._cells = [self.cell_shapes[start:end].tolist()
+                       for start, end in zip(self.cell_starts[:-1], self.cell_starts[1:])]
+        self._bands = {key: (start, end) for key, start, end in
+                       zip(self.band_keys.tolist(), self.band_starts[:-1].tolist(),
+                           self.band_starts[1:].tolist())}
+        # Edges of the small bands used so far as Python lists
+        self._small_bands = {}
+
+    @classmethod
+    def from_geojson(cls, geojson, cell_degrees=DEFAULT_CELL_DEGREES, complete=None):
+        """
+        Build the index from a timezone-boundary-builder FeatureCollection
+        (a dict or a file path). complete defaults to whether the data has
+        the ocean zones (Etc/GMT...).
+        """
+        if isinstance(geojson, str):
+            with open(geojson) as f:
+                geojson = json.load(f)
+        n_rows = int(round(180 / cell_degrees))
+        n_cols = int(round(360 / cell_degrees))
+
+        names = []
+        cell_lists = [[] for _ in range(n_rows * n_cols)]
+        band_keys = []
+        band_edges = []
+        for feature in geojson["features"]:
+            shape = len(names)
+            names.append(feature["properties"]["tzid"])
+            shape_edges = []
+            for polygon in _feature_rings(feature["geometry"]):
+                for ring in polygon:
+                    points = np.asarray(ring, dtype=np.float64)[:, :2]
+                    # Close the ring, edges from each point to the next
+                    points = np.vstack([points, points[:1]])
+                    shape_edges.append(np.hstack([points[:-1], points[1:]]))
+                # Cells overlapped by the polygon's bounding box
+                outer = np.asarray(polygon[0], dtype=np.float64)[:, :2]
+                col_min, row_min = cls._cell_of(outer.min(axis=0), cell_degrees, n_rows, n_cols)
+                col_max, row_max = cls._cell_of(outer.max(axis=0), cell_degrees, n_rows, n_cols)
+                for row in range(row_min, row_max + 1):
+                    for col in range(col_min, col_max + 1):
+                        cell = cell_lists[row * n_cols + col]
+                        if not cell or cell[-1] != shape:
+                            cell.append(shape)
+            edges = np.vstack(shape_edges)
+            # Drop horizontal edges, a horizontal ray never crosses them
+            edges = edges[edges[:, 1] != edges[:, 3]]
+            low = np.minimum(edges[:, 1], edges[:, 3])
+            high = np.maximum(edges[:, 1], edges[:, 3])
+            first = np.clip(np.floor((low + 90) / cell_degrees).astype(np.int64), 0, n_rows - 1)
+            last = np.clip(np.floor((high + 90) / cell_degrees).astype(np.int64), 0, n_rows - 1)
+            # One copy of an edge per grid row it spans
+            counts = last - first + 1
+            edge_index = np.repeat(np.arange(len(edges)), counts)
+            rows = np.repeat(first, counts) + (np.arange(counts.sum()) -
+                                               np.repeat(np.cumsum(counts) - counts, counts))
+            band_keys.append(shape * n_rows + rows)
+            band_edges.append(edges[edge_index])
+
+        keys = np.concatenate(band_keys)
+        edges = np.vstack(band_edges)
+        order = np.argsort(keys, kind="stable")
+        keys, edges = keys[order], edges[order]
+        unique_keys, starts = np.unique(keys, return_index=True)
+        band_starts = np.append(starts, len(keys))
+
+        cell_starts = np.zeros(len(cell_lists) + 1, dtype=np.int64)
+        cell_starts[1:] = np.cumsum([len(cell) for cell in cell_lists])
+        cell_shapes = np.fromiter((shape for cell in cell_lists for shape in cell),
+                                  dtype=np.int32, count=int(cell_starts[-1]))
+        if complete is None:
+            complete = any(name.startswith("Etc/") for name in names)
+        return cls(names, cell_starts, cell_shapes, unique_keys, band_starts, edges,
+                   cell_degrees=cell_degrees, complete=complete)
+
+    @staticmethod
+    def _cell_of(point, cell_degrees, n_rows, n_cols):
+        col = min(max(int(math.floor((point[0] + 180) / cell_degrees)), 0), n_cols - 1)
+        row = min(max(int(math.floor((point[1] + 90) / cell_degrees)), 0), n_rows - 1)
+        return col, row
+
+    def save(self, path):
+        """Save as .npz, load() is much faster than building from GeoJSON."""
+        np.savez(path,
+                 names=np.array(self.names),
+                 cell_starts=self.cell_starts,
+                 cell_shapes=self.cell_shapes,
+                 band_keys=self.band_keys,
+                 band_starts=self.band_starts,
+                 edges=self.edges,
+                 cell_degrees=self.cell_degrees,
+                 complete=self.complete)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["names"].tolist(), data["cell_starts"], data["cell_shapes"],
+                       data["band_keys"], data["band_starts"], data["edges"],
+                       cell_degrees=float(data["cell_degrees"]), complete=bool(data["complete"]))
+
+    def _contains(self, shape, row, lon, lat):
+        """Even-odd ray casting against the shape's edges of one grid row."""
+        key = shape * self.n_rows + row
+        band = self._bands.get(key)
+        if band is None:
+            return False
+        if band[1] - band[0] <= SMALL_BAND:
+            # Python is faster than numpy for a few edges
+            edges = self._small_bands.get(key)
+            if edges is None:
+                edges = self._small_bands[key] = self.edges[band[0]:band[1]].tolist()
+            inside = False
+            for x1, y1, x2, y2 in edges:
+                if (y1 > lat) != (y2 > lat) and lon < x1 + (lat - y1) * (x2 - x1) / (y2 - y1):
+                    inside = not inside
+            return inside
+        x1, y1, x2, y2 = self.edges[band[0]:band[1]].T
+        crosses = (y1 > lat) != (y2 > lat)
+        x_cross = x1[crosses] + (lat - y1[crosses]) * (x2[crosses] - x1[crosses]) / (y2[crosses] - y1[crosses])
+        return np.count_nonzero(x_cross > lon) % 2 == 1
+
+    def lookup(self, lat, lon):
+        """
+        Time zone name of a location, or None outside all polygons (only
+        possible without the ocean zones).
+        """
+        col, row = self._cell_of((lon, lat), self.cell_degrees, self.n_rows, self.n_cols)
+        shapes = self._cells[row * self.n_cols + col]
+        if self.complete:
+            # The point is in one of the shapes, the last one needs no test
+            for shape in shapes[:-1]:
+                if self._contains(shape, row, lon, lat):
+                    return self.names[shape]
+            return self.names[shapes[-1]] if shapes else None
+        for shape in shapes:
+            if self._contains(shape, row, lon, lat):
+                return self.names[shape]
+        return None
+
+    def __len__(self):
+        return len(self.names)
+
+
+class TimezoneFinderLookup:
+    """Adapter of the optional timezonefinder package to TimezoneIndex.lookup."""
+    def __init__(self):
+        self._finder = TimezoneFinder(in_memory=True)
+
+    def lookup(self, lat, lon):
+        return self._finder.timezone_at(lng=lon, lat=lat)
+
+
+_locator = None
+_locator_lock = threading.Lock()
+
+
+def load_locator(path):
+    """TimezoneIndex of a saved index (.npz) or a GeoJSON boundary file."""
+    if path.endswith(".npz"):
+        return TimezoneIndex.load(path)
+    return TimezoneIndex.from_geojson(path)
+
+
+def get_locator():
+    """
+    Locator of the process, loaded on first use: the HDA_TZ_BOUNDARIES index,
+    else timezonefinder, else None (no time zone data).
+    """
+    global _locator
+    if _locator is None:
+        with _locator_lock:
+            if _locator is None:
+                path = os.environ.get("HDA_TZ_BOUNDARIES")
+                if path:
+                    _locator = load_locator(path)
+                elif TimezoneFinder is not None:
+                    _locator = TimezoneFinderLookup()
+                else:
+                    _locator = False
+    return _locator or None
+
+
+def set_locator(locator):
+    """Set the locator of the process (None: no time zone data), returns the previous one."""
+    global _locator
+    previous, _locator = _locator, (locator if locator is not None else False)
+    return previous or None
+
+
+def zone_at(location, locator=None):
+    """
+    Time zone name of a (latitude, longitude), the nautical zone outside
+    the boundary polygons, or None if no time zone data is available.
+    """
+    locator = locator or get_locator()
+    if locator is None:
+        return None
+    lat, lon = float(location[0]), float(location[1])
+    return locator.lookup(lat, lon) or nautical_zone(lon)
+
+
+def format_offset(offset: timedelta):
+    """UTC offset as "+HH:MM", or "+HH:MM:SS" if it has seconds (local mean time)."""
+    seconds = int(offset.total_seconds())
+    sign = "-" if seconds < 0 else "+"
+    hours, rest = divmod(abs(seconds), 3600)
+    minutes, seconds = divmod(rest, 60)
+    if seconds:
+        return "{}{:02d}:{:02d}:{:02d}".format(sign, hours, minutes, seconds)
+    return "{}{:02d}:{:02d}".format(sign, hours, minutes)
+
+
+def local_offset(zone: str, birthDate: str, birthTime: str):
+    """
+    UTC offset of a local time in a zone.
+
+    Local times repeated when clocks are set back use the first (earlier)
+    offset, local times skipped when clocks are set forward the offset before
+    the change, as zoneinfo does for fold=0.
+
+    Returns
+    -------
+    tuple(timedelta, str or None)
+        The offset and "ambiguous" or "nonexistent" for such local times.
+    """
+    year, month, day = [int(s) for s in birthDate.split("/")]
+    parts = [int(t) for t in birthTime.split(":")]
+    local = datetime(year, month, day, *parts, tzinfo=ZoneInfo(zone))
+    offset = local.utcoffset()
+    other = local.replace(fold=1).utcoffset()
+    if other == offset:
+        return offset, None
+    # fold=1 has the later offset: larger when repeated, smaller when skipped
+    return offset, "ambiguous" if other < offset else "nonexistent"
+
+
+def resolve(location, birthDate: str, birthTime: str, locator=None):
+    """
+    Time zone and historical UTC offset of a local birth time at a location.
+
+    Parameters
+    ----------
+    location: tuple(float, float)
+        (latitude, longitude)
+    birthDate: str
+        Should be in the format YYYY/MM/DD
+    birthTime : str
+        Local time, HH:MM or HH:MM:SS.
+
+    Returns
+    -------
+    dict or None
+        {"zone", "offset"} and "note" ("ambiguous" or "nonexistent") for
+        local times at a clock change. None if no time zone data is available.
+    """
+    zone = zone_at(location, locator)
+    if zone is None:
+        return None
+    try:
+        offset, note = local_offset(zone, birthDate, birthTime)
+    except ZoneInfoNotFoundError:
+        # Zone missing from the system database, fall back to the longitude
+        zone = nautical_zone(float(location[1]))
+        offset, note = local_offset(zone, birthDate, birthTime)
+    info = {"zone": zone, "offset": format_offset(offset)}
+    if note is not None:
+        info["note"] = note
+    return info
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Build the time zone boundary index.")
+    parser.add_argument("geojson", help="timezone-boundary-builder GeoJSON file.")
+    parser.add_argument("out", help="Index file (.npz) for HDA_TZ_BOUNDARIES.")
+    parser.add_argument("--cell-degrees", type=float, default=DEFAULT_CELL_DEGREES,
+                        help="Grid cell size in degrees.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    start = time.perf_counter()
+    index = TimezoneIndex.from_geojson(args.geojson, cell_degrees=args.cell_degrees)
+    index.save(args.out)
+    print("{} zones, {} edge copies, complete: {}, built in {:.1f} s".format(
+        len(index), len(index.edges), index.complete, time.perf_counter() - start))